@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+
+# SCADA Simulator
+#
+
+"""
+Microbenchmarks of the register behaviors and of updating_writer, run
+against an in-memory ModbusSlaveContext - no sockets and no sleeps.
+
+- 'types': every behavior type in behaviors.py is ticked --ticks times,
+  reporting ticks/sec, CPU microseconds per tick and the memory allocated
+  while ticking (tracemalloc peak and blocks still allocated at the end,
+  measured on a second run)
+- 'scaling': updating_writer runs --sizes behaviors (a mix of every type)
+  on the discrete clock (ENGINE 'clock_speed: max') for --sim_seconds
+  simulated seconds, reporting behavior updates/sec, CPU per update and the
+  number of threads, with and without --vectorized (and --coalesce,
+  ENGINE 'coalesce_writes'), and the setValues calls that reached the
+  slave context
+- --coalesce also runs an 'adjacent' scenario, linear behaviors on
+  consecutive 'hr' addresses, and reports set_values_calls_saved
+- Results are printed and written with --output as JSON
+
+    python bench_behaviors.py --sizes 10,100,1000,10000 --output results.json
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import threading
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'plc'))
+
+from pymodbus.datastore import ModbusSlaveContext, ModbusServerContext
+from datablock import TrackedDataBlock, ArrayDataBlock, BitDataBlock
+from behaviors import compile_behaviors
+from scheduler import BehaviorScheduler
+from clock import DiscreteClock
+from helper import updating_writer
+import vectorized
+
+"""
+- @brief PARAMS has the config of one behavior of every type, the address,
+  count and coil address are filled in per behavior
+"""
+
+PARAMS = {
+    ('hr', 'linear'): dict(variance=1),
+    ('hr', 'linear_coil_dependent'): dict(variance=1, max=1000,
+                                          default_coil_value=1),
+    ('hr', 'random'): dict(min=0, max=100),
+    ('hr', 'random_coil_dependent'): dict(variance=1, max=1000,
+                                          default_coil_value=1, rand_min=0,
+                                          rand_max=100),
+    ('co', 'constant'): dict(num=1),
+    ('hr', 'fuel_tank_behavior'): dict(min=0, max=100),
+}
+
+
+def build_context(registers, datablock):
+    if datablock == 'array':
+        bits, words = BitDataBlock, ArrayDataBlock
+    else:
+        bits, words = TrackedDataBlock, TrackedDataBlock
+    store = ModbusSlaveContext(di=bits(1, [0] * registers),
+                               co=bits(1, [0] * registers),
+                               hr=words(1, [0] * registers),
+                               ir=words(1, [0] * registers))
+    return ModbusServerContext(slaves=store, single=True)
+
+
+"""
+- @brief build_config() returns a PLC config with n behaviors of the given
+  (table, type) keys, taken round robin
+"""
+
+
+def build_config(keys, n, registers, count, period=1):
+    datastore = dict((table, {'start_addr': 1, 'values': [0] * registers})
+                     for table in ('di', 'co', 'hr', 'ir'))
+    counters = {'hr': 0, 'co': 0}
+    for i in range(n):
+        table, type_name = keys[i % len(keys)]
+        counters[table] += 1
+        behavior = dict(PARAMS[(table, type_name)], type=type_name,
+                        address=(i * count) % (registers - count + 1),
+                        count=count, time=period, coil_address=i % registers)
+        datastore[table]['behavior_' + str(counters[table])] = behavior
+    # compile_behaviors() goes through 'values', one behavior per value
+    for table in ('hr', 'co'):
+        if counters[table] > registers:
+            datastore[table]['values'] = [0] * counters[table]
+    return {'DATASTORE': datastore, 'ENGINE': {'clock_speed': 'max'}}
+
+
+def bench_type(key, args, log):
+    context = build_context(args.registers, args.datablock)
+    config = build_config([key], args.behaviors, args.registers, args.count)
+    behaviors = compile_behaviors(config, context, log)
+    ticks = [behavior.tick for behavior in behaviors]
+    rounds = max(args.ticks // len(ticks), 1)
+
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    for i in range(rounds):
+        for tick in ticks:
+            tick()
+    wall = time.perf_counter() - start_wall
+    cpu = time.process_time() - start_cpu
+
+    # allocations are traced on a run of their own, tracing slows ticks down
+    tracemalloc.start()
+    for i in range(rounds):
+        for tick in ticks:
+            tick()
+    snapshot = tracemalloc.take_snapshot()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    total = rounds * len(ticks)
+    blocks = sum(stat.count for stat in snapshot.statistics('filename'))
+    return {'type': key[1], 'table': key[0], 'ticks': total,
+            'ticks_per_sec': round(total / wall, 1),
+            'cpu_us_per_tick': round(cpu * 1e6 / total, 3),
+            'alloc_peak_bytes': peak,
+            'alloc_blocks_retained': blocks}
+
+
+class CountingScheduler(BehaviorScheduler):
+
+    def __init__(self, log, clock=None):
+        BehaviorScheduler.__init__(self, log, clock)
+        self.ticks = 0
+
+    def add(self, tick, period, name='behavior', delay=None, policy='skip'):
+        def counted():
+            self.ticks += 1
+            return tick()
+        return BehaviorScheduler.add(self, counted, period, name, delay,
+                                     policy)
+
+
+def bench_scaling(n, vectorize, coalesce, args, log, scenario='mixed'):
+    context = build_context(max(args.registers, n), args.datablock)
+    slave = context[0]
+    set_values = slave.setValues
+    calls = [0]
+
+    def counted_set_values(fx, address, values):
+        calls[0] += 1
+        return set_values(fx, address, values)
+    slave.setValues = counted_set_values
+    if scenario == 'adjacent':
+        # linear behaviors writing one register each, at consecutive
+        # addresses, so coalescing can merge them
+        config = build_config([('hr', 'linear')], n, max(args.registers, n),
+                              1)
+    else:
+        # fuel_tank_behavior runs on its own timeline, not the period
+        keys = [key for key in sorted(PARAMS)
+                if key[1] != 'fuel_tank_behavior']
+        config = build_config(keys, n, max(args.registers, n), args.count)
+    config['ENGINE']['vectorized'] = vectorize
+    config['ENGINE']['coalesce_writes'] = coalesce
+    scheduler = CountingScheduler(log, clock=DiscreteClock())
+
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    updating_writer(context, config, None, log, None, scheduler=scheduler)
+    setup = time.perf_counter() - start_wall
+    threads = threading.active_count()
+    scheduler.run(until=scheduler.clock.now() + args.sim_seconds)
+    wall = time.perf_counter() - start_wall
+    cpu = time.process_time() - start_cpu
+    # every behavior has a period of 1 simulated second
+    updates = n * args.sim_seconds
+    return {'scenario': scenario, 'behaviors': n, 'vectorized': vectorize,
+            'coalesce_writes': coalesce,
+            'sim_seconds': args.sim_seconds,
+            'set_values_calls': calls[0],
+            'scheduled_ticks': scheduler.ticks,
+            'behavior_updates_per_sec': round(updates / wall, 1),
+            'cpu_us_per_update': round(cpu * 1e6 / updates, 3),
+            'setup_sec': round(setup, 4),
+            'threads': threads}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Microbenchmarks of the register behaviors")
+    parser.add_argument("--mode", default='all',
+                        choices=['all', 'types', 'scaling'],
+                        help="Benchmarks to run")
+    parser.add_argument("--ticks", type=int, default=20000,
+                        help="Ticks per behavior type")
+    parser.add_argument("--behaviors", type=int, default=100,
+                        help="Behaviors per type for the 'types' benchmark")
+    parser.add_argument("--count", type=int, default=1,
+                        help="Registers controlled by every behavior")
+    parser.add_argument("--registers", type=int, default=1000,
+                        help="Number of values in every table")
+    parser.add_argument("--sizes", default='10,100,1000,10000',
+                        help="Numbers of behaviors for the 'scaling' "
+                             "benchmark")
+    parser.add_argument("--sim_seconds", type=int, default=10,
+                        help="Simulated seconds per 'scaling' run")
+    parser.add_argument("--vectorized", action='store_true',
+                        help="Also run 'scaling' with ENGINE vectorized")
+    parser.add_argument("--coalesce", action='store_true',
+                        help="Also run 'scaling' with ENGINE coalesce_writes")
+    parser.add_argument("--datablock", default='list',
+                        choices=['list', 'array'],
+                        help="Datablock to run against")
+    parser.add_argument("--output",
+                        help="File to write the results to as JSON")
+    args = parser.parse_args()
+
+    log = logging.getLogger('bench')
+    log.setLevel(logging.WARNING)
+    results = {'datablock': args.datablock, 'count': args.count}
+    if args.mode in ('all', 'types'):
+        results['types'] = [bench_type(key, args, log)
+                            for key in sorted(PARAMS)]
+        for result in results['types']:
+            print(json.dumps(result))
+    if args.mode in ('all', 'scaling'):
+        modes = [(False, False)]
+        if args.coalesce:
+            modes.append((False, True))
+        if args.vectorized:
+            if vectorized.is_available():
+                modes.append((True, False))
+            else:
+                log.warning("NumPy is not installed - skipping vectorized")
+        runs = [('mixed', mode) for mode in modes]
+        if args.coalesce:
+            runs += [('adjacent', (False, False)), ('adjacent', (False, True))]
+        results['scaling'] = []
+        for n in [int(size) for size in args.sizes.split(',')]:
+            uncoalesced = {}
+            for scenario, (vectorize, coalesce) in runs:
+                result = bench_scaling(n, vectorize, coalesce, args, log,
+                                       scenario)
+                calls = result['set_values_calls']
+                if not coalesce:
+                    uncoalesced[scenario, vectorize] = calls
+                elif (scenario, vectorize) in uncoalesced:
+                    result['set_values_calls_saved'] = \
+                        uncoalesced[scenario, vectorize] - calls
+                results['scaling'].append(result)
+                print(json.dumps(result))
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
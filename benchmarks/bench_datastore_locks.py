@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+
+# SCADA Simulator
+#
+
+"""
+Benchmark of the atomic update functions in plc/datastore.py against the
+unlocked read -> modify -> write path the behaviors used before.
+
+- 'behavior' threads add 1 to the same block of holding registers, either
+  with read_hr_register/write_hr_register (unlocked) or with
+  update_hr_register after lock_tables() (locked)
+- 'client' threads act like Modbus requests being served at the same time:
+  they read the whole table and write registers next to the block
+- Reports updates/sec, client requests/sec and lost updates (increments
+  overwritten by another writer) for both paths
+- Registers are 16 bit (ArrayDataBlock saturates at 65535), so the
+  increments wrap around at 2**16 and lost updates are counted modulo 2**16
+
+    python bench_datastore_locks.py --duration 5 --behaviors 4 --clients 4
+"""
+import os
+import sys
+import json
+import time
+import argparse
+from threading import Event, Thread
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'plc'))
+
+from pymodbus.datastore import ModbusSlaveContext
+from datablock import TrackedDataBlock, ArrayDataBlock
+from datastore import *
+
+BLOCK = 8
+TABLE_SIZE = 64
+REGISTER_RANGE = 2 ** 16
+
+
+def build_context(datablock):
+    block_class = ArrayDataBlock if datablock == 'array' else TrackedDataBlock
+    return ModbusSlaveContext(
+        di=block_class(1, [0] * TABLE_SIZE),
+        co=block_class(1, [0] * TABLE_SIZE),
+        hr=block_class(1, [0] * TABLE_SIZE),
+        ir=block_class(1, [0] * TABLE_SIZE))
+
+
+def add_one(values):
+    return [(v + 1) % REGISTER_RANGE for v in values]
+
+
+def unlocked_behavior(context, stop, counts, i):
+    n = 0
+    while not stop.is_set():
+        values = read_hr_register(context, 0x00, 0, BLOCK)
+        write_hr_register(context, 0x00, 0, add_one(values))
+        n += 1
+    counts[i] = n
+
+
+def locked_behavior(context, stop, counts, i):
+    n = 0
+    while not stop.is_set():
+        update_hr_register(context, 0x00, 0, BLOCK, add_one)
+        n += 1
+    counts[i] = n
+
+
+def client(context, stop, counts, i):
+    n = 0
+    while not stop.is_set():
+        context.getValues(3, 0, TABLE_SIZE)
+        context.setValues(3, BLOCK + i % (TABLE_SIZE - BLOCK), [n % 100])
+        n += 2
+    counts[i] = n
+
+
+def run(mode, args):
+    context = build_context(args.datablock)
+    if mode == 'locked':
+        lock_tables(context)
+        behavior = locked_behavior
+    else:
+        behavior = unlocked_behavior
+    stop = Event()
+    behavior_counts = [0] * args.behaviors
+    client_counts = [0] * args.clients
+    threads = [Thread(target=behavior, args=(context, stop, behavior_counts,
+                                             i))
+               for i in range(args.behaviors)]
+    threads += [Thread(target=client, args=(context, stop, client_counts, i))
+                for i in range(args.clients)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    time.sleep(args.duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    updates = sum(behavior_counts)
+    # every update adds 1 (modulo 2**16) to every register of the block
+    applied = min(read_hr_register(context, 0x00, 0, BLOCK))
+    lost = (updates - applied) % REGISTER_RANGE
+    return {'mode': mode,
+            'datablock': args.datablock,
+            'behaviors': args.behaviors,
+            'clients': args.clients,
+            'updates_per_sec': round(updates / elapsed, 1),
+            'client_requests_per_sec': round(sum(client_counts) / elapsed, 1),
+            'lost_updates': lost}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark locked vs unlocked datastore updates")
+    parser.add_argument("--duration", type=float, default=3,
+                        help="Seconds to run each mode")
+    parser.add_argument("--behaviors", type=int, default=4,
+                        help="Number of behavior threads")
+    parser.add_argument("--clients", type=int, default=4,
+                        help="Number of client threads")
+    parser.add_argument("--datablock", default='list',
+                        choices=['list', 'array'],
+                        help="Datablock to run against")
+    parser.add_argument("--switch_interval", type=float, default=None,
+                        help="sys.setswitchinterval() value, smaller values "
+                             "make races more likely")
+    parser.add_argument("--output",
+                        help="File to write the results to as JSON")
+    args = parser.parse_args()
+    if args.switch_interval is not None:
+        sys.setswitchinterval(args.switch_interval)
+
+    results = [run(mode, args) for mode in ('unlocked', 'locked')]
+    for result in results:
+        print(json.dumps(result))
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
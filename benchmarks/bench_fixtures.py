@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+# SCADA Simulator
+#
+
+"""
+Generates the master configs the benchmarks run against, with the spec mode
+of plc_config_gen.py, so every run of a benchmark sees the same plant.
+
+- FIXTURES has the spec of every fixture, from a handful of PLC devices to a
+  500 PLC device plant with 10,000 registers per table
+- The PLC devices listen on 127.0.0.1 from BASE_PORT of bench_server.py on,
+  and log warnings to --output_dir/logs
+- Next to every <fixture>.yaml the spec it was generated from is written as
+  <fixture>.spec.yaml
+
+    python bench_fixtures.py --fixtures small,plant_500 --output_dir fixtures
+    python bench_server.py --config fixtures/small.yaml --clients 4
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'configs'))
+
+from plc_config_gen import generate_config
+
+BASE_PORT = 15020
+
+
+def plant_spec(plcs, registers, behaviors, coil_behaviors):
+    return {
+        'seed': 0,
+        'num_of_PLC': plcs,
+        'DATASTORE': {
+            'hr': {'registers': registers, 'values': {'min': 0, 'max': 1000},
+                   'behaviors': behaviors,
+                   'mix': {'linear': 4, 'random': 4,
+                           'linear_coil_dependent': 1,
+                           'random_coil_dependent': 1},
+                   'time': [1, 2, 5], 'count': {'min': 1, 'max': 4}},
+            'co': {'registers': registers, 'values': [0, 1],
+                   'behaviors': coil_behaviors, 'mix': {'constant': 1},
+                   'time': 1, 'count': 1},
+            'di': {'registers': registers, 'values': [0, 1]},
+            'ir': {'registers': registers,
+                   'values': {'mean': 500, 'stddev': 100, 'min': 0}},
+        },
+        'LOGGING': {'format': 'NONE', 'logging_level': 'WARNING'},
+        'SERVER': {'type': 'tcp', 'framer': 'TCP', 'address': '127.0.0.1',
+                   'port': {'start': BASE_PORT}},
+        'ENGINE': {'scheduler': 'thread', 'datablock': 'list'},
+        'BACKUP': {'interval': 1, 'max_delay': 5},
+    }
+
+
+FIXTURES = {
+    'small': plant_spec(4, 100, 10, 2),
+    'medium': plant_spec(50, 1000, 100, 10),
+    'large': plant_spec(100, 10000, 1000, 100),
+    'plant_500': plant_spec(500, 10000, 200, 10),
+}
+
+
+def write_fixture(name, output_dir):
+    spec = dict(FIXTURES[name])
+    spec['LOGGING'] = dict(spec['LOGGING'], file=os.path.join(
+        os.path.abspath(output_dir), 'logs', 'plc_{n}.log'))
+    config_filename = os.path.join(output_dir, name + '.yaml')
+    with open(os.path.join(output_dir, name + '.spec.yaml'), 'w') as stream:
+        yaml.safe_dump(spec, stream)
+    start = time.perf_counter()
+    with open(config_filename, 'w') as stream:
+        plcs = generate_config(spec, stream)
+    return {'fixture': name, 'config': config_filename, 'plcs': plcs,
+            'bytes': os.path.getsize(config_filename),
+            'seconds': round(time.perf_counter() - start, 3)}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generate the master configs benchmarks run against")
+    parser.add_argument("--fixtures", default='small,medium',
+                        help="Fixtures to generate, of " +
+                             ', '.join(sorted(FIXTURES)))
+    parser.add_argument("--output_dir", default='fixtures',
+                        help="Directory to write the fixtures to")
+    args = parser.parse_args()
+    names = args.fixtures.split(',')
+    for name in names:
+        if name not in FIXTURES:
+            parser.error("unknown fixture '%s'" % name)
+    if not os.path.isdir(os.path.join(args.output_dir, 'logs')):
+        os.makedirs(os.path.join(args.output_dir, 'logs'))
+    for name in names:
+        print(json.dumps(write_fixture(name, args.output_dir)))
+
+
+if __name__ == "__main__":
+    main()
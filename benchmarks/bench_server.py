@@ -0,0 +1,379 @@
+#!/usr/bin/env python
+
+# SCADA Simulator
+#
+
+"""
+Throughput/latency benchmark of PLC devices served by
+async_plc.run_updating_server.
+
+- Generates a master config for --plcs PLC devices on localhost, each with
+  --registers values per table and --behaviors linear holding register
+  behaviors, and starts every PLC device in a process of its own
+- The SERVER block of every PLC device follows --server: 'tcp', 'udp' or
+  'rtu' (RTU framer over TCP, see configure_server_framer in helper.py)
+- --clients client processes send requests to the PLC devices round robin
+  for --duration seconds, picking the function code of every request from
+  --mix (FC 1/2/3/4/5/6/15/16, weighted)
+- Reports requests/sec, errors and p50/p99/p999 latency in ms, overall and
+  per function code, as JSON; with --baseline the results are compared to
+  an earlier --output file
+- With --config the PLC devices of a master config are run instead, e.g. a
+  fixture written by bench_fixtures.py
+
+    python bench_server.py --server tcp --plcs 2 --behaviors 100 \
+        --clients 4 --duration 10 --output results.json
+"""
+import os
+import sys
+import json
+import time
+import yaml
+import random
+import shutil
+import logging
+import argparse
+import tempfile
+import platform
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'plc'))
+
+from pymodbus.client.sync import ModbusTcpClient, ModbusUdpClient
+from pymodbus.transaction import ModbusRtuFramer
+from pymodbus.version import version
+
+BASE_PORT = 15020
+DEFAULT_MIX = '1:1,2:1,3:1,4:1,5:1,6:1,15:1,16:1'
+# single request size for the multiple read/write function codes
+BLOCK = 8
+
+
+"""
+- @brief build_master_config() returns the master config of the PLC devices
+  under test, in the same layout plc_config_gen.py writes
+"""
+
+
+def build_master_config(args, log_dir):
+    master_config = {'MASTER': {'num_of_PLC': args.plcs}}
+    for i in range(args.plcs):
+        datastore = {}
+        for table in ('di', 'co', 'hr', 'ir'):
+            datastore[table] = {'start_addr': 1,
+                                'values': [0] * args.registers}
+        for j in range(args.behaviors):
+            datastore['hr']['behavior_' + str(j + 1)] = dict(
+                type='linear', variance=1, address=j % args.registers,
+                time=args.behavior_period, count=1)
+        server = dict(type='udp' if args.server == 'udp' else 'tcp',
+                      framer='RTU' if args.server == 'rtu' else 'TCP',
+                      address='127.0.0.1', port=args.port + i)
+        master_config['PLC ' + str(i)] = dict(
+            DATASTORE=datastore,
+            LOGGING=dict(file=os.path.join(log_dir, 'plc_%d.log' % i),
+                         format='NONE', logging_level='WARNING'),
+            SERVER=server,
+            ENGINE=dict(scheduler=args.scheduler, datablock=args.datablock,
+                        vectorized=args.vectorized, locking=args.locking),
+            BACKUP=dict(interval=1, max_delay=5))
+    return master_config
+
+
+def run_plc(config_list, backup_filename):
+    from helper import configure_logging
+    from async_plc import run_updating_server
+    log = configure_logging(config_list['LOGGING'])
+    run_updating_server(config_list, backup_filename, log)
+
+
+"""
+- @brief start_plcs() writes the backup file of every PLC device, the same
+  way master.py does, and starts them
+"""
+
+
+def start_plcs(master_config, work_dir):
+    processes = []
+    for i in range(master_config['MASTER']['num_of_PLC']):
+        config_list = master_config['PLC ' + str(i)]
+        backup_filename = os.path.join(work_dir, 'backup_%d.yaml' % i)
+        with open(backup_filename, 'w') as backup:
+            yaml.dump({'DATASTORE': config_list['DATASTORE']}, backup)
+        process = multiprocessing.Process(target=run_plc,
+                                          args=(config_list, backup_filename))
+        process.daemon = True
+        process.start()
+        processes.append(process)
+    return processes
+
+
+def connect(server_config):
+    host, port = server_config['address'], server_config['port']
+    if server_config['type'] == 'udp':
+        return ModbusUdpClient(host, port, timeout=1)
+    if server_config['framer'] == 'RTU':
+        return ModbusTcpClient(host, port, framer=ModbusRtuFramer, timeout=1)
+    return ModbusTcpClient(host, port, timeout=1)
+
+
+def wait_for_plcs(server_configs, timeout=30):
+    # refused connections are expected until the servers listen
+    logging.getLogger('pymodbus.client.sync').setLevel(logging.CRITICAL)
+    deadline = time.time() + timeout
+    for server_config in server_configs:
+        client = connect(server_config)
+        while True:
+            try:
+                if not client.read_holding_registers(0, 1, unit=1).isError():
+                    break
+            except Exception:
+                pass
+            if time.time() > deadline:
+                raise RuntimeError("PLC device on port %d did not start" %
+                                   server_config['port'])
+            time.sleep(0.2)
+        client.close()
+
+
+"""
+- @brief REQUESTS maps every function code to a call sending one request,
+  with the address picked by the client
+"""
+
+REQUESTS = {
+    1: lambda c, a: c.read_coils(a, BLOCK, unit=1),
+    2: lambda c, a: c.read_discrete_inputs(a, BLOCK, unit=1),
+    3: lambda c, a: c.read_holding_registers(a, BLOCK, unit=1),
+    4: lambda c, a: c.read_input_registers(a, BLOCK, unit=1),
+    5: lambda c, a: c.write_coil(a, a % 2 == 0, unit=1),
+    6: lambda c, a: c.write_register(a, a, unit=1),
+    15: lambda c, a: c.write_coils(a, [True] * BLOCK, unit=1),
+    16: lambda c, a: c.write_registers(a, [a] * BLOCK, unit=1),
+}
+
+
+def parse_mix(mix):
+    weights = {}
+    for entry in mix.split(','):
+        fc, weight = entry.split(':')
+        if int(fc) not in REQUESTS:
+            raise ValueError("function code %s is not supported" % fc)
+        weights[int(fc)] = float(weight)
+    return weights
+
+
+"""
+- @brief client_worker() runs in a client process and returns the latency
+  (seconds) of every request sent, by function code, and the error count
+"""
+
+
+def client_worker(server_configs, weights, registers, start, duration, seed):
+    rng = random.Random(seed)
+    clients = [connect(server_config) for server_config in server_configs]
+    fcs = list(weights)
+    cum_weights = []
+    total = 0
+    for fc in fcs:
+        total += weights[fc]
+        cum_weights.append(total)
+    latencies = dict((fc, []) for fc in fcs)
+    errors = 0
+    # start together with the other client processes
+    time.sleep(max(start - time.time(), 0))
+    end = start + duration
+    i = 0
+    while True:
+        now = time.time()
+        if now >= end:
+            break
+        fc = rng.choices(fcs, cum_weights=cum_weights)[0]
+        address = rng.randrange(registers - BLOCK + 1)
+        client = clients[i % len(clients)]
+        i += 1
+        before = time.perf_counter()
+        try:
+            response = REQUESTS[fc](client, address)
+            failed = response is None or response.isError()
+        except Exception:
+            failed = True
+        latency = time.perf_counter() - before
+        if failed:
+            errors += 1
+        else:
+            latencies[fc].append(latency)
+    for client in clients:
+        client.close()
+    return latencies, errors
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(int(fraction * len(sorted_values)), len(sorted_values) - 1)
+    return round(sorted_values[index] * 1000, 3)
+
+
+def summarize(latencies, duration):
+    latencies = sorted(latencies)
+    return {'requests': len(latencies),
+            'requests_per_sec': round(len(latencies) / duration, 1),
+            'p50_ms': percentile(latencies, 0.50),
+            'p99_ms': percentile(latencies, 0.99),
+            'p999_ms': percentile(latencies, 0.999)}
+
+
+"""
+- @brief load_master_config() reads a master config for --config, with its
+  PLC_GROUPS expanded, and sets the --plcs and --registers it runs with
+"""
+
+
+def load_master_config(args):
+    from config_cache import load_yaml
+    from templates import get_plc_config
+    with open(args.config, 'rb') as config_file:
+        config = load_yaml(config_file)
+    args.plcs = config['MASTER']['num_of_PLC']
+    master_config = {'MASTER': config['MASTER']}
+    for i in range(args.plcs):
+        master_config['PLC ' + str(i)] = get_plc_config(config, i)
+    # clients address every table of every PLC device alike
+    args.registers = min(
+        len(master_config['PLC ' + str(i)]['DATASTORE'][table]['values'])
+        for i in range(args.plcs) for table in ('di', 'co', 'hr', 'ir'))
+    return master_config
+
+
+def run(args):
+    work_dir = tempfile.mkdtemp(prefix='bench_server_')
+    if args.config:
+        master_config = load_master_config(args)
+    else:
+        master_config = build_master_config(args, work_dir)
+    server_configs = [master_config['PLC ' + str(i)]['SERVER']
+                      for i in range(args.plcs)]
+    processes = start_plcs(master_config, work_dir)
+    try:
+        wait_for_plcs(server_configs)
+        weights = parse_mix(args.mix)
+        start = time.time() + 0.5
+        pool = multiprocessing.Pool(args.clients)
+        results = pool.starmap(client_worker, [
+            (server_configs, weights, args.registers, start, args.duration,
+             args.seed + i) for i in range(args.clients)])
+        pool.close()
+        pool.join()
+    finally:
+        for process in processes:
+            process.terminate()
+            process.join()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    by_fc = dict((fc, []) for fc in weights)
+    errors = 0
+    for latencies, client_errors in results:
+        errors += client_errors
+        for fc, values in latencies.items():
+            by_fc[fc].extend(values)
+    overall = summarize([v for values in by_fc.values() for v in values],
+                        args.duration)
+    overall['errors'] = errors
+    return {'config': {'config': args.config,
+                       'server': args.server, 'plcs': args.plcs,
+                       'behaviors': args.behaviors,
+                       'behavior_period': args.behavior_period,
+                       'registers': args.registers, 'clients': args.clients,
+                       'duration': args.duration, 'mix': args.mix,
+                       'scheduler': args.scheduler,
+                       'datablock': args.datablock,
+                       'vectorized': args.vectorized,
+                       'locking': args.locking},
+            'environment': {'python': platform.python_version(),
+                            'pymodbus': version.short(),
+                            'platform': platform.platform(),
+                            'cpus': multiprocessing.cpu_count()},
+            'overall': overall,
+            'by_function_code': dict(
+                (str(fc), summarize(values, args.duration))
+                for fc, values in sorted(by_fc.items()))}
+
+
+"""
+- @brief compare() prints the change of every overall metric against an
+  earlier result
+"""
+
+
+def compare(result, baseline):
+    for key in ('requests_per_sec', 'p50_ms', 'p99_ms', 'p999_ms'):
+        new, old = result['overall'][key], baseline['overall'][key]
+        if new is None or not old:
+            continue
+        print("%-16s %10s -> %10s (%+.1f%%)" % (key, old, new,
+                                               (new - old) * 100.0 / old))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark Modbus requests served by async_plc.py")
+    parser.add_argument("--server", default='tcp',
+                        choices=['tcp', 'udp', 'rtu'],
+                        help="SERVER type/framer of the PLC devices "
+                             "('rtu' is the RTU framer over TCP)")
+    parser.add_argument("--plcs", type=int, default=1,
+                        help="Number of PLC devices")
+    parser.add_argument("--behaviors", type=int, default=10,
+                        help="Number of holding register behaviors per "
+                             "PLC device")
+    parser.add_argument("--behavior_period", type=float, default=1,
+                        help="'time' of every behavior in seconds")
+    parser.add_argument("--registers", type=int, default=100,
+                        help="Number of values in every table")
+    parser.add_argument("--clients", type=int, default=4,
+                        help="Number of client processes")
+    parser.add_argument("--duration", type=float, default=10,
+                        help="Seconds to send requests for")
+    parser.add_argument("--mix", default=DEFAULT_MIX,
+                        help="Function codes and weights to send, "
+                             "e.g. '3:8,16:2'")
+    parser.add_argument("--scheduler", default='thread',
+                        choices=['thread', 'reactor'],
+                        help="ENGINE scheduler of the PLC devices")
+    parser.add_argument("--datablock", default='list',
+                        choices=['list', 'array'],
+                        help="ENGINE datablock of the PLC devices")
+    parser.add_argument("--vectorized", action='store_true',
+                        help="Set ENGINE vectorized on the PLC devices")
+    parser.add_argument("--locking", action='store_true',
+                        help="Set ENGINE locking on the PLC devices")
+    parser.add_argument("--port", type=int, default=BASE_PORT,
+                        help="Port of the first PLC device")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed of the request mix")
+    parser.add_argument("--config",
+                        help="Master config to run instead of generating "
+                             "one, the PLC device options are ignored")
+    parser.add_argument("--output",
+                        help="File to write the results to as JSON")
+    parser.add_argument("--baseline",
+                        help="Earlier --output file to compare against")
+    args = parser.parse_args()
+    if args.registers < BLOCK:
+        parser.error("--registers has to be at least %d" % BLOCK)
+
+    logging.basicConfig(level=logging.WARNING)
+    result = run(args)
+    print(json.dumps(result, indent=2))
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            compare(result, json.load(baseline))
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(result, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,9 +3,84 @@
 # SCADA Simulator
 #
 
+"""
+Generates a master config, from command line questions or, for large test
+plants, from a spec (--spec):
+
+    python plc_config_gen.py --spec plant_spec.yaml --output plant.yaml
+
+- The spec sets the number of PLC devices, the registers and behaviors of
+  every table, the parameters of every behavior type and the other sections
+  of a PLC config; numbers can be drawn from distributions (see sample())
+- Every PLC device is generated with a random.Random of its own, seeded from
+  the spec 'seed' and its number, so a config is reproducible
+- The config is written PLC device by PLC device as it is generated, so only
+  one PLC device is kept in memory however large the plant is
+"""
 import sys
+import random
+import argparse
 import yaml
 
+try:
+    from yaml import CDumper as Dumper
+except ImportError:
+    from yaml import Dumper
+
+"""
+@brief ask() asks a question until the answer is valid, and returns the
+answer converted, or default for an empty answer
+- choices limits the answers allowed; convert (e.g. float) raises ValueError
+  for an answer it can not take
+"""
+
+
+def ask(question, default, choices=None, convert=None):
+    hint = '/'.join(choices) if choices is not None else ''
+    while True:
+        answer = input("%s (%sdefault %s):\n" % (
+            question, hint + ', ' if hint else '', default)).strip()
+        if not answer:
+            return default
+        if choices is not None and answer not in choices:
+            print("Enter one of: " + ', '.join(choices))
+            continue
+        if convert is None:
+            return answer
+        try:
+            return convert(answer)
+        except ValueError as error:
+            print("Not a valid answer: %s" % error)
+
+
+def yes_no(question, default=False):
+    return ask(question, 'y' if default else 'n', ('y', 'n')) == 'y'
+
+
+def positive(convert):
+    def positive_value(answer):
+        value = convert(answer)
+        if value <= 0:
+            raise ValueError("%s is not greater than 0" % answer)
+        return value
+    return positive_value
+
+
+def port_number(answer):
+    if answer == 'NONE':
+        return answer
+    value = int(answer)
+    if not 0 < value < 65536:
+        raise ValueError("%s is not a port number" % answer)
+    return value
+
+
+def speed_factor(answer):
+    if answer == 'max':
+        return answer
+    return positive(float)(answer)
+
+
 """
 @brief obtain input on parameters for linear behavior
 """
@@ -146,6 +221,11 @@ def logging_setup():
                                    "or a valid format string:\n")
     if logging_dict['format'] == 'DEFAULT':
         logging_dict['format'] = def_format
+    logging_dict['queue'] = yes_no("Write log records from a background "
+                                   "thread?")
+    logging_dict['rate_limit'] = ask("DEBUG/INFO records per second per "
+                                     "behavior, 0 for no limit", 0.0,
+                                     convert=float)
     return logging_dict
 
 
@@ -164,28 +244,352 @@ def server_setup():
     server_dict['port'] = input("Enter port used for server:\n")
     server_dict['address'] = input("Enter address used for server "
                                    "(NONE if using serial server):\n")
+    metrics_port = ask("Enter port to serve metrics on, NONE for no "
+                       "metrics", 'NONE', convert=port_number)
+    if metrics_port != 'NONE':
+        server_dict['metrics_port'] = metrics_port
     return server_dict
 
 
+"""
+@brief obtain input on how often the datastore is backed up
+"""
+
+
+def backup_setup():
+    backup_dict = dict(format='yaml', interval=1, max_delay=5)
+    print("\n\nConfiguring Backup\n")
+    backup_dict['format'] = ask("Back up the datastore to a 'yaml' file or "
+                                "keep it in an 'mmap' file", 'yaml',
+                                ('yaml', 'mmap'))
+    backup_dict['interval'] = ask("How often to check the datastore for "
+                                  "changes to back up, in seconds", 1.0,
+                                  convert=positive(float))
+    backup_dict['max_delay'] = ask("Longest time a burst of changes can "
+                                   "hold back a backup, in seconds", 5.0,
+                                   convert=positive(float))
+    return backup_dict
+
+
+"""
+@brief obtain input on how the register behaviors are run
+"""
+
+
+def engine_setup():
+    engine_dict = dict(scheduler='thread', vectorized=False, datablock='list',
+                       locking=False, plugins=[], clock_speed=1)
+    print("\n\nConfiguring Engine\n")
+    engine_dict['scheduler'] = ask("Run behaviors on a scheduler 'thread' "
+                                   "or on the server 'reactor'", 'thread',
+                                   ('thread', 'reactor'))
+    engine_dict['vectorized'] = yes_no("Vectorize behaviors with NumPy?")
+    engine_dict['datablock'] = ask("Keep the datastore in a 'list' or in a "
+                                   "packed 'array'", 'list',
+                                   ('list', 'array'))
+    engine_dict['locking'] = yes_no("Lock tables so client requests can not "
+                                    "interrupt behavior updates?")
+    engine_dict['clock_speed'] = ask("Simulation speed-up factor, or 'max' "
+                                     "to run behaviors as fast as possible "
+                                     "(1 is real time)", 1.0,
+                                     convert=speed_factor)
+    plugins = input("Modules with extra behaviors, comma separated "
+                    "(blank for none):\n")
+    engine_dict['plugins'] = [p.strip() for p in plugins.split(',')
+                              if p.strip()]
+    return engine_dict
+
+
+"""
+@brief obtain input on the history kept of the datastore, None for no history
+"""
+
+
+def historian_setup():
+    print("\n\nConfiguring Historian\n")
+    if not yes_no("Keep a history of the datastore?"):
+        return None
+    historian_dict = dict(interval=1, raw_rows=3600, second_rows=86400,
+                          minute_rows=10080)
+    historian_dict['interval'] = ask("How often to sample the datastore, in "
+                                     "seconds", 1.0, convert=positive(float))
+    historian_dict['raw_rows'] = ask("Number of raw samples to keep", 3600,
+                                     convert=positive(int))
+    historian_dict['minute_rows'] = ask("Number of 1 minute min/max/avg rows "
+                                        "to keep", 10080,
+                                        convert=positive(int))
+    return historian_dict
+
+
 """
 @brief calls all of the other functions - encapsulates the setup of a PLC device
 """
 
 
 def plc_setup():
-    return dict(DATASTORE=datastore_setup(), LOGGING=logging_setup(),
-                SERVER=server_setup())
+    plc_dict = dict(DATASTORE=datastore_setup(), LOGGING=logging_setup(),
+                    SERVER=server_setup(), ENGINE=engine_setup(),
+                    BACKUP=backup_setup())
+    historian_dict = historian_setup()
+    if historian_dict is not None:
+        plc_dict['HISTORIAN'] = historian_dict
+    return plc_dict
+
+
+DEFAULT_FORMAT = '%(asctime)-15s %(threadName)-15s %(levelname)-8s ' \
+                 '%(module)-15s:%(lineno)-8s %(message)s'
+
+"""
+@brief DEFAULT_PARAMS are the parameters of the built-in behavior types, the
+BEHAVIORS section of a spec adds to and overrides them
+- coil_address is drawn from the coils of the PLC device when not given
+"""
+
+DEFAULT_PARAMS = {
+    'linear': dict(variance=1),
+    'linear_coil_dependent': dict(variance=1, max=1000,
+                                  default_coil_value=1),
+    'random': dict(min=0, max=100),
+    'random_coil_dependent': dict(variance=1, max=1000, default_coil_value=1,
+                                  rand_min=0, rand_max=100),
+    'constant': dict(num=1),
+    'fuel_tank_behavior': dict(min=0, max=100),
+}
+
+COIL_DEPENDENT = ('linear_coil_dependent', 'random_coil_dependent',
+                  'fuel_tank_behavior')
+
+"""
+@brief EXAMPLE_SPEC is written by --example_spec, as a starting point
+"""
+
+EXAMPLE_SPEC = """\
+seed: 1
+num_of_PLC: 500
+DATASTORE:
+  hr:
+    registers: 10000             # or {min: 5000, max: 10000} per PLC device
+    values: {min: 0, max: 1000}  # a number, a list to pick from,
+                                 # {min, max} or {mean, stddev}
+    behaviors: 200
+    mix: {linear: 3, random: 2, linear_coil_dependent: 1}
+    time: [1, 2, 5]
+    count: {min: 1, max: 4}
+  co: {registers: 100, values: [0, 1], behaviors: 10, mix: {constant: 1},
+       time: 1, count: 1}
+  di: {registers: 100, values: 0}
+  ir: {registers: 100, values: {mean: 500, stddev: 50}}
+BEHAVIORS:
+  linear: {variance: {min: -2, max: 2}}
+LOGGING: {file: '/usr/local/bin/scadasim_pymodbus_plc/logging/logging_{n}.log',
+          format: DEFAULT, logging_level: WARNING}
+SERVER: {type: tcp, framer: TCP, address: 0.0.0.0, port: 5020-5519}
+ENGINE: {scheduler: reactor, datablock: array}
+BACKUP: {format: mmap}
+"""
+
+
+"""
+@brief sample() draws a value from a spec entry:
+- a number or string is used as is, a list is picked from
+- {min, max} is uniform (integers if both are integers), {mean, stddev} is
+  normal, rounded and clamped to 'min'/'max' when given
+"""
+
+
+def sample(rng, spec):
+    if isinstance(spec, list):
+        return rng.choice(spec)
+    if not isinstance(spec, dict):
+        return spec
+    if 'mean' in spec:
+        value = int(round(rng.gauss(spec['mean'], spec.get('stddev', 1))))
+        if 'min' in spec:
+            value = max(value, spec['min'])
+        if 'max' in spec:
+            value = min(value, spec['max'])
+        return value
+    low, high = spec['min'], spec['max']
+    if isinstance(low, int) and isinstance(high, int):
+        return rng.randint(low, high)
+    return rng.uniform(low, high)
+
+
+def sample_values(rng, spec, n):
+    if isinstance(spec, (list, dict)):
+        return [sample(rng, spec) for i in range(n)]
+    return [spec] * n
+
+
+def port_of(spec, num):
+    # 'first-last' or {start, step}, taken in PLC number order
+    if isinstance(spec, str) and '-' in spec:
+        first, last = [int(port) for port in spec.split('-')]
+        if first + num > last:
+            raise ValueError("port range %s is too small for PLC %d" %
+                             (spec, num))
+        return first + num
+    if isinstance(spec, dict):
+        return spec['start'] + num * spec.get('step', 1)
+    return spec
+
+
+"""
+@brief generate_behaviors() fills in behavior_1 ... behavior_N of a table,
+picking the type of every behavior from the weighted 'mix'
+"""
+
+
+def generate_behaviors(rng, table_config, table_spec, params, coils):
+    registers = len(table_config['values'])
+    n = min(int(sample(rng, table_spec.get('behaviors', 0))), registers)
+    mix = table_spec.get('mix', {})
+    types = sorted(mix)
+    weights = [mix[type_name] for type_name in types]
+    for i in range(n):
+        type_name = rng.choices(types, weights=weights)[0]
+        count = min(int(sample(rng, table_spec.get('count', 1))), registers)
+        behavior = dict(type=type_name,
+                        address=rng.randrange(registers - count + 1),
+                        count=count, time=sample(rng, table_spec.get('time',
+                                                                     1)))
+        for key, value in params.get(type_name, {}).items():
+            behavior[key] = sample(rng, value)
+        if type_name in COIL_DEPENDENT and 'coil_address' not in behavior:
+            behavior['coil_address'] = rng.randrange(max(coils, 1))
+        if 'policy' in table_spec:
+            behavior['policy'] = table_spec['policy']
+        table_config['behavior_' + str(i + 1)] = behavior
+
+
+def substitute(value, num):
+    if isinstance(value, dict):
+        return dict((key, substitute(v, num)) for key, v in value.items())
+    if isinstance(value, str):
+        return value.replace('{n}', str(num))
+    return value
+
+
+"""
+@brief generate_plc() returns the config of PLC device num, generated from a
+spec
+"""
+
+
+def generate_plc(spec, num):
+    rng = random.Random('%s-%d' % (spec.get('seed', 0), num))
+    params = dict(DEFAULT_PARAMS)
+    for type_name, type_params in (spec.get('BEHAVIORS') or {}).items():
+        params[type_name] = dict(params.get(type_name, {}), **type_params)
+
+    datastore = {}
+    for table in ('di', 'co', 'hr', 'ir'):
+        table_spec = spec['DATASTORE'].get(table, {})
+        registers = int(sample(rng, table_spec.get('registers', 1)))
+        datastore[table] = {
+            'start_addr': table_spec.get('start_addr', 1),
+            'values': sample_values(rng, table_spec.get('values', 0),
+                                    registers)}
+    coils = len(datastore['co']['values'])
+    for table in ('hr', 'co'):
+        generate_behaviors(rng, datastore[table],
+                           spec['DATASTORE'].get(table, {}), params, coils)
+
+    logging_dict = dict(logging_level='DEBUG', file='STDOUT',
+                        format=DEFAULT_FORMAT)
+    logging_dict.update(substitute(spec.get('LOGGING', {}), num))
+    if logging_dict['format'] == 'DEFAULT':
+        logging_dict['format'] = DEFAULT_FORMAT
+    server_dict = dict(type='tcp', framer='TCP', address='0.0.0.0')
+    server_dict.update(substitute(spec.get('SERVER', {}), num))
+    server_dict['port'] = port_of(server_dict.get('port', 5020), num)
+    if 'metrics_port' in server_dict:
+        server_dict['metrics_port'] = port_of(server_dict['metrics_port'],
+                                              num)
+    plc = dict(DATASTORE=datastore, LOGGING=logging_dict, SERVER=server_dict)
+    for section in ('ENGINE', 'BACKUP', 'HISTORIAN', 'PLANT'):
+        if section in spec:
+            plc[section] = substitute(spec[section], num)
+    return plc
+
+
+"""
+@brief generate_config() streams the master config generated from a spec to
+a file and returns the number of PLC devices written
+"""
+
+
+def generate_config(spec, stream):
+    num_of_plc = int(spec['num_of_PLC'])
+    stream.write('# generated by plc_config_gen.py, seed %s\n' %
+                 spec.get('seed', 0))
+    yaml.dump({'MASTER': {'num_of_PLC': num_of_plc}}, stream, Dumper=Dumper)
+    for num in range(num_of_plc):
+        dump_plc(stream, 'PLC ' + str(num), generate_plc(spec, num))
+    return num_of_plc
+
+
+"""
+@brief dump_plc() writes one PLC device of a master config
+- yaml.dump spends most of its time on the register values, so lists of
+  numbers are written as flow sequences ([0, 1, ...]) by hand, in place of a
+  placeholder yaml.dump writes
+"""
+
+
+def dump_plc(stream, name, plc):
+    values = {}
+    for table, table_config in plc['DATASTORE'].items():
+        if all(type(value) in (int, float) for value in
+               table_config['values']):
+            placeholder = '__values_' + table + '__'
+            values[placeholder] = table_config['values']
+            table_config['values'] = placeholder
+    text = yaml.dump({name: plc}, Dumper=Dumper, default_flow_style=None,
+                     width=1 << 16)
+    for placeholder, table_values in values.items():
+        text = text.replace(placeholder, '[' + ', '.join(
+            map(repr, table_values)) + ']', 1)
+    stream.write(text)
 
 
 """
 @brief generates a master config file in YAML format
-- Determines the number of PLC devices then calls plc_setup(), 
-  which in turn calls other functions, in order to finish it up and 
+- With --spec the config is generated from the spec, without any questions
+- Otherwise determines the number of PLC devices then calls plc_setup(),
+  which in turn calls other functions, in order to finish it up and
   yaml.dump it to the config yaml file for later use
 """
 
 
 def main():
+    parser = argparse.ArgumentParser(
+        description="SCADASim 2.0 PLC config generator")
+    parser.add_argument("dump_filename", nargs='?',
+                        help="File to write the config to")
+    parser.add_argument("--spec", help="Generate the config from this spec "
+                                       "file instead of asking questions")
+    parser.add_argument("--output", help="File to write the config to")
+    parser.add_argument("--seed", help="Seed to use instead of the spec's")
+    parser.add_argument("--example_spec", action='store_true',
+                        help="Print an example spec and exit")
+    args = parser.parse_args()
+    if args.example_spec:
+        sys.stdout.write(EXAMPLE_SPEC)
+        return
+    if args.spec:
+        with open(args.spec) as spec_file:
+            spec = yaml.safe_load(spec_file)
+        if args.seed is not None:
+            spec['seed'] = args.seed
+        dump_filename = args.output or args.dump_filename
+        if dump_filename is None:
+            parser.error("--spec needs --output")
+        with open(dump_filename, 'w') as stream:
+            num_of_plc = generate_config(spec, stream)
+        print("Wrote " + str(num_of_plc) + " PLC devices to " + dump_filename)
+        return
+
     print("SCADASim 2.0 PLC config generator\n")
 
     config_dict = {'MASTER': {'num_of_PLC': 1}}
@@ -199,8 +603,8 @@ def main():
     else:
         dump_filename = output_filename
 
-    if len(sys.argv) == 2:
-        dump_filename = sys.argv[1]
+    if args.output or args.dump_filename:
+        dump_filename = args.output or args.dump_filename
     for i in range(int(num_devices)):
         print("\n\nConfiguring PLC " + str(i))
         config_dict["PLC " + str(i)] = plc_setup()
@@ -9,30 +9,30 @@ Asynchronous PyModbus Server with Client Functionality
   Used for SCADASim 2.0
 """
 
+import time
+# start of the import phase, see StartupTimer in helper.py
+IMPORT_START = time.perf_counter()
 # --------------------------------------------------------------------------- #
 # import the modbus libraries we need
+# - the server, framer and device identification are imported by
+#   start_server() for the SERVER type used
 # --------------------------------------------------------------------------- #
-from pymodbus.device import ModbusDeviceIdentification
-from pymodbus.version import version
-from pymodbus.datastore import ModbusSequentialDataBlock
 from pymodbus.datastore import ModbusSlaveContext
 from pymodbus.datastore import ModbusServerContext
-from pymodbus.transaction import ModbusRtuFramer
-from pymodbus.transaction import ModbusAsciiFramer
-from pymodbus.transaction import ModbusBinaryFramer
-from pymodbus.server.asynchronous import StartSerialServer
-from pymodbus.server.asynchronous import StartTcpServer
-from pymodbus.server.asynchronous import StartUdpServer
 # --------------------------------------------------------------------------- #
 # import the other libraries we need
 # --------------------------------------------------------------------------- #
 from datastore import *
 from helper import *
+from scheduler import ReactorScheduler
+from clock import clock_from_config
+from config_cache import load_sections, load_plc_configs, load_plc_config
+from references import register_plc, set_backup_filenames
+from datablock import (TrackedDataBlock, ArrayDataBlock, BitDataBlock,
+                       MmapDataBlock)
 from threading import Thread
 
 import sys
-import yaml
-import time
 import logging
 import argparse
 
@@ -40,10 +40,20 @@ import argparse
 @brief reads from backup, initializes the datastore, 
 starts the backup thread and the register behavior threads, 
 then starts the server
+- When shared schedulers are passed in (multi-PLC host mode), the behaviors
+  and the backup are added to them instead of schedulers of their own
+- With defer_reactor_run, the server only starts listening and the caller
+  runs the reactor once every PLC device has been set up
+- The phases of the start are timed by a StartupTimer (helper.py) and
+  logged at INFO once the server is listening
+- With num_of_PLC, behaviors of the other PLC devices of this process can
+  refer to its registers directly ('PLC N/co/5', references.py)
 """
 
 
-def run_updating_server(config_list, backup_filename, log):
+def run_updating_server(config_list, backup_filename, log, scheduler=None,
+                        backup_scheduler=None, defer_reactor_run=False,
+                        timer=None, num_of_PLC=None):
     """
     # initialize your data store
 
@@ -53,71 +63,259 @@ def run_updating_server(config_list, backup_filename, log):
     # If this is the first time this is used, the backup file will match up
     with what is laid out in the master config (due to master.py)"""
 
-    datastore_config = datastore_backup_on_start(backup_filename)
-
-    # initialize the server information for default
-    identity = ModbusDeviceIdentification()
-    identity.VendorName = 'Pymodbus'
-    identity.ProductCode = 'PM'
-    identity.VendorUrl = 'http://github.com/riptideio/pymodbus/'
-    identity.ProductName = 'Pymodbus Server'
-    identity.ModelName = 'Pymodbus Server'
-    identity.MajorMinorRevision = version.short()
+    if timer is None:
+        timer = StartupTimer('PLC device')
+    backup_config = config_list.get('BACKUP', {})
+    use_mmap = backup_config.get('format', 'yaml') == 'mmap'
+    if use_mmap:
+        datastore_config = datastore_mmap_on_start(
+            backup_filename, config_list['DATASTORE'])
+    else:
+        datastore_config = datastore_backup_on_start(backup_filename)
 
     if datastore_config == -1:
         print("Issue with backup file - either not created or empty."
               " Exiting program.")
         sys.exit()
-    
-    store = ModbusSlaveContext(
-        di=ModbusSequentialDataBlock(datastore_config['di']['start_addr'],
-                                     datastore_config['di']['values']),
-        co=ModbusSequentialDataBlock(datastore_config['co']['start_addr'],
-                                     datastore_config['co']['values']),
-        hr=ModbusSequentialDataBlock(datastore_config['hr']['start_addr'],
-                                     datastore_config['hr']['values']),
-        ir=ModbusSequentialDataBlock(datastore_config['ir']['start_addr'],
-                                     datastore_config['ir']['values']))
+    timer.phase('backup load')
+
+    if use_mmap:
+        # datastore_config is the mapped backup_N.bin file
+        store = ModbusSlaveContext(
+            di=MmapDataBlock(datastore_config, 'di'),
+            co=MmapDataBlock(datastore_config, 'co'),
+            hr=MmapDataBlock(datastore_config, 'hr'),
+            ir=MmapDataBlock(datastore_config, 'ir'))
+    elif config_list.get('ENGINE', {}).get('datablock', 'list') == 'array':
+        # packed tables - 2 bytes per register, 1 bit per coil
+        store = ModbusSlaveContext(
+            di=BitDataBlock(datastore_config['di']['start_addr'],
+                            datastore_config['di']['values']),
+            co=BitDataBlock(datastore_config['co']['start_addr'],
+                            datastore_config['co']['values']),
+            hr=ArrayDataBlock(datastore_config['hr']['start_addr'],
+                              datastore_config['hr']['values']),
+            ir=ArrayDataBlock(datastore_config['ir']['start_addr'],
+                              datastore_config['ir']['values']))
+    else:
+        store = ModbusSlaveContext(
+            di=TrackedDataBlock(datastore_config['di']['start_addr'],
+                                datastore_config['di']['values']),
+            co=TrackedDataBlock(datastore_config['co']['start_addr'],
+                                datastore_config['co']['values']),
+            hr=TrackedDataBlock(datastore_config['hr']['start_addr'],
+                                datastore_config['hr']['values']),
+            ir=TrackedDataBlock(datastore_config['ir']['start_addr'],
+                                datastore_config['ir']['values']))
+    if config_list.get('ENGINE', {}).get('locking', False):
+        # Modbus client requests take the table locks too, so they can not
+        # land in the middle of a behavior's read-modify-write
+        lock_tables(store)
     """ Could have multiple slaves, with their own addressing. 
     Since we have 1 PLC device handled by every async_plc.py, 
     it is not necessary"""
     context = ModbusServerContext(slaves=store, single=True)
+    if num_of_PLC is not None:
+        register_plc(num_of_PLC, context)
+
+    """ With SERVER 'metrics_port', request, datastore, behavior and backup
+    metrics are served over HTTP (metrics.py). Only the Modbus server gets
+    the metered server context, so behaviors are not counted as requests"""
+    server_config = config_list['SERVER']
+    metrics = None
+    server_context = context
+    if server_config.get('metrics_port') is not None:
+        from metrics import (Metrics, MeteredServerContext, meter_tables,
+                             serve_metrics)
+        metrics = Metrics({'port': server_config['port']})
+        meter_tables(store, metrics)
+        server_context = MeteredServerContext(context, metrics)
+        serve_metrics(metrics, server_config['metrics_port'],
+                      server_config.get('metrics_address', '127.0.0.1'))
+    timer.phase('datastore build')
 
     """ Setup a thread with target as datastore_backup_to_yaml to start here,
      before other threads this will continuously read from the context to 
-     write to a backup yaml file"""
-    backup_thread = Thread(target=datastore_backup_to_yaml,
-                           args=(context, backup_filename))
-    backup_thread.daemon = True
-    backup_thread.start()
+     write to a backup yaml file whenever it changes.
+     With BACKUP format 'mmap', datastore_backup_to_mmap only has to flush
+     the mapped file.
+     In multi-PLC host mode the backups share one backup scheduler thread.
+     With a HISTORIAN section the datastore is also sampled into a history
+     database (historian.py), from the same thread"""
+    # the clock of the behaviors, the history is stamped with it too
+    engine_config = config_list.get('ENGINE', {})
+    if scheduler is not None:
+        clock = scheduler.clock
+    else:
+        clock = clock_from_config(engine_config)
+    run_backup_scheduler = backup_scheduler is None
+    if run_backup_scheduler:
+        backup_scheduler = BehaviorScheduler(log)
+    if use_mmap:
+        datastore_backup_to_mmap(context, datastore_config, backup_config,
+                                 scheduler=backup_scheduler, metrics=metrics)
+    else:
+        datastore_backup_to_yaml(context, backup_filename, backup_config,
+                                 scheduler=backup_scheduler, metrics=metrics)
+    historian_config = config_list.get('HISTORIAN')
+    if historian_config is not None:
+        from historian import history_filename
+        datastore_history(context, historian_config.get(
+            'file', history_filename(backup_filename)), historian_config,
+                          scheduler=backup_scheduler, metrics=metrics,
+                          clock=clock)
+    if run_backup_scheduler:
+        backup_thread = Thread(target=backup_scheduler.run)
+        backup_thread.daemon = True
+        backup_thread.start()
  
-    """ Start register behaviors. Updating writer is started off, 
-    which will spawn a thread for every holding register based on the config"""
-    thread = Thread(target=updating_writer, args=(
-        context, config_list, time.time, log, backup_filename))
-    thread.daemon = True
-    thread.start()
-
-    # Starting the server
-    server_config = config_list['SERVER']
+    """ Start register behaviors. Updating writer is started off,
+    which will schedule a tick for every register behavior based on the config
+    and run all of them from this one thread.
+    With ENGINE scheduler set to 'reactor', the ticks are scheduled on the
+    reactor that serves requests instead, and no thread is started"""
+    if scheduler is not None:
+        updating_writer(context, config_list, time.time, log,
+                        backup_filename, scheduler=scheduler,
+                        metrics=metrics)
+    elif scheduler_kind(engine_config, log) == 'reactor':
+        updating_writer(context, config_list, time.time, log,
+                        backup_filename, scheduler=ReactorScheduler(
+                            log, clock=clock), metrics=metrics)
+    else:
+        scheduler = BehaviorScheduler(log, clock=clock)
+        updating_writer(context, config_list, time.time, log,
+                        backup_filename, scheduler=scheduler,
+                        metrics=metrics)
+        scheduler.start()
+
+    timer.phase('behavior start')
+
+    # Starting the server - the reactor is run here (unless deferred) once
+    # the startup has been reported
+    start_server(server_context, server_config, metrics)
+    timer.phase('socket bind')
+    timer.report(log)
+    if not defer_reactor_run:
+        from twisted.internet import reactor
+        reactor.run()
+
+
+"""
+@brief starts listening for the SERVER section of a PLC device, without
+running the reactor
+- Only the server and framer of the SERVER type are imported here
+- With metrics, the framer also meters the latency of every request
+"""
+
+
+def start_server(server_context, server_config, metrics=None):
     framer = configure_server_framer(server_config)
+    if metrics is not None:
+        # the framer meters the latency of the requests (metrics.py); the
+        # servers fall back to the socket framer without one
+        from metrics import metered_framer
+        if framer is None:
+            from pymodbus.transaction import ModbusSocketFramer as framer
+        framer = metered_framer(framer, metrics)
     if server_config['type'] == 'serial':
-        StartSerialServer(context, port=server_config['port'], framer=framer)
+        from pymodbus.server.asynchronous import StartSerialServer
+        StartSerialServer(server_context, port=server_config['port'],
+                          framer=framer, defer_reactor_run=True)
     elif server_config['type'] == 'udp':
-        StartUdpServer(context, identity=identity, address=(
-            server_config['address'], int(server_config['port'])))
+        from pymodbus.server.asynchronous import StartUdpServer
+        StartUdpServer(server_context, identity=server_identity(), address=(
+            server_config['address'], int(server_config['port'])),
+                       framer=framer, defer_reactor_run=True)
     elif server_config['type'] == 'tcp':
+        from pymodbus.server.asynchronous import StartTcpServer
         if server_config['framer'] == 'RTU':
-            StartTcpServer(context, identity=identity, address=(
-                server_config['address'], int(server_config['port'])),
-                           framer=framer)
+            StartTcpServer(server_context, identity=server_identity(),
+                           address=(server_config['address'],
+                                    int(server_config['port'])),
+                           framer=framer, defer_reactor_run=True)
         else:
-            StartTcpServer(context, address=(
-                server_config['address'], int(server_config['port'])))
+            StartTcpServer(server_context, address=(
+                server_config['address'], int(server_config['port'])),
+                           framer=framer, defer_reactor_run=True)
+
+
+def server_identity():
+    from pymodbus.device import ModbusDeviceIdentification
+    from pymodbus.version import version
+
+    # initialize the server information for default
+    identity = ModbusDeviceIdentification()
+    identity.VendorName = 'Pymodbus'
+    identity.ProductCode = 'PM'
+    identity.VendorUrl = 'http://github.com/riptideio/pymodbus/'
+    identity.ProductName = 'Pymodbus Server'
+    identity.ModelName = 'Pymodbus Server'
+    identity.MajorMinorRevision = version.short()
+    return identity
+
+"""
+@brief serves several PLC devices from this one process and one reactor
+- Every PLC device gets its own datastore, logger and listening socket
+  (one per SERVER block)
+- Behaviors of all PLC devices share one BehaviorScheduler thread, or the
+  reactor itself for PLC devices with ENGINE scheduler set to 'reactor'
+  (one of each per ENGINE clock_speed)
+- Backups of all PLC devices share one more BehaviorScheduler thread
+- Every PLC device reports its own startup phases; the host reports the
+  import and config load phases and the time until every PLC device is
+  listening, to the log of the first one
+"""
+
+
+def run_plc_host(master_config, plc_numbers, timer=None):
+    from twisted.internet import reactor
+
+    if timer is None:
+        timer = StartupTimer('PLC host')
+    host_log = None
+    schedulers = {}
+    backup_scheduler = BehaviorScheduler(logging.getLogger())
+    backup_scheduler.start()
+    for num_of_PLC in plc_numbers:
+        config_list = master_config["PLC " + num_of_PLC]
+        log = configure_logging(config_list['LOGGING'], "PLC " + num_of_PLC)
+        if host_log is None:
+            host_log = log
+        engine_config = config_list.get('ENGINE', {})
+        kind = (scheduler_kind(engine_config, log),
+                engine_config.get('clock_speed', 1))
+        if kind not in schedulers:
+            clock = clock_from_config(engine_config)
+            if kind[0] == 'reactor':
+                schedulers[kind] = ReactorScheduler(logging.getLogger(),
+                                                    clock=clock)
+            else:
+                schedulers[kind] = BehaviorScheduler(logging.getLogger(),
+                                                     clock=clock)
+                schedulers[kind].start()
+        run_updating_server(config_list, backup_filename_for(num_of_PLC),
+                            log, scheduler=schedulers[kind],
+                            backup_scheduler=backup_scheduler,
+                            defer_reactor_run=True,
+                            timer=StartupTimer("PLC " + num_of_PLC),
+                            num_of_PLC=num_of_PLC)
+    timer.phase('plc devices')
+    if host_log is not None:
+        timer.report(host_log)
+    reactor.run()
+
+
+def backup_filename_for(num_of_PLC):
+    return '/home/dsespitia/Scripts/python/SCADASim/backups/' \
+           'backup_' + num_of_PLC + '.yaml'
+
 
 """
 @brief parse args, handle master config, setup logging, 
 then call run_updating_server
+- With --range START-END or --all, the PLC devices are hosted together by
+  run_plc_host instead
 """
 
 
@@ -131,43 +329,57 @@ def main():
     parser.add_argument("--c",
                         "--config_filename",
                         help="Name of the master config file")
+    parser.add_argument("--range",
+                        help="Host PLC devices START-END (inclusive) "
+                             "in this one process")
+    parser.add_argument("--all",
+                        action="store_true",
+                        help="Host every PLC device of the master config "
+                             "in this one process")
     args = parser.parse_args()
-    if args.n is None or args.c is None:
-        print("Need to run async_plc.py with --n and --c arguments."
-              " Run 'python async_plc.py --h' for help")
+    if args.c is None or (args.n is None and args.range is None
+                          and not args.all):
+        print("Need to run async_plc.py with --c and one of --n, --range or"
+              " --all arguments. Run 'python async_plc.py --h' for help")
         return
     print(args)
+    if args.n is not None:
+        timer = StartupTimer("PLC " + args.n, IMPORT_START)
+    else:
+        timer = StartupTimer("PLC host " + (args.range or 'all'),
+                             IMPORT_START)
+    timer.phase('import')
     num_of_PLC = args.n
     master_config_filename = args.c
-    backup_filename = '/home/dsespitia/Scripts/python/SCADASim/backups/' \
-                      'backup_' + args.n + '.yaml'
     # --- END argparse handling ---
+    # references to PLC devices of other processes map their backup_N.bin,
+    # checked against their config
+    set_backup_filenames(backup_filename_for, lambda num: load_plc_config(
+        master_config_filename, num))
+
+    # Only load the configuration of the PLC device(s) run here, from the
+    # cache written by master.py when it matches the master config
+    if args.n is None:
+        if args.all:
+            master = load_sections(master_config_filename, ['MASTER'])
+            first, last = 0, master['MASTER']['num_of_PLC'] - 1
+        else:
+            first, last = [int(n) for n in args.range.split('-')]
+        plc_numbers = [str(n) for n in range(first, last + 1)]
+        master_config = load_plc_configs(master_config_filename, plc_numbers)
+        timer.phase('config load')
+        run_plc_host(master_config, plc_numbers, timer)
+        return
 
-    stream = open(master_config_filename, 'r')
-    config_list = yaml.safe_load(stream)
-    stream.close()
-    # Only get the current PLC's configuration dictionary
-    config_list = config_list["PLC " + num_of_PLC]
+    backup_filename = backup_filename_for(num_of_PLC)
+    config_list = load_plc_config(master_config_filename, num_of_PLC)
 
     # --- BEGIN LOGGING SETUP ---
-    FORMAT = config_list['LOGGING']['format']
-    # Add logic based on whether a file is used or stdout
-    #   AND whether a format string is used or not
-    if config_list['LOGGING']['file'] == 'STDOUT':
-        if FORMAT == 'NONE':
-            logging.basicConfig()
-        else:
-            logging.basicConfig(format=FORMAT)
-    else:
-        if FORMAT == 'NONE':
-            logging.basicConfig(filename=config_list['LOGGING']['file'])
-        else:
-            logging.basicConfig(format=FORMAT,
-                                filename=config_list['LOGGING']['file'])
-    log = logging.getLogger()
-    configure_logging_level(config_list['LOGGING']['logging_level'], log)
+    log = configure_logging(config_list['LOGGING'])
     # --- END LOGGING SETUP ---
-    run_updating_server(config_list, backup_filename, log)
+    timer.phase('config load')
+    run_updating_server(config_list, backup_filename, log, timer=timer,
+                        num_of_PLC=num_of_PLC)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+
+"""
+Backup writers for the datastore of a PLC device.
+
+- Runs as a tick on a BehaviorScheduler every 'interval' seconds (BACKUP
+  section of the PLC config, defaults to 1 second)
+- Only writes when a datablock reports a dirty range, and only copies the
+  dirty values into the backup it keeps in memory
+- While behaviors keep changing values, the backup is written on every
+  tick, so it is at most 'interval' seconds behind
+- Coalesces bursts: ticks run closer together than half an 'interval' (the
+  scheduler catching up after a stall) only write once the burst is over,
+  but never more than 'max_delay' seconds after the first change held back
+- Coils and discrete inputs are written as 0/1, whatever the datablock
+- Writes atomically (temp file + rename), so a crash never leaves a half
+  written backup file behind for datastore_backup_on_start to reject
+"""
+import os
+import yaml
+from time import time
+
+# table name in the backup file -> key of the datablock in the slave context
+TABLES = (('co', 'c'), ('di', 'd'), ('hr', 'h'), ('ir', 'i'))
+# tables of bits, kept as 0/1 in the backup file
+BIT_TABLES = ('co', 'di')
+
+
+class BackupWriter(object):
+
+    def __init__(self, context, my_backup, interval=1, max_delay=5):
+        self.context = context
+        self.my_backup = my_backup
+        self.interval = interval
+        self.max_delay = max_delay
+        with open(my_backup, 'r') as backup:
+            self.backup_file = yaml.safe_load(backup)
+        # time of the first change not written yet, None if nothing changed
+        self.pending_since = None
+        self.last_write = None
+        # stats of the writes done, for metrics.py
+        self.writes = 0
+        self.write_seconds = 0.0
+        self.bytes_written = 0
+
+    """
+    - @brief collect() copies the dirty ranges of every datablock into the
+      in-memory backup and returns True if anything changed
+    - Datablocks that do not track dirty ranges are always copied in full
+    """
+
+    def collect(self):
+        changed = False
+        store = self.context[0].store
+        for table, key in TABLES:
+            block = store[key]
+            values = self.backup_file['DATASTORE'][table]['values']
+            if hasattr(block, 'take_dirty'):
+                dirty = block.take_dirty()
+                if dirty is None:
+                    continue
+                first, last = dirty
+            else:
+                first, last = block.address, block.address + len(values)
+            start = first - block.address
+            changed_values = block.getValues(first, last - first)
+            if table in BIT_TABLES:
+                # BitDataBlock returns bools, the backup keeps 0/1
+                changed_values = [1 if value else 0
+                                  for value in changed_values]
+            values[start:start + last - first] = changed_values
+            changed = True
+        return changed
+
+    def tick(self):
+        now = time()
+        changed = self.collect()
+        if changed and self.pending_since is None:
+            self.pending_since = now
+        if self.pending_since is None:
+            return
+        # hold the write back during a burst of ticks
+        burst = self.last_write is not None and \
+            now - self.last_write < self.interval / 2.0
+        if burst and now - self.pending_since < self.max_delay:
+            return
+        self.write()
+        self.pending_since = None
+        self.last_write = now
+
+    def write(self):
+        start = time()
+        tmp_backup = self.my_backup + '.tmp'
+        with open(tmp_backup, 'w') as yaml_file:
+            yaml.dump(self.backup_file, yaml_file, default_flow_style=False)
+            yaml_file.flush()
+            os.fsync(yaml_file.fileno())
+            size = yaml_file.tell()
+        os.replace(tmp_backup, self.my_backup)
+        self.writes += 1
+        self.write_seconds += time() - start
+        self.bytes_written += size
+
+    def schedule(self, scheduler):
+        scheduler.add(self.tick, self.interval, name='backup ' +
+                      os.path.basename(self.my_backup))
+
+
+"""
+MmapBackupWriter is used instead of BackupWriter with BACKUP 'format: mmap'
+- The mapped file already holds the live values, so a backup is only an
+  msync of the file, done when a datablock reports a dirty range
+"""
+
+
+class MmapBackupWriter(object):
+
+    def __init__(self, context, mmap_file, interval=1):
+        self.context = context
+        self.mmap_file = mmap_file
+        self.interval = interval
+        self.writes = 0
+        self.write_seconds = 0.0
+        self.bytes_written = 0
+
+    def tick(self):
+        store = self.context[0].store
+        # take every dirty range, so none is left over for the next tick
+        dirty = [store[key].take_dirty() for table, key in TABLES]
+        if any(d is not None for d in dirty):
+            start = time()
+            self.mmap_file.flush()
+            self.writes += 1
+            self.write_seconds += time() - start
+            # the whole mapping is synced
+            self.bytes_written += len(self.mmap_file.mmap)
+
+    def schedule(self, scheduler):
+        scheduler.add(self.tick, self.interval, name='backup ' +
+                      os.path.basename(self.mmap_file.filename))
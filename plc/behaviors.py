@@ -0,0 +1,537 @@
+#!/usr/bin/env python
+
+"""
+Register behaviors and the registry used to look them up.
+
+- Every behavior type is a class registered with @register_behavior for the
+  table it controls ('hr' or 'co') and its 'type' name in the master config
+- A behavior declares its config parameters once, in 'params', as
+  (name, type, prompt) tuples; the parameters and any state are __slots__,
+  so per-tick work only touches prebound attributes
+- compile_behaviors() turns the DATASTORE section of a PLC config into
+  behavior instances up front, and updating_writer schedules their tick()
+- tick() does one update of the slave context and returns the number of
+  seconds until the next tick, or None to tick again after 'time' seconds
+- Third parties can add behaviors without touching helper.py: register them
+  in a module listed in ENGINE 'plugins', which is imported on start:
+
+    from behaviors import Behavior, register_behavior
+
+    @register_behavior('hr', 'sawtooth')
+    class Sawtooth(Behavior):
+        params = (('max', int, "Max value of the register(s)"),)
+        __slots__ = tuple(param[0] for param in params)
+
+        def tick(self):
+            ...
+"""
+import importlib
+from functools import partial
+from random import randint
+from datastore import *
+from scheduler import POLICIES
+from references import REFERENCE, RemoteRegister, parse_reference
+
+# (table, type name) -> behavior class
+BEHAVIORS = {}
+
+
+def register_behavior(table, type_name):
+    def register(behavior_class):
+        behavior_class.table = table
+        behavior_class.type_name = type_name
+        BEHAVIORS[(table, type_name)] = behavior_class
+        return behavior_class
+    return register
+
+
+def load_plugins(module_names):
+    for module_name in module_names:
+        importlib.import_module(module_name)
+
+
+"""
+- @brief compile_behaviors() returns the behavior instances for the 'hr' and
+  'co' tables of a PLC config, in config order
+- behavior_N entries with no registered type (e.g. 'none') are skipped
+"""
+
+
+def compile_behaviors(config_list, context, log):
+    behaviors = []
+    for table in ('hr', 'co'):
+        table_config = config_list['DATASTORE'][table]
+        for i in range(len(table_config['values'])):
+            name = 'behavior_' + str(i + 1)
+            behavior_config = table_config.get(name, {'type': 'none'})
+            behavior_class = BEHAVIORS.get((table, behavior_config['type']))
+            if behavior_class is None:
+                # invalid type name or no behavior
+                continue
+            behaviors.append(behavior_class(table + ' ' + name,
+                                            behavior_config, context, log))
+    return behaviors
+
+
+"""
+- @brief check_behaviors() raises ValueError for the first behavior_N entry
+  of a PLC config with an unknown type or policy, or a missing parameter
+"""
+
+
+def check_behaviors(config_list):
+    for table in ('hr', 'co'):
+        table_config = config_list['DATASTORE'][table]
+        for i in range(len(table_config['values'])):
+            name = table + ' behavior_' + str(i + 1)
+            behavior_config = table_config.get(name.split()[1],
+                                               {'type': 'none'})
+            type_name = behavior_config.get('type')
+            if type_name == 'none':
+                continue
+            behavior_class = BEHAVIORS.get((table, type_name))
+            if behavior_class is None:
+                raise ValueError("%s has unknown type '%s'" % (name,
+                                                               type_name))
+            for key in ('time', 'address', 'count') + tuple(
+                    param[0] for param in behavior_class.params):
+                if key not in behavior_config:
+                    raise ValueError("%s (%s) has no '%s'" % (
+                        name, type_name, key))
+            if behavior_config.get('policy', 'skip') not in POLICIES:
+                raise ValueError("%s has unknown policy '%s'" % (
+                    name, behavior_config['policy']))
+            for param in behavior_class.params:
+                value = behavior_config[param[0]]
+                if param[0] in behavior_class.references:
+                    try:
+                        parse_reference(value)
+                    except ValueError as error:
+                        raise ValueError("%s %s" % (name, error))
+                elif isinstance(value, str) and \
+                        REFERENCE.match(value.strip()):
+                    # other strings (e.g. a replay 'file') are plain values
+                    raise ValueError("%s (%s) can not take a reference for "
+                                     "'%s'" % (name, type_name, param[0]))
+
+
+"""
+- @brief behavior_references() returns (behavior name, parameter, reference)
+  for the parameters of a PLC config that refer to another PLC device
+  (references.py)
+"""
+
+
+def behavior_references(config_list):
+    references = []
+    for table in ('hr', 'co'):
+        table_config = config_list['DATASTORE'][table]
+        for i in range(len(table_config['values'])):
+            name = 'behavior_' + str(i + 1)
+            behavior_config = table_config.get(name, {'type': 'none'})
+            behavior_class = BEHAVIORS.get((table, behavior_config['type']))
+            if behavior_class is None:
+                continue
+            for param in behavior_class.references:
+                reference = parse_reference(behavior_config[param])
+                if reference is not None:
+                    references.append((table + ' ' + name, param, reference))
+    return references
+
+
+"""
+Behavior is the base class of every behavior
+- 'time', 'address' and 'count' are read for every behavior, 'params' are the
+  extra parameters of the behavior type
+- The optional 'policy' is what the scheduler does when the behavior falls
+  behind its schedule, 'skip' (default) or 'catch_up' (see scheduler.py)
+- 'references' are the params that can refer to a register of another PLC
+  device instead ('PLC N/table/address', see references.py)
+"""
+
+
+class Behavior(object):
+
+    params = ()
+    references = ()
+    __slots__ = ('name', 'period', 'policy', 'address', 'count', 'slave_id',
+                 'context', 'log')
+
+    def __init__(self, name, config, context, log):
+        self.name = name
+        self.period = config['time']
+        self.policy = config.get('policy', 'skip')
+        self.address = int(config['address'])
+        self.count = config['count']
+        self.slave_id = 0x00
+        # the slave context, as the datastore functions use context[0]
+        self.context = context[0]
+        # a logger per behavior, for the LOGGING rate limits (log_queue.py)
+        self.log = log.getChild(name)
+        for param in self.params:
+            setattr(self, param[0], config[param[0]])
+
+    """
+    - @brief first_delay() is the number of seconds before the first tick
+    """
+
+    def first_delay(self):
+        return self.period
+
+    def tick(self):
+        raise NotImplementedError
+
+
+"""
+linear will update registers/coils in a linear function
+"""
+
+
+@register_behavior('hr', 'linear')
+class Linear(Behavior):
+
+    params = (('variance', int, "Variance of linear function"),)
+    __slots__ = tuple(param[0] for param in params)
+
+    def add_variance(self, values):
+        variance = self.variance
+        return [v + variance for v in values]
+
+    def tick(self):
+        values = update_hr_register(self.context, self.slave_id, self.address,
+                                    self.count, self.add_variance)
+        self.log.debug(values)
+
+
+"""
+linear_coil_dependent will update registers/coils in a linear function
+until it reaches the max value specified
+- Currently will not decrement if it will fall below 0
+- Also will not increment if it goes past max
+- If the coil matches what the default_coil_value is, it will continue to add
+  variance to the holding register normally
+- Otherwise, it will negate the variance and add it to the holding register
+- The holding register will be checked every 'time' seconds
+- coil_address can be a coil of another PLC device, 'PLC N/co/address'
+  (or a register, set when it is not 0); until it can be read the coil
+  counts as default
+"""
+
+
+@register_behavior('hr', 'linear_coil_dependent')
+class LinearCoilDependent(Behavior):
+
+    params = (('variance', int, "Variance of linear function"),
+              ('max', int, "Max value of the register(s)"),
+              ('coil_address', int, "Address of the coil it is dependent on"),
+              ('default_coil_value', int, "Default coil value - default "
+                                          "state that would mean normal "
+                                          "behavior"))
+    references = ('coil_address',)
+    __slots__ = tuple(param[0] for param in params) + ('remote',)
+
+    def __init__(self, name, config, context, log):
+        Behavior.__init__(self, name, config, context, log)
+        self.remote = None
+        if parse_reference(self.coil_address) is not None:
+            self.remote = RemoteRegister(self.coil_address, self.log)
+
+    def coil_is_default(self):
+        if self.remote is not None:
+            coil_reg = self.remote.read()
+            if coil_reg is None:
+                return True
+            # a register of another PLC device is set when it is not 0
+            coil_reg = 1 if coil_reg else 0
+        else:
+            coil_reg = read_co_register(self.context, self.slave_id,
+                                        self.coil_address, 1)
+            # the datastore helper functions return a list,
+            # even if it is just one register being read
+            coil_reg = coil_reg[0]
+        # check the state of the coil
+        if coil_reg == "false" or int(coil_reg) == 0:
+            coil_val = 0
+        elif coil_reg == "true" or int(coil_reg) == 1:
+            coil_val = 1
+        # compare the current state of the coil to the default coil value
+        return coil_val == int(self.default_coil_value)
+
+    def increase(self, values):
+        # check to see if exceeded max value
+        if values[0] >= self.max:
+            values[0] = self.max
+        else:
+            values[0] = values[0] + self.variance
+        return values
+
+    def decrease(self, values):
+        # only write if every register is still above 0
+        for v in values:
+            if v <= 0:
+                return None
+        variance = self.variance
+        return [v + (variance * -1) for v in values]
+
+    def tick(self):
+        if self.coil_is_default():
+            update = self.increase
+        else:
+            # not default coil value - negate variance and add it to
+            # holding register in order to do opposite behavior
+            update = self.decrease
+        values = update_hr_register(self.context, self.slave_id, self.address,
+                                    self.count, update)
+        self.log.debug(values)
+
+
+"""
+random will update the registers/coils randomly
+- Will only generate random values between 'min' and 'max'
+"""
+
+
+@register_behavior('hr', 'random')
+class RandomNum(Behavior):
+
+    params = (('min', int, "Minimum value the register can hold"),
+              ('max', int, "Maximum value the register can hold"))
+    __slots__ = tuple(param[0] for param in params)
+
+    def randomize(self, values):
+        variance = randint(self.min, self.max)
+        return [(v * 0) + variance for v in values]
+
+    def tick(self):
+        values = update_hr_register(self.context, self.slave_id, self.address,
+                                    self.count, self.randomize)
+        self.log.debug(values)
+
+
+"""
+random_coil_dependent will update registers/coils in a linear function until
+ it reaches the max value specified, then it will begin random data variance
+"""
+
+
+@register_behavior('hr', 'random_coil_dependent')
+class RandomCoilDependent(LinearCoilDependent):
+
+    params = LinearCoilDependent.params + (
+        ('rand_min', int, "Minimum random value once max is reached"),
+        ('rand_max', int, "Maximum random value once max is reached"))
+    __slots__ = ('rand_min', 'rand_max', 'at_max')
+
+    def __init__(self, name, config, context, log):
+        LinearCoilDependent.__init__(self, name, config, context, log)
+        # false until max is reached
+        self.at_max = False
+
+    def increase(self, values):
+        # checking to see if max value was reached to begin
+        # random data variance
+        if values[0] >= self.max:
+            self.at_max = True
+        # if at max select random int
+        if self.at_max:
+            values[0] = randint(self.rand_min, self.rand_max)
+        # check to see if exceeded max
+        elif values[0] >= self.max:
+            values[0] = self.max
+        else:
+            values[0] = values[0] + self.variance
+        return values
+
+    def decrease(self, values):
+        if values[0] >= self.max:
+            self.at_max = True
+        # only write if every register is still above 0
+        for v in values:
+            if v <= 0:
+                return None
+        # no longer at max value, do not do random variance
+        self.at_max = False
+        variance = self.variance
+        values = [v + (variance * -1) for v in values]
+        if values[0] < 0:
+            values[0] = 0
+        return values
+
+
+"""
+constant will update the registers/coils with a constant value
+- Will generate constant value to coil register
+"""
+
+
+@register_behavior('co', 'constant')
+class ConstantNum(Behavior):
+
+    params = (('num', int, "Value that the coil register should try to stay "
+                           "constant at"),)
+    __slots__ = tuple(param[0] for param in params)
+
+    def set_constant(self, values):
+        variance = self.num
+        return [(v * 0) + variance for v in values]
+
+    def tick(self):
+        values = update_co_register(self.context, self.slave_id, self.address,
+                                    self.count, self.set_constant)
+        self.log.debug(values)
+
+
+"""
+fuel_tank_behavior decrements the tank by 25% about every 15 min and
+refills it to 100% about every hour
+- Written as a generator that yields how many seconds to wait before the
+  next step; tick() runs the generator up to its next yield
+"""
+
+
+@register_behavior('hr', 'fuel_tank_behavior')
+class FuelTank(Behavior):
+
+    params = (('min', int, "Minimum level of the tank"),
+              ('max', int, "Maximum level of the tank"),
+              ('coil_address', int, "Address of the coil of the tank valve"))
+    __slots__ = ('min', 'max', 'coil_address', 'tick')
+
+    def __init__(self, name, config, context, log):
+        Behavior.__init__(self, name, config, context, log)
+        self.log.debug("Behavior started for fuel_tank_behavior")
+        self.tick = partial(next, self.cycle())
+
+    def drain(self, values):
+        for v in values:
+            if v > self.min:
+                values = [(v - 1) for v in values]
+        return values
+
+    def refill(self, values):
+        for v in values:
+            if v < self.max:
+                values = [(v + 1) for v in values]
+        return values
+
+    def set_coil(self, value):
+        coil_values = read_co_register(self.context, self.slave_id,
+                                       self.coil_address, 1)
+        coil_values = [value for v in coil_values]
+        write_co_register(self.context, self.slave_id, self.address,
+                          coil_values)
+
+    def cycle(self):
+        context, slave_id = self.context, self.slave_id
+        address, count, log = self.address, self.count, self.log
+        while True:
+            for i in range(0, 2):
+                # decrement behavior - decrement tank by 25% about every 15 min
+                # open coil
+                self.set_coil(1)
+                for j in range(0, 25):
+                    # take 25 seconds to decrement fuel tank level by 25%
+                    values = update_hr_register(context, slave_id, address,
+                                                count, self.drain)
+                    log.debug(values)
+                    yield 1
+
+                # close coil
+                self.set_coil(0)
+
+                sleep_val = 875
+                # sleep for about 15 minutes, depending on whether we
+                # decremented or also incremented
+                yield sleep_val
+                # increment behavior - refill tank to 100% about every hour
+                if i == 1:
+                    # open coil
+                    log.debug("Increment behavior entered\n")
+                    self.set_coil(1)
+
+                    for k in range(0, 100):
+                        # take 100 seconds to refill fuel tank back to 100
+                        values = update_hr_register(context, slave_id,
+                                                    address, count,
+                                                    self.refill)
+                        log.debug(values)
+                        yield 1
+
+                    # close coil
+                    self.set_coil(0)
+
+            yield 900
+
+
+"""
+replay writes the register/coil values of a trace file (trace_file.py) at
+the times they were recorded
+- Registers address ... address + count - 1 get the trace columns of the
+  same table from 'source' (defaults to 'address') on, or of the table set
+  by 'source_table'
+- 'speed' replays the trace faster (2 is twice as fast) on top of the ENGINE
+  clock_speed; 'loop: true' starts over at the end of the trace, otherwise
+  the last values are kept
+- Rows closer together than 'time' seconds are not all written, every tick
+  writes the latest row that is due
+- The trace is read one chunk at a time, never loaded whole
+"""
+
+
+@register_behavior('hr', 'replay')
+class Replay(Behavior):
+
+    params = (('file', str, "Trace file to replay"),)
+    __slots__ = ('file', 'speed', 'loop', 'tick')
+
+    def __init__(self, name, config, context, log):
+        from trace_file import TraceReader
+        Behavior.__init__(self, name, config, context, log)
+        self.speed = float(config.get('speed', 1))
+        self.loop = config.get('loop', False)
+        reader = TraceReader(self.file)
+        source = int(config.get('source', self.address))
+        source_table = config.get('source_table', self.table)
+        columns = [reader.column_index(source_table, source + i)
+                   for i in range(self.count)]
+        self.tick = partial(next, self.replay(reader, columns))
+
+    def first_delay(self):
+        # the first row is written on start
+        return 0
+
+    def replay(self, reader, columns):
+        write = write_co_register if self.table == 'co' else \
+            write_hr_register
+        context, slave_id, address = self.context, self.slave_id, self.address
+        log, period, speed = self.log, self.period, self.speed
+        while True:
+            trace_time = None
+            pending = None
+            for row_time, values in reader.iter_rows(columns):
+                if trace_time is None:
+                    trace_time = row_time
+                if row_time > trace_time:
+                    if pending is not None:
+                        write(context, slave_id, address, pending)
+                        log.debug(pending)
+                        pending = None
+                    delay = max((row_time - trace_time) / speed, period)
+                    trace_time += delay * speed
+                    yield delay
+                pending = values
+            if pending is not None:
+                write(context, slave_id, address, pending)
+                log.debug(pending)
+            if not self.loop:
+                break
+            yield period
+        while True:
+            # end of the trace, the last values stay
+            yield None
+
+
+@register_behavior('co', 'replay')
+class ReplayCoils(Replay):
+
+    __slots__ = ()
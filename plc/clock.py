@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+"""
+Simulation clocks used by the schedulers that run the register behaviors.
+
+- Behaviors never sleep: a tick returns how many simulated seconds until it
+  wants to run again, and the scheduler waits for that deadline on its clock
+- SimClock runs simulated time 'speed' times as fast as wall time, so with
+  ENGINE 'clock_speed: 60' an hour of plant behavior runs in a minute
+- DiscreteClock is the "as fast as possible" mode ('clock_speed: max'):
+  nothing waits, the clock jumps straight to the next deadline
+- Simulated time starts at the wall time the clock is created, so times
+  taken from a simulation still look like real ones, but it moves with the
+  monotonic clock, so changes to the system time do not move deadlines
+"""
+from time import time, monotonic
+
+
+class SimClock(object):
+
+    discrete = False
+
+    def __init__(self, speed=1.0, start=None):
+        if speed <= 0:
+            raise ValueError("clock speed has to be greater than 0")
+        self.speed = float(speed)
+        self.monotonic_start = monotonic()
+        self.start = time() if start is None else start
+
+    def now(self):
+        return self.start + (monotonic() - self.monotonic_start) * self.speed
+
+    """
+    - @brief wall_seconds() turns simulated seconds into wall seconds to wait
+    """
+
+    def wall_seconds(self, seconds):
+        return seconds / self.speed
+
+    def advance(self, deadline):
+        # simulated time follows wall time, nothing to do
+        return None
+
+
+class DiscreteClock(object):
+
+    discrete = True
+    speed = float('inf')
+
+    def __init__(self, start=None):
+        self._now = time() if start is None else start
+
+    def now(self):
+        return self._now
+
+    def wall_seconds(self, seconds):
+        return 0
+
+    """
+    - @brief advance() moves simulated time to the deadline being run
+    """
+
+    def advance(self, deadline):
+        if deadline > self._now:
+            self._now = deadline
+
+
+"""
+- @brief clock_from_config() returns the clock for the ENGINE section of a
+  PLC config: 'clock_speed' is a speed-up factor (default 1, real time) or
+  'max' for the discrete "as fast as possible" mode
+"""
+
+
+def clock_from_config(engine_config):
+    speed = engine_config.get('clock_speed', 1)
+    if speed == 'max':
+        return DiscreteClock()
+    return SimClock(float(speed))
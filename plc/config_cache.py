@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+
+"""
+Compiled cache of the master config, so PLC devices do not parse all of it.
+
+- master.py calls compile_config() once on start: the master config is
+  parsed (with libyaml's CSafeLoader when PyYAML has it), validated, and
+  every section ('MASTER', 'PLC 0', ...) is written to a pickle file of its
+  own
+- The files are kept in a directory named after the SHA-256 of the master
+  config, so an edited config is never served from a stale cache; caches of
+  older versions of the config are removed
+- async_plc.py loads only the sections it runs with load_plc_configs(),
+  which parses the YAML instead when there is no cache for the current
+  contents of the config
+- PLC devices of PLC_GROUPS (templates.py) are expanded when they are
+  loaded, one by one
+- The cache sits next to the config: <dir>/.<config name>.cache/
+"""
+import os
+import pickle
+import shutil
+import hashlib
+import yaml
+from templates import get_plc_config, parse_plcs
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+CACHE_VERSION = 1
+TABLES = ('di', 'co', 'hr', 'ir')
+
+
+def load_yaml(stream):
+    return yaml.load(stream, Loader=SafeLoader)
+
+
+def read_config(config_filename):
+    with open(config_filename, 'rb') as config_file:
+        data = config_file.read()
+    return data, hashlib.sha256(data).hexdigest()
+
+
+def cache_dir_for(config_filename):
+    directory, name = os.path.split(os.path.abspath(config_filename))
+    return os.path.join(directory, '.' + name + '.cache')
+
+
+def cache_path(cache_dir, digest):
+    return os.path.join(cache_dir, 'v%d-%s' % (CACHE_VERSION, digest))
+
+
+def section_filename(name):
+    return name.replace(' ', '_') + '.pickle'
+
+
+"""
+- @brief validate_config() raises ValueError for the first problem found in
+  a master config: missing sections, tables or SERVER keys, behaviors
+  of unknown types or with missing parameters, and PLANT sections (plant.py)
+  that do not fit the datastore
+"""
+
+
+def validate_config(config):
+    from behaviors import load_plugins, check_behaviors, behavior_references
+
+    if not isinstance(config, dict) or 'MASTER' not in config:
+        raise ValueError("master config has no MASTER section")
+    for group in config.get('PLC_GROUPS') or []:
+        if group.get('template') not in (config.get('TEMPLATES') or {}):
+            raise ValueError("PLC_GROUPS entry " + str(group.get('plcs')) +
+                             " has no template '" +
+                             str(group.get('template')) + "'")
+        parse_plcs(group['plcs'])
+    for i in range(int(config['MASTER']['num_of_PLC'])):
+        name = 'PLC ' + str(i)
+        try:
+            config_list = get_plc_config(config, i)
+        except KeyError:
+            raise ValueError(name + " is missing from the master config")
+        except (IndexError, TypeError) as error:
+            raise ValueError(name + " could not be expanded from its "
+                             "template: " + str(error))
+        for section in ('DATASTORE', 'LOGGING', 'SERVER'):
+            if section not in config_list:
+                raise ValueError(name + " has no " + section + " section")
+        for table in TABLES:
+            if 'values' not in config_list['DATASTORE'].get(table, {}):
+                raise ValueError(name + " DATASTORE has no " + table +
+                                 " values")
+        for key in ('type', 'port'):
+            if key not in config_list['SERVER']:
+                raise ValueError(name + " SERVER has no '" + key + "'")
+        load_plugins(config_list.get('ENGINE', {}).get('plugins', []))
+        try:
+            check_behaviors(config_list)
+        except ValueError as error:
+            raise ValueError(name + " " + str(error))
+        references = behavior_references(config_list)
+        if config_list.get('PLANT') is not None:
+            from plant import check_plant
+            try:
+                references += check_plant(config_list['PLANT'], config_list)
+            except (ValueError, KeyError, TypeError) as error:
+                raise ValueError(name + " " + str(error))
+        for behavior, param, reference in references:
+            check_reference(config, name + " " + behavior, param, reference,
+                            i)
+
+
+"""
+- @brief check_reference() raises ValueError if a reference to a register
+  of another PLC device (references.py) is not in the master config
+- The PLC device referred to needs BACKUP 'format: mmap' to be read from
+  another process, unless MASTER has 'host_mode: true' (every PLC device is
+  hosted by one process: async_plc.py --all, or supervisor.py with one
+  worker) or it refers to referring_PLC itself
+"""
+
+
+def check_reference(config, name, param, reference, referring_PLC=None):
+    num_of_PLC, table, address = reference
+    if not 0 <= num_of_PLC < int(config['MASTER']['num_of_PLC']):
+        raise ValueError("%s '%s' refers to PLC %d, which is not in the "
+                         "master config" % (name, param, num_of_PLC))
+    plc_config = get_plc_config(config, num_of_PLC)
+    in_process = num_of_PLC == referring_PLC or \
+        config['MASTER'].get('host_mode', False)
+    if not in_process and plc_config.get(
+            'BACKUP', {}).get('format', 'yaml') != 'mmap':
+        raise ValueError("%s '%s' refers to PLC %d, which has no BACKUP "
+                         "'format: mmap' to be read from another process; "
+                         "give it one, or set MASTER 'host_mode: true' to "
+                         "host every PLC device in one process"
+                         % (name, param, num_of_PLC))
+    table_config = plc_config['DATASTORE'][table]
+    # addresses are 0 based, like the slave contexts
+    index = address + 1 - table_config.get('start_addr', 1)
+    if not 0 <= index < len(table_config['values']):
+        raise ValueError("%s '%s' refers to %s address %d of PLC %d, which "
+                         "has %d" % (name, param, table, address, num_of_PLC,
+                                     len(table_config['values'])))
+
+
+"""
+- @brief compile_config() validates the master config and writes its cache,
+  then returns the parsed config
+"""
+
+
+def compile_config(config_filename, cache_dir=None):
+    data, digest = read_config(config_filename)
+    config = load_yaml(data)
+    validate_config(config)
+
+    if cache_dir is None:
+        cache_dir = cache_dir_for(config_filename)
+    target = cache_path(cache_dir, digest)
+    if not os.path.isdir(target):
+        tmp_target = target + '.tmp' + str(os.getpid())
+        os.makedirs(tmp_target)
+        for name, section in config.items():
+            with open(os.path.join(tmp_target, section_filename(name)),
+                      'wb') as section_file:
+                pickle.dump(section, section_file, pickle.HIGHEST_PROTOCOL)
+        try:
+            os.rename(tmp_target, target)
+        except OSError:
+            # compiled at the same time by another process
+            shutil.rmtree(tmp_target, ignore_errors=True)
+
+    # caches of older versions of the config
+    for entry in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, entry)
+        if path != target and '.tmp' not in entry:
+            shutil.rmtree(path, ignore_errors=True)
+    return config
+
+
+"""
+- @brief load_sections() returns {name: section} for the sections of the
+  master config asked for, from the cache if it matches the config
+- Sections that are not in the master config are left out
+"""
+
+
+def load_sections(config_filename, names, cache_dir=None):
+    data, digest = read_config(config_filename)
+    if cache_dir is None:
+        cache_dir = cache_dir_for(config_filename)
+    target = cache_path(cache_dir, digest)
+    if not os.path.isdir(target):
+        # no cache for this config - parse it
+        config = load_yaml(data)
+        return dict((name, config[name]) for name in names if name in config)
+    sections = {}
+    for name in names:
+        try:
+            with open(os.path.join(target, section_filename(name)),
+                      'rb') as section_file:
+                sections[name] = pickle.load(section_file)
+        except (IOError, OSError):
+            # not in the master config
+            continue
+    return sections
+
+
+"""
+- @brief load_plc_configs() returns {'PLC N': config} for the PLC numbers
+  asked for, written out in full or expanded from PLC_GROUPS
+"""
+
+
+def load_plc_configs(config_filename, plc_numbers, cache_dir=None):
+    names = ['PLC ' + str(num) for num in plc_numbers]
+    sections = load_sections(config_filename,
+                             names + ['TEMPLATES', 'PLC_GROUPS'], cache_dir)
+    return dict(('PLC ' + str(num), get_plc_config(sections, num))
+                 for num in plc_numbers)
+
+
+def load_plc_config(config_filename, num_of_PLC, cache_dir=None):
+    return load_plc_configs(config_filename, [num_of_PLC],
+                            cache_dir)['PLC ' + str(num_of_PLC)]
@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+
+"""
+Datablocks used for the di/co/hr/ir tables of a PLC device.
+
+- All of them remember the range of addresses changed since the last time
+  it was checked, whether the change came from a register behavior or from
+  a Modbus client
+- The backup writer uses the dirty range to skip backups when nothing
+  changed and to only copy the changed values
+- TrackedDataBlock keeps its values in a list, like ModbusSequentialDataBlock
+- ArrayDataBlock (registers) and BitDataBlock (coils/discrete inputs) keep
+  their values packed, and hand out zero-copy views of them with view()
+- MmapDataBlock keeps its values in a file mapped with mmap (mmap_store.py),
+  so every write is persisted without any serialization
+- LockedDataBlock wraps any of them with a lock for atomic updates, and
+  MeteredDataBlock with read/write counters
+"""
+from array import array
+from threading import Lock, RLock
+from pymodbus.datastore.store import BaseModbusDataBlock
+from pymodbus.datastore import ModbusSequentialDataBlock
+
+
+class DirtyTracking(object):
+
+    def __init__(self):
+        # (first, last + 1) addresses changed since take_dirty(), or None
+        self.dirty = None
+        self._dirty_lock = Lock()
+
+    def mark_dirty(self, address, count):
+        with self._dirty_lock:
+            dirty = self.dirty
+            if dirty is None:
+                self.dirty = (address, address + count)
+            else:
+                self.dirty = (min(dirty[0], address),
+                              max(dirty[1], address + count))
+
+    """
+    - @brief take_dirty() returns the dirty range and resets it
+    """
+
+    def take_dirty(self):
+        with self._dirty_lock:
+            dirty, self.dirty = self.dirty, None
+        return dirty
+
+
+class TrackedDataBlock(DirtyTracking, ModbusSequentialDataBlock):
+
+    def __init__(self, address, values):
+        ModbusSequentialDataBlock.__init__(self, address, values)
+        DirtyTracking.__init__(self)
+
+    def setValues(self, address, values):
+        if not isinstance(values, list):
+            values = [values]
+        start = address - self.address
+        # writing the values that are already there is not a change
+        if self.values[start:start + len(values)] == values:
+            return
+        self.values[start:start + len(values)] = values
+        self.mark_dirty(address, len(values))
+
+
+"""
+RegisterDataBlock keeps its values in a buffer of 16 bit values
+- self.values is a memoryview, so view() hands out slices without copying
+- setValues() takes a list, or an array('H')/memoryview for bulk writes
+  without any per value conversion
+- Values are 16 bit, so values written outside of 0-65535 are clamped
+"""
+
+
+class RegisterDataBlock(DirtyTracking, BaseModbusDataBlock):
+
+    def __init__(self, address, values):
+        DirtyTracking.__init__(self)
+        self.address = address
+        self.values = values
+        self.default_value = 0
+
+    def reset(self):
+        self.values[:] = array('H', [self.default_value] * len(self.values))
+        self.mark_dirty(self.address, len(self.values))
+
+    def validate(self, address, count=1):
+        result = (self.address <= address)
+        result &= ((self.address + len(self.values)) >= (address + count))
+        return result
+
+    def getValues(self, address, count=1):
+        start = address - self.address
+        return self.values[start:start + count].tolist()
+
+    """
+    - @brief view() returns the values as a memoryview, without copying
+    """
+
+    def view(self, address, count=1):
+        start = address - self.address
+        return self.values[start:start + count]
+
+    def setValues(self, address, values):
+        if not isinstance(values, (array, memoryview)):
+            if not isinstance(values, list):
+                values = [values]
+            values = array('H', [min(max(int(v), 0), 0xFFFF)
+                                 for v in values])
+        start = address - self.address
+        current = self.values[start:start + len(values)]
+        # writing the values that are already there is not a change
+        if current == values:
+            return
+        current[:] = values
+        self.mark_dirty(address, len(values))
+
+
+"""
+ArrayDataBlock is a RegisterDataBlock backed by an array('H'), about 2 bytes
+per register instead of a list of int objects
+"""
+
+
+class ArrayDataBlock(RegisterDataBlock):
+
+    def __init__(self, address, values):
+        self.array = array('H', [min(max(int(v), 0), 0xFFFF)
+                                 for v in values])
+        RegisterDataBlock.__init__(self, address, memoryview(self.array))
+
+
+"""
+MmapDataBlock is a RegisterDataBlock serving one table of an MmapFile
+"""
+
+
+class MmapDataBlock(RegisterDataBlock):
+
+    def __init__(self, mmap_file, table):
+        self.mmap_file = mmap_file
+        RegisterDataBlock.__init__(self, mmap_file.tables[table][0],
+                                   mmap_file.region(table))
+
+
+"""
+BitDataBlock keeps coils/discrete inputs packed 8 to a byte in a bytearray
+"""
+
+
+class BitDataBlock(DirtyTracking, BaseModbusDataBlock):
+
+    def __init__(self, address, values):
+        DirtyTracking.__init__(self)
+        self.address = address
+        self.count = len(values)
+        self.bits = bytearray((self.count + 7) // 8)
+        self.default_value = False
+        for i, v in enumerate(values):
+            if v:
+                self.bits[i >> 3] |= 1 << (i & 7)
+
+    @property
+    def values(self):
+        return BitView(self.bits, 0, self.count)
+
+    def reset(self):
+        self.bits[:] = bytearray(len(self.bits))
+        self.mark_dirty(self.address, self.count)
+
+    def validate(self, address, count=1):
+        result = (self.address <= address)
+        result &= ((self.address + self.count) >= (address + count))
+        return result
+
+    def getValues(self, address, count=1):
+        return self.view(address, count).tolist()
+
+    """
+    - @brief view() returns the bits as a BitView, without copying
+    """
+
+    def view(self, address, count=1):
+        start = address - self.address
+        count = max(min(count, self.count - start), 0)
+        return BitView(self.bits, start, count)
+
+    def setValues(self, address, values):
+        if not isinstance(values, (list, BitView)):
+            values = [values]
+        start = address - self.address
+        bits = self.bits
+        changed = False
+        for i, v in enumerate(values, start):
+            mask = 1 << (i & 7)
+            if bool(v) != bool(bits[i >> 3] & mask):
+                bits[i >> 3] ^= mask
+                changed = True
+        if changed:
+            self.mark_dirty(address, len(values))
+
+
+"""
+BitView is a read only, zero-copy view of count bits of a bytearray
+"""
+
+
+class BitView(object):
+
+    __slots__ = ('bits', 'start', 'count')
+
+    def __init__(self, bits, start, count):
+        self.bits = bits
+        self.start = start
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.count)
+            if step != 1:
+                raise ValueError("BitView slices do not support steps")
+            return BitView(self.bits, self.start + start,
+                           max(stop - start, 0))
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError("BitView index out of range")
+        i = self.start + index
+        return bool(self.bits[i >> 3] & (1 << (i & 7)))
+
+    def __iter__(self):
+        bits = self.bits
+        for i in range(self.start, self.start + self.count):
+            yield bool(bits[i >> 3] & (1 << (i & 7)))
+
+    def tolist(self):
+        return list(self)
+
+
+"""
+LockedDataBlock wraps any datablock so getValues/setValues hold its lock
+- Set up by lock_tables() in datastore.py; the update/transaction functions
+  there hold the same (reentrant) lock around a read-modify-write, so a
+  Modbus client request can not land in the middle of it
+- Everything else (view, take_dirty, address, ...) goes to the datablock
+"""
+
+
+class LockedDataBlock(object):
+
+    def __init__(self, block):
+        self.block = block
+        self.lock = RLock()
+
+    def getValues(self, address, count=1):
+        with self.lock:
+            return self.block.getValues(address, count)
+
+    def setValues(self, address, values):
+        with self.lock:
+            self.block.setValues(address, values)
+
+    def __getattr__(self, name):
+        return getattr(self.block, name)
+
+    def __iter__(self):
+        return iter(self.block)
+
+
+"""
+MeteredDataBlock wraps any datablock to count its reads and writes, set up
+by meter_tables() in metrics.py
+- Goes around LockedDataBlock, so the table lock is still found through it
+"""
+
+
+class MeteredDataBlock(object):
+
+    def __init__(self, block, key, reads, writes):
+        self.block = block
+        self.key = key
+        self.reads = reads
+        self.writes = writes
+
+    def getValues(self, address, count=1):
+        self.reads.inc(self.key)
+        return self.block.getValues(address, count)
+
+    def setValues(self, address, values):
+        self.writes.inc(self.key)
+        self.block.setValues(address, values)
+
+    def __getattr__(self, name):
+        return getattr(self.block, name)
+
+    def __iter__(self):
+        return iter(self.block)
@@ -11,6 +11,9 @@ ModbusServerContext is setup with single=True
   - hr - holding register - read and write - 3
   - ir - input register - read only - 4
 """
+from contextlib import contextmanager
+from threading import Lock, RLock
+from datablock import LockedDataBlock
 
 
 def read_di_register(context, slave_id, addr, count):
@@ -35,3 +38,120 @@ def write_hr_register(context, slave_id, addr, values):
 
 def read_ir_register(context, slave_id, addr, count):
     return context.getValues(4, addr, count)
+
+
+"""
+- View functions return the values without copying them when the datablock
+  supports it (ArrayDataBlock, BitDataBlock and MmapDataBlock in
+  datablock.py), and fall back to the list from getValues otherwise
+- Views are live: they change when the datastore changes, so copy them
+  (e.g. with list()) to keep a snapshot
+"""
+
+
+def view_register(context, fx, addr, count):
+    if not context.zero_mode:
+        addr = addr + 1
+    block = context.store[context.decode(fx)]
+    if hasattr(block, 'view'):
+        return block.view(addr, count)
+    return block.getValues(addr, count)
+
+
+def view_di_register(context, slave_id, addr, count):
+    return view_register(context, 2, addr, count)
+
+
+def view_co_register(context, slave_id, addr, count):
+    return view_register(context, 1, addr, count)
+
+
+def view_hr_register(context, slave_id, addr, count):
+    return view_register(context, 3, addr, count)
+
+
+def view_ir_register(context, slave_id, addr, count):
+    return view_register(context, 4, addr, count)
+
+
+"""
+- Atomic read-modify-write functions
+- Every table has its own lock. After lock_tables(), the lock is also taken
+  by the datablock for every getValues/setValues, so Modbus client requests
+  can not land in the middle of an update. Without lock_tables(), updates
+  are only atomic with respect to each other
+- update_*_register(context, slave_id, addr, count, function) reads the
+  values, passes them to function and writes back what it returns (nothing
+  is written if it returns None); the values written are returned
+- compare_and_set_*_register() only writes values if the current values
+  are equal to expected, and returns whether it did
+- transaction(context, fx, ...) holds the locks of several tables at once,
+  for updates spanning more than one range or table
+"""
+
+_lock_creation = Lock()
+
+
+def lock_tables(context):
+    for key, block in context.store.items():
+        if not isinstance(block, LockedDataBlock):
+            context.store[key] = LockedDataBlock(block)
+
+
+def table_lock(context, fx):
+    block = context.store[context.decode(fx)]
+    lock = getattr(block, 'lock', None)
+    if lock is None:
+        with _lock_creation:
+            lock = getattr(block, 'lock', None)
+            if lock is None:
+                lock = block.lock = RLock()
+    return lock
+
+
+@contextmanager
+def transaction(context, *fxs):
+    # always take the locks in the same order, so transactions can not
+    # deadlock each other
+    tables = dict((context.decode(fx), fx) for fx in fxs)
+    locks = [table_lock(context, tables[key]) for key in sorted(tables)]
+    for lock in locks:
+        lock.acquire()
+    try:
+        yield context
+    finally:
+        for lock in reversed(locks):
+            lock.release()
+
+
+def update_register(context, fx, addr, count, function):
+    with table_lock(context, fx):
+        values = function(context.getValues(fx, addr, count))
+        if values is not None:
+            context.setValues(fx, addr, values)
+        return values
+
+
+def compare_and_set_register(context, fx, addr, expected, values):
+    expected = list(expected)
+    with table_lock(context, fx):
+        if list(context.getValues(fx, addr, len(expected))) != expected:
+            return False
+        context.setValues(fx, addr, values)
+        return True
+
+
+def update_co_register(context, slave_id, addr, count, function):
+    return update_register(context, 1, addr, count, function)
+
+
+def update_hr_register(context, slave_id, addr, count, function):
+    return update_register(context, 3, addr, count, function)
+
+
+def compare_and_set_co_register(context, slave_id, addr, expected, values):
+    return compare_and_set_register(context, 1, addr, expected, values)
+
+
+def compare_and_set_hr_register(context, slave_id, addr, expected, values):
+    return compare_and_set_register(context, 3, addr, expected, values)
@@ -3,467 +3,336 @@
 """
 Helper functions AND functions to be used for register behavior.
 
-(Reg behavior) Functions to be used to generate data variance
- for the plc devices.
-
-These functions accept:
-    minimum value
-    maximom value
-    slave context
-
-These functions return:
-    a set of values to be written to the slave context
+(Reg behavior) The register behaviors themselves are the classes in
+behaviors.py; updating_writer compiles them from the config and runs their
+"ticks" with the BehaviorScheduler in scheduler.py
 """
+import os
 import sys
 import yaml
+import atexit
 import logging
 from os import path
-from threading import Thread
-from time import *
-from random import *
+from time import perf_counter
 from datastore import *
-from pymodbus.transaction import (ModbusRtuFramer,
-                                  ModbusAsciiFramer,
-                                  ModbusBinaryFramer)
-
-"""
-linear() will update registers/coils in a linear function
-- It will continue to run until it receives 'ctrl+c' KeyboardInterrupt
-"""
+from scheduler import BehaviorScheduler
+from clock import clock_from_config
 
+# the behaviors, backup writers, metrics, log queue, mmap store, write
+# buffer, historian.py (sqlite3), vectorized.py (NumPy) and the framers are
+# only imported by the functions and PLC devices that use them, see
+# StartupTimer
 
-def linear(variance, bit, address, slave_id, count, context, log, my_backup):
-    try:
-        while True:
-            sleep(bit)
-            values = read_hr_register(context[0], slave_id, address, count)
-            values = [v + variance for v in values]
-            write_hr_register(context[0], slave_id, address, values)
-            log.debug(values)
-    except:
-        sys.exit()
+""" 
+A worker that runs every so often and updates live values of the context.
+Every read-modify-write of a behavior goes through the update functions in
+datastore.py, so it is atomic with respect to the other behaviors, and also
+to Modbus client requests when ENGINE has 'locking: true'.
 
+:param arguments: The input arguments to the call
 
-"""
-linear_coil_dependent() will update registers/coils in a linear function 
-until it reaches the max value specified
-- Currently will not decrement if it will fall below 0
-- Also will not increment if it goes past max
-- It will continue to run until it receives 'ctrl+c' KeyboardInterrupt
-- If the coil matches what the default_coil_value is, it will continue to add
-  variance to the holding register normally
-- Otherwise, it will negate the variance and add it to the holding register
-- The holding register will be checked every 'time' seconds
+Updating_writer compiles the DATASTORE section of the config for the
+calling PLC device into behavior objects (behaviors.py), based on the type
+of behavior and the parameters specified, and schedules their ticks
+    - All ticks run on one BehaviorScheduler, so there is a single thread
+      for every behavior of the PLC device
+    - If no scheduler is passed in, one is created and run in the calling
+      thread (this call will then block)
+    - With ENGINE 'vectorized: true', behaviors that vectorized.py supports
+      are grouped by type and period and each group runs as one tick
+    - A PLANT section (plant.py) is solved as one tick too
+    - With ENGINE 'coalesce_writes: true', the writes of the behaviors are
+      buffered and merged into one setValues per contiguous range
+      (write_buffer.py)
+    - With 'metrics' (SERVER 'metrics_port'), tick counts and lateness of
+      the behaviors are exposed by metrics.py
+    - The scheduler created runs on the clock set by ENGINE 'clock_speed'
+      (clock.py); with 'duration' it returns after that many simulated
+      seconds, e.g. to run a day of plant behavior for a regression test
+    - Currently does not handle 'di' or 'ir' register types
 """
 
 
-def linear_coil_dependent(variance, top, bit, address, slave_id, count,
-                          context, log, my_backup, coil_address,
-                          default_coil_value):
-    try:
-        while True:
-            sleep(bit)
-            coil_reg = read_co_register(context[0], slave_id, coil_address, 1)
-            # the datastore helper functions return a list,
-            # even if it is just one register being read
-            coil_reg = coil_reg[0]
-            # check the state of the coil
-            if coil_reg == "false" or int(coil_reg) == 0:
-                coil_val = 0
-            elif coil_reg == "true" or int(coil_reg) == 1:
-                coil_val = 1
-            # compare the current state of the coil to the default coil value
-            if coil_val == int(default_coil_value):
-                values = read_hr_register(context[0], slave_id, address, count)
-                # check to see if exceeded max value
-                if values[0] >= top:
-                    values[0] = top
-                else:
-                    values[0] = values[0] + variance
-                # values = [v + variance for v in values]
-                write_hr_register(context[0], slave_id, address, values)
-                log.debug(values)
-            else:
-                # not default coil value - negate variance and add it to
-                # holding register in order to do opposite behavior
-                values = read_hr_register(context[0], slave_id, address, count)
-                all_gt_0 = True
-                for v in values:
-                    if v <= 0:
-                        all_gt_0 = False
-                values = [v + (variance * -1) for v in values]
-                if all_gt_0:
-                    write_hr_register(context[0], slave_id, address, values)
-                log.debug(values)
-    except:
-        sys.exit()
+def updating_writer(context, config_list, bit, log, backup_filename,
+                    scheduler=None, duration=None, metrics=None):
+    engine_config = config_list.get('ENGINE', {})
+    from behaviors import compile_behaviors, load_plugins
+    run_scheduler = scheduler is None
+    if run_scheduler:
+        scheduler = BehaviorScheduler(log,
+                                      clock=clock_from_config(engine_config))
+    # modules registering behaviors of their own
+    load_plugins(engine_config.get('plugins', []))
+
+    # with 'coalesce_writes', behaviors write to a buffer that is flushed
+    # with one setValues per range once every tick due has run
+    behavior_context = context
+    if engine_config.get('coalesce_writes', False):
+        from write_buffer import WriteBuffer, BufferedServerContext
+        write_buffer = WriteBuffer(context[0])
+        behavior_context = BufferedServerContext(context, write_buffer)
+        scheduler.add_flush(write_buffer.flush)
+        if metrics is not None:
+            from metrics import meter_writes
+            meter_writes(metrics, write_buffer)
+
+    vector_engine = None
+    if engine_config.get('vectorized', False):
+        import vectorized
+        if vectorized.is_available():
+            vector_engine = vectorized.VectorEngine(context, log)
+        else:
+            log.warning("NumPy is not installed - "
+                        "running behaviors without vectorization")
+
+    # compile the behaviors of the config up front, looked up by table and
+    # type in the behavior registry (behaviors.py)
+    entries = []
+    for behavior in compile_behaviors(config_list, behavior_context, log):
+        if vector_engine is not None and vector_engine.accept(behavior):
+            # grouped with the other behaviors of its type and period
+            continue
+        entries.append(scheduler.add(behavior.tick, behavior.period,
+                                     name=behavior.name,
+                                     delay=behavior.first_delay(),
+                                     policy=behavior.policy))
+
+    if vector_engine is not None:
+        entries.extend(vector_engine.schedule(scheduler))
+    if config_list.get('PLANT') is not None:
+        # the process model of the plant, stepped as one tick
+        from plant import Plant
+        entries.append(Plant(context, config_list['PLANT'],
+                             log).schedule(scheduler))
+    if metrics is not None:
+        from metrics import meter_ticks
+        meter_ticks(metrics, entries)
+
+    if run_scheduler:
+        until = None
+        if duration is not None:
+            until = scheduler.clock.now() + duration
+        scheduler.run(until=until)
+    return scheduler
 
 
 """
-random_num() will update the registers/coils randomly
-- Will only generate random values between 'min' and 'max'
-- It will continue to run until it receives 'ctr+c' KeyboardInterrupt 
+- @brief scheduler_kind() returns where the behaviors of a PLC device run,
+  ENGINE 'scheduler' ('thread' or 'reactor')
+- The reactor has to serve requests in real time, so a PLC device with the
+  discrete clock ('clock_speed: max') always gets a scheduler thread
 """
 
 
-def random_num(less, top, bit, address, slave_id,
-               count, context, log, my_backup):
-    try:
-        while True:
-            sleep(bit)
-            values = read_hr_register(context[0], slave_id, address, count)
-            variance = randint(less, top)
-            values = [(v * 0) + variance for v in values]
-            write_hr_register(context[0], slave_id, address, values)
-            log.debug(values)
-    except:
-        sys.exit()
+def scheduler_kind(engine_config, log):
+    kind = engine_config.get('scheduler', 'thread')
+    if kind == 'reactor' and engine_config.get('clock_speed', 1) == 'max':
+        log.warning("clock_speed 'max' can not run on the reactor - "
+                    "running behaviors on a scheduler thread")
+        return 'thread'
+    return kind
 
 
 """
-random_coil_dependent() will update registers/coils in a linear function until
- it reaches the max value specified, then it will begin random data variance
-- It will continue to run until it receives 'ctr+c' KeyboardInterrupt
+- @brief datastore_backup_on_start will run before the datablock/slave/server
+  contexts are set up in order to start the server with the last known good
+  state of the server context
+- It updates the local datastore_config object with the corresponding 
+  values in backup_filename and then exits
 """
 
 
-def random_coil_dependent(variance, top, rand_min, rand_max, bit,
-                          address, slave_id, count, context, log,
-                          my_backup, coil_address, default_coil_value):
-    try:
-        # false until max is reached
-        at_max = False
-        while True:
-            sleep(bit)
-            coil_reg = read_co_register(context[0], slave_id, coil_address, 1)
-            # the datastore helper functions return a list,
-            # even if it is just one register being read
-            coil_reg = coil_reg[0]
-            values = read_hr_register(context[0], slave_id, address, count)
-            # checking to see if max value was reached to begin
-            # random data variance
-            if values[0] >= top:
-                at_max = True
-            # check the state of the coil
-            if coil_reg == "false" or int(coil_reg) == 0:
-                coil_val = 0
-            elif coil_reg == "true" or int(coil_reg) == 1:
-                coil_val = 1
-            # compare the current state of the coil to the default coil value
-            if coil_val == int(default_coil_value):
-                # if at max select random int
-                if at_max:
-                    values[0] = randint(rand_min, rand_max)
-                # check to see if exceeded max
-                elif values[0] >= top:
-                    values[0] = top
-                else:
-                    values[0] = values[0] + variance
-                # values = [v + variance for v in values]
-                write_hr_register(context[0], slave_id, address, values)
-                log.debug(values)
-            else:
-                # not default coil value - negate variance and
-                # add it to holding register in order to do opposite behavior
-                values = read_hr_register(context[0], slave_id, address, count)
-                all_gt_0 = True
-                for v in values:
-                    if v <= 0:
-                        all_gt_0 = False
-                if all_gt_0:
-                    # no longer at max value, do not do random variance
-                    at_max = False
-                    values = [v + (variance * -1) for v in values]
-                    if values[0] < 0:
-                        values[0] = 0
-                    write_hr_register(context[0], slave_id, address, values)
-                log.debug(values)
-    except:
-        sys.exit()
+def datastore_backup_on_start(my_backup):
+    if not path.exists(my_backup) or path.getsize(my_backup) == 0:
+        return -1
+    with open(my_backup, 'r') as backup:
+        backup_file = yaml.safe_load(backup)
+
+    return backup_file['DATASTORE']
 
 
 """
-constant_num() will update the registers/coils with a constant value
-- Will generate constant value to coil register
-- It will continue to run until it receives 'ctr+c' KeyboardInterrupt
+- @brief datastore_mmap_on_start is used instead of datastore_backup_on_start
+  with BACKUP 'format: mmap'
+- It maps backup_N.bin next to my_backup; the first time, that file is
+  created from the values in my_backup (made by master.py)
+- With datastore_config (the DATASTORE section of the PLC config), a file
+  whose tables differ from the config's is rebuilt from my_backup, and a
+  ValueError is raised if my_backup does not match the config either
+- Returns the MmapFile to build the datablocks from, or -1 like
+  datastore_backup_on_start
 """
 
 
-def constant_num(num, bit, address, slave_id, count, context, log, my_backup):
-    try:
-        while True:
-            sleep(bit)
-            values = read_co_register(context[0], slave_id, address, count)
-            variance = num
-            values = [(v * 0) + variance for v in values]
-            write_co_register(context[0], slave_id, address, values)
-            log.debug(values)
-    except:
-        sys.exit()
-
-
-def fuel_tank_behavior(less, top, bit, address, slave_id, count,
-                       context, log, my_backup, coil_address):
-    print("Thread started for fuel_tank_behavior")
-    try:
-        while True:
-            for i in range(0, 2):
-                # decrement behavior - decrement tank by 25% about every 15 min
-                # open coil
-                coil_values = read_co_register(context[0],
-                                               slave_id, coil_address, 1)
-                coil_values = [1 for v in coil_values]
-                write_co_register(context[0], slave_id, address, coil_values)
-                for j in range(0, 25):
-                    # take 25 seconds to decrement fuel tank level by 25%
-                    values = read_hr_register(context[0], slave_id,
-                                              address, count)
-                    for v in values:
-                        if v > less:
-                            values = [(v - 1) for v in values]
-                    write_hr_register(context[0], slave_id, address, values)
-                    log.debug(values)
-                    sleep(1)
-
-                # close coil
-                coil_values = read_co_register(context[0],
-                                               slave_id, coil_address, 1)
-                coil_values = [0 for v in coil_values]
-                write_co_register(context[0], slave_id, address, coil_values)
-
-                sleep_val = 875
-                # sleep for about 15 minutes, depending on whether we
-                # decremented or also incremented
-                sleep(sleep_val)
-                # increment behavior - refill tank to 100% about every hour
-                if i == 1:
-                    # open coil
-                    log.debug("Increment behavior entered\n")
-                    coil_values = read_co_register(context[0], slave_id,
-                                                   coil_address, 1)
-                    coil_values = [1 for v in coil_values]
-                    write_co_register(context[0], slave_id, address,
-                                      coil_values)
-
-                    for k in range(0, 100):
-                        # take 100 seconds to refill fuel tank back to 100
-                        values = read_hr_register(context[0], slave_id,
-                                                  address, count)
-                        for v in values:
-                            if v < top:
-                                values = [(v + 1) for v in values]
-                        write_hr_register(context[0], slave_id,
-                                          address, values)
-                        log.debug(values)
-                        sleep(1)
-
-                    # close coil
-                    coil_values = read_co_register(context[0], slave_id,
-                                                   coil_address, 1)
-                    coil_values = [0 for v in coil_values]
-                    write_co_register(context[0], slave_id, address,
-                                      coil_values)
-
-            sleep(900)
-    except:
-        sys.exit()
+def datastore_mmap_on_start(my_backup, datastore_config=None):
+    from mmap_store import MmapFile, create_mmap_file, mmap_filename, layout
+    mmap_backup = mmap_filename(my_backup)
+    if path.exists(mmap_backup):
+        mmap_file = MmapFile(mmap_backup)
+        if datastore_config is None or \
+                mmap_file.layout() == layout(datastore_config):
+            return mmap_file
+        # the tables of the config changed since the file was created
+        mmap_file.close()
+        logging.getLogger().warning(
+            "%s does not match the tables of the config, rebuilding it "
+            "from %s", mmap_backup, my_backup)
+    backup_config = datastore_backup_on_start(my_backup)
+    if backup_config == -1:
+        return -1
+    if datastore_config is not None and \
+            layout(backup_config) != layout(datastore_config):
+        raise ValueError("%s does not match the tables of the config either;"
+                         " clear the backups of this PLC device to start "
+                         "from the config" % my_backup)
+    create_mmap_file(mmap_backup + '.tmp', backup_config)
+    os.replace(mmap_backup + '.tmp', mmap_backup)
+    return MmapFile(mmap_backup)
 
 
-""" 
-A worker process that runs every so often and
-updates live values of the context. It should be noted
-that there is a race condition for the update.
+"""
+- @brief datastore_backup_to_yaml will keep the datastore backup file in
+  YAML format up to date with the context
+- It sets up a BackupWriter (backup.py) from the BACKUP section of the config
+  and adds it to the scheduler passed in; if no scheduler is passed in, one
+  is created and run in the calling thread (this call will then block)
+- It should start running before the other threads (for register behavior) 
+  starts running, but after the datastore context has been setup
+"""
 
-:param arguments: The input arguments to the call
 
-Updating_writer parses the DATASTORE section of the config
-for the calling PLC device to start threads for each holding register 
-based on the type of behavior and the parameters specified
-    - Currently designed to have one thread per holding register
-    - Currently does not handle 'di' or 'ir' register types
-"""
+def datastore_backup_to_yaml(context, my_backup, backup_config=None,
+                             scheduler=None, metrics=None):
+    from backup import BackupWriter
+    if backup_config is None:
+        backup_config = {}
+    writer = BackupWriter(context, my_backup,
+                          interval=backup_config.get('interval', 1),
+                          max_delay=backup_config.get('max_delay', 5))
+    if metrics is not None:
+        from metrics import meter_backup
+        meter_backup(metrics, writer)
+    run_scheduler = scheduler is None
+    if run_scheduler:
+        scheduler = BehaviorScheduler(logging.getLogger())
+    writer.schedule(scheduler)
+    if run_scheduler:
+        scheduler.run()
+    return writer
 
 
-def updating_writer(context, config_list, bit, log, backup_filename):
-    # load in config list to generate thread behavior
-    values = config_list['DATASTORE']['hr']['values']
-    size = len(values)
-    i = 0
-    # loop through each holding register
-    while i < size:
-        log.debug("updating the context")
-        name = 'behavior_' + str(i + 1)
-        slave_id = 0x00
-        bit = config_list['DATASTORE']['hr'][name]['time']
-        address = config_list['DATASTORE']['hr'][name]['address']
-        count = config_list['DATASTORE']['hr'][name]['count']
-        target = ''
-        args = ()
-
-        # check to see what behavior to use
-        if config_list['DATASTORE']['hr'][name]['type'] == 'linear':
-            # collect values from master config
-            variance = config_list['DATASTORE']['hr'][name]['variance']
-            target = linear
-            args = (variance, bit, address, slave_id, count, context,
-                    log, backup_filename)
-
-        elif config_list['DATASTORE']['hr'][name]['type'] == \
-                'linear_coil_dependent':
-            variance = config_list['DATASTORE']['hr'][name]['variance']
-            coil_address = config_list['DATASTORE']['hr'][name]['coil_address']
-            default_coil_value = config_list['DATASTORE']['hr'][name][
-                'default_coil_value']
-            maximum = config_list['DATASTORE']['hr'][name]['max']
-            target = linear_coil_dependent
-            args = (variance, maximum, bit, address, slave_id, count,
-                    context, log, backup_filename, coil_address,
-                    default_coil_value)
-
-        elif config_list['DATASTORE']['hr'][name]['type'] == 'random':
-            # collect values from master config
-            minimum = config_list['DATASTORE']['hr'][name]['min']
-            maximum = config_list['DATASTORE']['hr'][name]['max']
-            target = random_num
-            args = (minimum, maximum, bit, address, slave_id,
-                    count, context, log, backup_filename)
-
-        elif config_list['DATASTORE']['hr'][name]['type'] == \
-                'random_coil_dependent':
-            variance = config_list['DATASTORE']['hr'][name]['variance']
-            coil_address = config_list['DATASTORE']['hr'][name]['coil_address']
-            default_coil_value = config_list['DATASTORE']['hr'][name][
-                'default_coil_value']
-            maximum = config_list['DATASTORE']['hr'][name]['max']
-            rand_min = config_list['DATASTORE']['hr'][name]['rand_min']
-            rand_max = config_list['DATASTORE']['hr'][name]['rand_max']
-            target = random_coil_dependent
-            args = (variance, maximum, rand_min, rand_max, bit, address,
-                    slave_id, count, context, log, backup_filename,
-                    coil_address, default_coil_value)
-
-        elif config_list['DATASTORE']['hr'][name]['type'] == \
-                'fuel_tank_behavior':
-            print("successfully found fuel_tank_behavior")
-            minimum = config_list['DATASTORE']['hr'][name]['min']
-            maximum = config_list['DATASTORE']['hr'][name]['max']
-            coil_address = config_list['DATASTORE']['hr'][name]['coil_address']
-            target = fuel_tank_behavior
-            args = (minimum, maximum, bit, address, slave_id, count,
-                    context, log, backup_filename, coil_address)
-
-        # start thread
-        thread = Thread(target=target, args=args)
-        thread.daemon = True
-        thread.start()
-
-        # iterate to next thread
-        i += 1
-
-    # load in config list to generate thread behavior for coil registers
-    co_values = config_list['DATASTORE']['co']['values']
-    co_size = len(co_values)
-    # Allow for us to add behaviors only for some coil registers if we want to
-    is_behavior = False
-    j = 0
-    while j < co_size:
-        log.debug("updating the context")
-        name = 'behavior_' + str(j + 1)
-        slave_id = 0x00
-        # Moved time/address/count collection to if logic for constant
-        # If we add more behaviors in the future for coils, can move it
-        # back up here and add logic to check that behavior_N['type'] != 'none'
-        # before getting time/address/count values
-        target = ''
-        args = ()
-
-        # check to see what behavior to use.
-        # If it does not match any, don't start a thread
-        if config_list['DATASTORE']['co'][name]['type'] == 'constant':
-            # collect values from master config
-            bit = config_list['DATASTORE']['co'][name]['time']
-            address = config_list['DATASTORE']['co'][name]['address']
-            count = config_list['DATASTORE']['co'][name]['count']
-            num = config_list['DATASTORE']['co'][name]['num']
-            target = constant_num
-            args = (num, bit, address, slave_id, count,
-                    context, log, backup_filename)
-            is_behavior = True
-        else:
-            # invalid type name or no behavior
-            is_behavior = False
+"""
+- @brief datastore_history() samples the datastore into the history database
+  of the HISTORIAN section (historian.py), set up like the backups
+- Samples are stamped with 'clock', the clock of the behaviors; the
+  historian is closed when the process exits
+"""
 
-        # start thread if it is a valid behavior
-        if is_behavior:
-            thread = Thread(target=target, args=args)
-            thread.daemon = True
-            thread.start()
 
-        # iterate to the next coil register to check for behavior
-        j += 1
+def datastore_history(context, history_file, historian_config,
+                      scheduler=None, metrics=None, clock=None):
+    from historian import Historian
+    historian = Historian(context, history_file, historian_config, clock)
+    # write the rows still being aggregated on the way out
+    atexit.register(historian.close)
+    if metrics is not None:
+        from metrics import meter_history
+        meter_history(metrics, historian)
+    run_scheduler = scheduler is None
+    if run_scheduler:
+        scheduler = BehaviorScheduler(logging.getLogger())
+    historian.schedule(scheduler)
+    if run_scheduler:
+        scheduler.run()
+    return historian
 
 
 """
-- @brief datastore_backup_on_start will run before the datablock/slave/server
-  contexts are set up in order to start the server with the last known good
-  state of the server context
-- It updates the local datastore_config object with the corresponding 
-  values in backup_filename and then exits
+- @brief datastore_backup_to_mmap is used instead of datastore_backup_to_yaml
+  with BACKUP 'format: mmap', and is set up the same way
 """
 
 
-def datastore_backup_on_start(my_backup):
-    if not path.exists(my_backup) or path.getsize(my_backup) == 0:
-        return -1
-    with open(my_backup, 'r') as backup:
-        backup_file = yaml.safe_load(backup)
-
-    return backup_file['DATASTORE']
+def datastore_backup_to_mmap(context, mmap_file, backup_config=None,
+                             scheduler=None, metrics=None):
+    if backup_config is None:
+        backup_config = {}
+    from backup import MmapBackupWriter
+    writer = MmapBackupWriter(context, mmap_file,
+                              interval=backup_config.get('interval', 1))
+    if metrics is not None:
+        from metrics import meter_backup
+        meter_backup(metrics, writer)
+    run_scheduler = scheduler is None
+    if run_scheduler:
+        scheduler = BehaviorScheduler(logging.getLogger())
+    writer.schedule(scheduler)
+    if run_scheduler:
+        scheduler.run()
+    return writer
 
 
 """
-- @brief datastore_backup_to_yaml will run continuously to READ from 
-  the context to update the entries in the datastore backup file in YAML format
-- It should be run from async_plc.py as a thread to continuously run
-- It should start running before the other threads (for register behavior) 
-  starts running, but after the datastore context has been setup
+Used to configure logging from the LOGGING section and clean up the code in
+async_plc.py
+- With no name, the root logger is set up with logging.basicConfig
+- With a name (multi-PLC host mode), a logger of its own is set up so every
+  PLC device keeps logging to the file in its own LOGGING section
+- With 'queue: true' records are written from a background thread, and
+  'rate_limit'/'sample' drop DEBUG/INFO records per behavior (log_queue.py)
 """
 
 
-def datastore_backup_to_yaml(context, my_backup):
-    with open(my_backup, 'r') as backup:
-        backup_file = yaml.safe_load(backup)
-
-    yaml_file = ''
-    num_of_co = len(backup_file['DATASTORE']['co']['values'])
-    num_of_di = len(backup_file['DATASTORE']['di']['values'])
-    num_of_hr = len(backup_file['DATASTORE']['hr']['values'])
-    num_of_ir = len(backup_file['DATASTORE']['ir']['values'])
-    try:
-        while True:
-            # Eventually change sleep value to a parameter - there are
-            # issues with the backup file if there is no sleep at all
-            sleep(1)
-            backup_file['DATASTORE']['co']['values'] = read_co_register(
-                context[0], 0x00, 0x00, num_of_co)
-            backup_file['DATASTORE']['di']['values'] = read_di_register(
-                context[0], 0x00, 0x00, num_of_di)
-            backup_file['DATASTORE']['hr']['values'] = read_hr_register(
-                context[0], 0x00, 0x00, num_of_hr)
-            backup_file['DATASTORE']['ir']['values'] = read_ir_register(
-                context[0], 0x00, 0x00, num_of_ir)
-
-            with open(my_backup, 'w') as yaml_file:
-                yaml.dump(backup_file, yaml_file, default_flow_style=False)
-
-    except:
-        if not yaml_file.closed:
-            yaml_file.close()
-        sys.exit()
+def configure_logging(logging_config, name=None):
+    FORMAT = logging_config['format']
+    if logging_config.get('queue', False):
+        # the file/stdout handler is run by the listener thread of log_queue
+        if logging_config['file'] == 'STDOUT':
+            target = logging.StreamHandler()
+        else:
+            target = logging.FileHandler(logging_config['file'])
+        if FORMAT != 'NONE':
+            target.setFormatter(logging.Formatter(FORMAT))
+        log = logging.getLogger(name)
+        if name is not None:
+            log.propagate = False
+        from log_queue import queue_handler
+        log.addHandler(queue_handler(target, logging_config))
+    elif name is None:
+        # Add logic based on whether a file is used or stdout
+        #   AND whether a format string is used or not
+        if logging_config['file'] == 'STDOUT':
+            if FORMAT == 'NONE':
+                logging.basicConfig()
+            else:
+                logging.basicConfig(format=FORMAT)
+        else:
+            if FORMAT == 'NONE':
+                logging.basicConfig(filename=logging_config['file'])
+            else:
+                logging.basicConfig(format=FORMAT,
+                                    filename=logging_config['file'])
+        log = logging.getLogger()
+    else:
+        log = logging.getLogger(name)
+        log.propagate = False
+        if logging_config['file'] == 'STDOUT':
+            handler = logging.StreamHandler()
+        else:
+            handler = logging.FileHandler(logging_config['file'])
+        if FORMAT != 'NONE':
+            handler.setFormatter(logging.Formatter(FORMAT))
+        log.addHandler(handler)
+    if logging_config.get('rate_limit', 0) or \
+            logging_config.get('sample', 1) > 1:
+        from log_queue import add_log_filters
+        add_log_filters(log, logging_config)
+    configure_logging_level(logging_config['logging_level'], log)
+    return log
 
 
 """
-Used to configure logging and clean up the code in async_plc.py
+Used to configure the logging level
 """
 
 
@@ -485,6 +354,7 @@ def configure_logging_level(logging_level, log):
 
 """
 Used to configure the framer and clean up the code in async_plc.py
+- Only the framer of the SERVER section is imported
 """
 
 
@@ -493,13 +363,44 @@ def configure_server_framer(server_config):
     if server_config['type'] == 'tcp':
         # check framer to be rtu or none
         if server_config['framer'] == 'RTU':
-            framer = ModbusRtuFramer
+            from pymodbus.transaction import ModbusRtuFramer as framer
     elif server_config['type'] == 'serial':
         # framer can be rtu, ascii, or binary
         if server_config['framer'] == 'RTU':
-            framer = ModbusRtuFramer
+            from pymodbus.transaction import ModbusRtuFramer as framer
         elif server_config['framer'] == 'ASCII':
-            framer = ModbusAsciiFramer
+            from pymodbus.transaction import ModbusAsciiFramer as framer
         elif server_config['framer'] == 'BINARY':
-            framer = ModbusBinaryFramer
+            from pymodbus.transaction import ModbusBinaryFramer as framer
     return framer
+
+
+"""
+StartupTimer measures the phases of the start of a PLC device (import,
+config load, backup load, datastore build, behavior start, socket bind), so
+the time a restarted plant is not answering can be accounted for
+- phase() ends the current phase and starts the next one
+- report() logs the phases at INFO, once the PLC device is ready
+"""
+
+
+class StartupTimer(object):
+
+    def __init__(self, name, start=None):
+        self.name = name
+        self.start = perf_counter() if start is None else start
+        self.last = self.start
+        self.phases = []
+
+    def phase(self, name):
+        now = perf_counter()
+        self.phases.append((name, now - self.last))
+        self.last = now
+
+    def total(self):
+        return self.last - self.start
+
+    def report(self, log):
+        log.info("%s ready in %.1f ms: %s", self.name, self.total() * 1000,
+                 ', '.join('%s %.1f ms' % (name, seconds * 1000)
+                           for name, seconds in self.phases))
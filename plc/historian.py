@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+
+"""
+Historian of a PLC device: the values of its tables over time, kept in a
+local SQLite database (WAL mode) when the PLC config has a HISTORIAN
+section.
+
+    HISTORIAN:
+      file: /usr/local/bin/scadasim_pymodbus_plc/backups/history_0.db
+      interval: 1          # seconds between samples of the tables
+      tables: [hr, co]     # tables to sample, defaults to all four
+      raw_rows: 3600       # raw samples kept per table
+      second_rows: 86400   # 1 second min/max/avg rows kept per table
+      minute_rows: 10080   # 1 minute min/max/avg rows kept per table
+      flush_interval: 10   # seconds between writes to the database
+
+- Every resolution is a ring of a fixed number of rows: a row goes to slot
+  'seq % rows' and replaces the oldest one, so neither the database nor
+  memory grows with the length of a run
+- In memory there are only the samples not written yet and the 1 second /
+  1 minute rows being aggregated
+- Without 'file', the database is kept next to the backup file, e.g.
+  backups/history_0.db for backups/backup_0.yaml
+- Samples are stamped with the clock of the PLC device's behaviors, so with
+  ENGINE 'clock_speed' the history is in simulated time, like the behaviors
+  ('interval' and 'flush_interval' stay wall seconds)
+- close() writes the 1 second / 1 minute rows still being aggregated, so a
+  shutdown does not lose them; datastore_history() (helper.py) calls it when
+  the process exits
+- The database can be read while the PLC device is running:
+
+    python historian.py ../backups/history_0.db --table hr --address 0 \
+        --count 4 --resolution 1min --start -3600
+
+- query_history() is the same query from Python; 'auto' picks the finest
+  resolution that still has rows from 'start' on
+"""
+import os
+import sys
+import time
+import sqlite3
+import argparse
+import operator
+from array import array
+from threading import Lock
+from clock import SimClock
+
+# resolution name -> seconds per row (0 for raw samples)
+RESOLUTIONS = (('raw', 0), ('1s', 1), ('1min', 60))
+ROWS_KEYS = {'raw': 'raw_rows', '1s': 'second_rows', '1min': 'minute_rows'}
+ROWS_DEFAULTS = {'raw': 3600, '1s': 86400, '1min': 10080}
+# table name -> key of the datablock in the slave context
+TABLES = (('co', 'c'), ('di', 'd'), ('hr', 'h'), ('ir', 'i'))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS history (
+    resolution TEXT, tbl TEXT, slot INTEGER, seq INTEGER, t REAL,
+    samples INTEGER, start_addr INTEGER, min BLOB, max BLOB, avg BLOB,
+    PRIMARY KEY (resolution, tbl, slot));
+CREATE INDEX IF NOT EXISTS history_t ON history (resolution, tbl, t);
+"""
+
+
+def history_filename(backup_filename):
+    directory, name = os.path.split(backup_filename)
+    name = os.path.splitext(name)[0].replace('backup', 'history', 1)
+    return os.path.join(directory, name + '.db')
+
+
+def connect(filename):
+    connection = sqlite3.connect(filename, check_same_thread=False)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def block_size(block):
+    # bit blocks keep a count, register blocks a list/array of values
+    count = getattr(block, 'count', None)
+    return count if count is not None else len(block.values)
+
+
+"""
+Rollup aggregates the samples of one table into rows of 'seconds' seconds
+"""
+
+
+class Rollup(object):
+
+    __slots__ = ('seconds', 'bucket', 'samples', 'min', 'max', 'sum')
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.bucket = None
+
+    def add(self, t, values):
+        # returns the finished row (t, samples, min, max, avg) when t is in
+        # the next bucket, else None
+        bucket = int(t // self.seconds)
+        row = None
+        if bucket != self.bucket:
+            row = self.row()
+            self.bucket = bucket
+            self.samples = 1
+            self.min = list(values)
+            self.max = list(values)
+            self.sum = list(values)
+            return row
+        self.samples += 1
+        self.min = list(map(min, self.min, values))
+        self.max = list(map(max, self.max, values))
+        self.sum = list(map(operator.add, self.sum, values))
+        return row
+
+    def row(self):
+        if self.bucket is None:
+            return None
+        samples = self.samples
+        return (self.bucket * self.seconds, samples, self.min, self.max,
+                [total / samples for total in self.sum])
+
+
+class Historian(object):
+
+    def __init__(self, context, filename, config=None, clock=None):
+        config = config or {}
+        self.context = context
+        # the clock of the behaviors (clock.py), real time by default
+        self.clock = SimClock() if clock is None else clock
+        self.filename = filename
+        self.interval = config.get('interval', 1)
+        self.flush_interval = config.get('flush_interval', 10)
+        self.tables = [(table, key) for table, key in TABLES
+                       if table in config.get('tables',
+                                              [t for t, k in TABLES])]
+        self.rows = dict((name, int(config.get(ROWS_KEYS[name],
+                                               ROWS_DEFAULTS[name])))
+                         for name, seconds in RESOLUTIONS)
+        self.connection = connect(filename)
+        self.lock = Lock()
+        # next sequence number per (resolution, table), after a restart too
+        self.seq = {}
+        for name, seconds in RESOLUTIONS:
+            for table, key in self.tables:
+                last = self.connection.execute(
+                    'SELECT MAX(seq) FROM history WHERE resolution = ? AND '
+                    'tbl = ?', (name, table)).fetchone()[0]
+                self.seq[(name, table)] = 0 if last is None else last + 1
+        self.rollups = dict(((seconds, table), Rollup(seconds))
+                            for name, seconds in RESOLUTIONS if seconds
+                            for table, key in self.tables)
+        self.pending = []
+        self.last_flush = time.time()
+        self.closed = False
+        # stats, like the backup writers
+        self.samples = 0
+        self.writes = 0
+        self.write_seconds = 0.0
+
+    def _append(self, name, table, t, samples, start_addr, mins, maxs, avgs):
+        seq = self.seq[(name, table)]
+        self.seq[(name, table)] = seq + 1
+        # raw samples only keep their values, in 'min'
+        self.pending.append((name, table, seq % self.rows[name], seq, t,
+                             samples, start_addr,
+                             array('q', mins).tobytes(),
+                             None if maxs is None else
+                             array('q', maxs).tobytes(),
+                             None if avgs is None else
+                             array('d', avgs).tobytes()))
+
+    """
+    - @brief tick() samples every table, and writes the rows collected to
+      the database every 'flush_interval' seconds
+    """
+
+    def tick(self):
+        if self.closed:
+            # the scheduler thread can still run while the process exits
+            return
+        now = self.clock.now()
+        store = self.context[0].store
+        for table, key in self.tables:
+            block = store[key]
+            values = block.getValues(block.address, block_size(block))
+            values = [int(value) for value in values]
+            self._append('raw', table, now, 1, block.address, values,
+                         None, None)
+            for name, seconds in RESOLUTIONS[1:]:
+                row = self.rollups[(seconds, table)].add(now, values)
+                if row is not None:
+                    self._append(name, table, row[0], row[1],
+                                 block.address, *row[2:])
+        self.samples += 1
+        if time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        start = time.time()
+        with self.lock:
+            pending, self.pending = self.pending, []
+            if pending:
+                with self.connection:
+                    self.connection.executemany(
+                        'INSERT OR REPLACE INTO history VALUES '
+                        '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', pending)
+                self.writes += 1
+        self.last_flush = time.time()
+        self.write_seconds += self.last_flush - start
+
+    """
+    - @brief query() returns rows of the history written so far, see
+      query_history()
+    """
+
+    def query(self, table, address, count=1, start=None, end=None,
+              resolution='auto'):
+        self.flush()
+        with self.lock:
+            return query_history(self.connection, table, address, count,
+                                 start, end, resolution,
+                                 now=self.clock.now())
+
+    def schedule(self, scheduler):
+        scheduler.add(self.tick, self.interval, name='historian ' +
+                      os.path.basename(self.filename))
+
+    """
+    - @brief close() writes the rows still being aggregated and what is
+      pending, then closes the database
+    """
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        start_addrs = dict((table, self.context[0].store[key].address)
+                           for table, key in self.tables)
+        for name, seconds in RESOLUTIONS[1:]:
+            for table, key in self.tables:
+                rollup = self.rollups[(seconds, table)]
+                row = rollup.row()
+                if row is not None:
+                    self._append(name, table, row[0], row[1],
+                                 start_addrs[table], *row[2:])
+                    rollup.bucket = None
+        self.flush()
+        self.connection.close()
+
+
+def pick_resolution(connection, table, start):
+    if start is None:
+        return RESOLUTIONS[-1][0]
+    for name, seconds in RESOLUTIONS:
+        oldest = connection.execute(
+            'SELECT MIN(t) FROM history WHERE resolution = ? AND tbl = ?',
+            (name, table)).fetchone()[0]
+        if oldest is not None and oldest <= start:
+            return name
+    return RESOLUTIONS[-1][0]
+
+
+"""
+- @brief query_history() returns (t, samples, min, max, avg) rows of a table
+  from a history database (a filename or an open connection), oldest first
+- min/max/avg are lists of the 'count' values from 'address' (offset into
+  the table, from 0); for raw samples they are the sampled values
+- start/end are times in seconds, negative ones are relative to 'now'
+  (default: the wall time)
+"""
+
+
+def query_history(database, table, address, count=1, start=None, end=None,
+                  resolution='auto', now=None):
+    connection = database
+    if not isinstance(database, sqlite3.Connection):
+        connection = sqlite3.connect(database)
+    if now is None:
+        now = time.time()
+    if start is not None and start < 0:
+        start += now
+    if end is not None and end < 0:
+        end += now
+    if resolution == 'auto':
+        resolution = pick_resolution(connection, table, start)
+    rows = connection.execute(
+        'SELECT t, samples, min, max, avg FROM history WHERE resolution = ? '
+        'AND tbl = ? AND t >= ? AND t <= ? ORDER BY t',
+        (resolution, table, -1.0 if start is None else start,
+         float('inf') if end is None else end)).fetchall()
+    result = []
+    for t, samples, mins, maxs, avgs in rows:
+        mins = array('q', mins)
+        maxs = mins if maxs is None else array('q', maxs)
+        avgs = array('d', mins) if avgs is None else array('d', avgs)
+        result.append((t, samples, mins[address:address + count].tolist(),
+                       maxs[address:address + count].tolist(),
+                       avgs[address:address + count].tolist()))
+    if connection is not database:
+        connection.close()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Query the history database of a PLC device")
+    parser.add_argument("database", help="history_N.db file")
+    parser.add_argument("--table", default='hr', help="co, di, hr or ir")
+    parser.add_argument("--address", type=int, default=0,
+                        help="First address, from 0")
+    parser.add_argument("--count", type=int, default=1,
+                        help="Number of values")
+    parser.add_argument("--start", type=float,
+                        help="Start time, negative for seconds ago")
+    parser.add_argument("--end", type=float,
+                        help="End time, negative for seconds ago")
+    parser.add_argument("--resolution", default='auto',
+                        choices=['auto'] + [r[0] for r in RESOLUTIONS])
+    args = parser.parse_args()
+    for t, samples, mins, maxs, avgs in query_history(
+            args.database, args.table, args.address, args.count, args.start,
+            args.end, args.resolution):
+        sys.stdout.write('%.3f %d min=%s max=%s avg=%s\n' % (
+            t, samples, mins, maxs, ['%.2f' % avg for avg in avgs]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+
+"""
+Logging that does not hold up the register behaviors, set up from the
+LOGGING section of a PLC config.
+
+    LOGGING:
+      file: /usr/local/bin/scadasim_pymodbus_plc/logging/logging_0.log
+      format: '%(asctime)-15s %(name)-20s %(message)s'
+      logging_level: DEBUG
+      queue: true        # write records from a background thread
+      queue_size: 10000  # records waiting to be written, more are dropped
+                         # (the queue is shared, the first PLC device sets it)
+      rate_limit: 5      # records per second per behavior (0: no limit)
+      burst: 10          # records a behavior can log at once (rate_limit)
+      sample: 10         # log 1 in 10 records per behavior (1: every one)
+
+- With 'queue: true' the thread that logs a record only fills in its
+  message (so values that change later are logged as they were) and puts it
+  on a queue; formatting it and writing it to the file is left to one
+  QueueListener thread shared by every PLC device of the process
+- The queue never blocks: when it is full, records are dropped and counted
+- Every behavior logs to a logger of its own (a child of the PLC device's
+  logger, e.g. 'hr behavior_1'), so 'rate_limit' and 'sample' apply per
+  behavior; warnings and errors are never dropped
+- Records keep the time they were logged at, not the time they are written
+"""
+import queue
+import atexit
+import logging
+from threading import Lock
+from logging.handlers import QueueHandler, QueueListener
+
+"""
+RateLimitFilter drops DEBUG/INFO records per logger name
+- 'sample' keeps 1 in every 'sample' records
+- 'rate_limit' is a token bucket of 'burst' records, refilled at 'rate'
+  records per second of record time
+- Behaviors log from the scheduler thread and requests from the reactor, so
+  the counts are updated under a lock
+"""
+
+
+class RateLimitFilter(logging.Filter):
+
+    def __init__(self, rate=0, burst=None, sample=1):
+        logging.Filter.__init__(self)
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(self.rate, 1))
+        self.sample = max(int(sample), 1)
+        # logger name -> [tokens, time of the last record]
+        self.buckets = {}
+        self.seen = {}
+        self.dropped = 0
+        self._lock = Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        with self._lock:
+            return self.keep(record)
+
+    def keep(self, record):
+        name = record.name
+        if self.sample > 1:
+            seen = self.seen.get(name, 0)
+            self.seen[name] = seen + 1
+            if seen % self.sample:
+                self.dropped += 1
+                return False
+        if self.rate > 0:
+            bucket = self.buckets.get(name)
+            if bucket is None:
+                bucket = self.buckets[name] = [self.burst, record.created]
+            tokens = min(self.burst, bucket[0] + (record.created - bucket[1])
+                         * self.rate)
+            bucket[1] = record.created
+            if tokens < 1:
+                bucket[0] = tokens
+                self.dropped += 1
+                return False
+            bucket[0] = tokens - 1
+        return True
+
+
+"""
+DeferredQueueHandler puts (target handler, record) on the shared queue, with
+its message filled in, and leaves formatting to the listener thread
+"""
+
+
+class DeferredQueueHandler(QueueHandler):
+
+    def __init__(self, log_queue, target):
+        QueueHandler.__init__(self, log_queue)
+        self.target = target
+        self.dropped = 0
+
+    def prepare(self, record):
+        # QueueHandler formats here, in the thread that logs; only the
+        # message is filled in, the args (value lists, live views of the
+        # datastore) may have changed by the time the listener formats it
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait((self.target, record))
+        except queue.Full:
+            self.dropped += 1
+
+
+class DispatchingListener(QueueListener):
+
+    def enqueue_sentinel(self):
+        # wait for room, the sentinel must not be dropped
+        self.queue.put(self._sentinel)
+
+    def handle(self, item):
+        target, record = item
+        if record.levelno >= target.level:
+            target.handle(record)
+
+
+_listener = None
+
+
+def shared_queue(queue_size):
+    global _listener
+    if _listener is None:
+        _listener = DispatchingListener(queue.Queue(queue_size))
+        _listener.start()
+        # write out what is still queued when the process exits
+        atexit.register(stop_logging)
+    return _listener.queue
+
+
+def stop_logging():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+"""
+- @brief add_log_filters() adds the 'rate_limit'/'sample' filter of a LOGGING
+  section to the handlers of a logger
+"""
+
+
+def add_log_filters(log, logging_config):
+    rate = logging_config.get('rate_limit', 0)
+    sample = logging_config.get('sample', 1)
+    if not rate and sample <= 1:
+        return None
+    log_filter = RateLimitFilter(rate, logging_config.get('burst'), sample)
+    for handler in log.handlers:
+        handler.addFilter(log_filter)
+    return log_filter
+
+
+"""
+- @brief queue_handler() returns the handler logging to target from the
+  listener thread
+"""
+
+
+def queue_handler(target, logging_config):
+    return DeferredQueueHandler(
+        shared_queue(int(logging_config.get('queue_size', 10000))), target)
@@ -0,0 +1,503 @@
+#!/usr/bin/env python
+
+"""
+Metrics of a PLC device, served in the Prometheus text format over HTTP when
+the SERVER section of its config has 'metrics_port'.
+
+- Modbus requests: count per function code, a histogram of the request
+  latency per function code (from the server receiving the request to the
+  response being written: decode, validate, datastore and encode), and a
+  histogram of the part of it spent reading/writing the datastore
+  (including the wait for the table locks with ENGINE 'locking: true')
+- Datastore reads/writes per table, from behaviors and requests alike
+- Behavior ticks: count, lateness (how long after its deadline a tick ran)
+  and skipped ticks per behavior, or per group with ENGINE 'vectorized: true'
+- Backups: count, duration and bytes written
+- Historian (HISTORIAN section): samples taken, writes and their duration
+- Counting is cheap: counters and histograms are updated without a lock,
+  in a dict of the thread counting, and the dicts of every thread are only
+  added up when the endpoint is scraped; the behavior and backup stats are
+  kept by the scheduler and backup writer anyway, and are only copied over
+  when the endpoint is scraped
+- Several PLC devices (multi-PLC host mode) can share one port, every sample
+  carries a 'port' label with the Modbus port of its PLC device
+
+    curl http://127.0.0.1:<metrics_port>/metrics
+"""
+from threading import Lock, local
+from time import perf_counter
+
+# request latencies are well under a millisecond when nothing is contended
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 1.0)
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join('%s="%s"' % (name, str(value).replace('"', '\\"'))
+                          for name, value in zip(names, values)) + '}'
+
+
+"""
+Family is one metric with its label names; values are kept per tuple of
+label values
+"""
+
+
+class Family(object):
+
+    type_name = 'untyped'
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.values = {}
+        self._lock = Lock()
+
+    def set(self, label_values, value):
+        with self._lock:
+            self.values[label_values] = value
+
+    def lines(self, const_names, const_values):
+        names = const_names + self.label_names
+        with self._lock:
+            values = list(self.values.items())
+        for label_values, value in values:
+            yield self.name + format_labels(
+                names, const_values + label_values) + ' ' + repr(value)
+
+
+"""
+ThreadFamily keeps the values updated by every thread in a dict of that
+thread, so updates take no lock; lines() adds them up with the values set()
+"""
+
+
+class ThreadFamily(Family):
+
+    def __init__(self, name, help_text, label_names=()):
+        Family.__init__(self, name, help_text, label_names)
+        self._local = local()
+        self._thread_values = []
+
+    def local_values(self):
+        try:
+            return self._local.values
+        except AttributeError:
+            # first update from this thread
+            values = self._local.values = {}
+            with self._lock:
+                self._thread_values.append(values)
+            return values
+
+    def totals(self):
+        with self._lock:
+            totals = dict(self.values)
+            thread_values = list(self._thread_values)
+        for values in thread_values:
+            # dict() copies in one step, while the thread may add keys
+            for label_values, value in dict(values).items():
+                totals[label_values] = self.add(totals.get(label_values),
+                                                value)
+        return totals
+
+
+class Counter(ThreadFamily):
+
+    type_name = 'counter'
+
+    def inc(self, label_values=(), amount=1):
+        values = self.local_values()
+        values[label_values] = values.get(label_values, 0) + amount
+
+    def add(self, total, value):
+        return value if total is None else total + value
+
+    def lines(self, const_names, const_values):
+        names = const_names + self.label_names
+        for label_values, value in self.totals().items():
+            yield self.name + format_labels(
+                names, const_values + label_values) + ' ' + repr(value)
+
+
+class Gauge(Family):
+
+    type_name = 'gauge'
+
+
+"""
+Summary only keeps the sum and count of the values observed, no quantiles
+"""
+
+
+class Summary(Family):
+
+    type_name = 'summary'
+
+    def set(self, label_values, value):
+        # value is (sum, count)
+        Family.set(self, label_values, tuple(value))
+
+    def lines(self, const_names, const_values):
+        names = const_names + self.label_names
+        with self._lock:
+            values = list(self.values.items())
+        for label_values, (total, count) in values:
+            labels = format_labels(names, const_values + label_values)
+            yield self.name + '_sum' + labels + ' ' + repr(total)
+            yield self.name + '_count' + labels + ' ' + repr(count)
+
+
+class Histogram(ThreadFamily):
+
+    type_name = 'histogram'
+
+    def __init__(self, name, help_text, label_names=(),
+                 buckets=LATENCY_BUCKETS):
+        ThreadFamily.__init__(self, name, help_text, label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, label_values, value):
+        values = self.local_values()
+        counts = values.get(label_values)
+        if counts is None:
+            # one count per bucket, then +Inf, sum
+            counts = values[label_values] = \
+                [0] * (len(self.buckets) + 1) + [0.0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        else:
+            counts[len(self.buckets)] += 1
+        counts[-1] += value
+
+    def add(self, total, counts):
+        counts = list(counts)
+        if total is None:
+            return counts
+        return [a + b for a, b in zip(total, counts)]
+
+    def lines(self, const_names, const_values):
+        names = const_names + self.label_names + ('le',)
+        for label_values, counts in self.totals().items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts[:-1]):
+                cumulative += count
+                yield self.name + '_bucket' + format_labels(
+                    names, const_values + label_values + (bound,)) + \
+                    ' ' + str(cumulative)
+            labels = format_labels(names[:-1], const_values + label_values)
+            yield self.name + '_sum' + labels + ' ' + repr(counts[-1])
+            yield self.name + '_count' + labels + ' ' + str(cumulative)
+
+
+"""
+Metrics holds the metric families of one PLC device
+- 'labels' are added to every sample, e.g. {'port': '5020'}
+- Collectors are called on every scrape, to copy over stats that are kept
+  somewhere else
+"""
+
+
+class Metrics(object):
+
+    def __init__(self, labels=None):
+        labels = sorted((labels or {}).items())
+        self.label_names = tuple(name for name, value in labels)
+        self.label_values = tuple(value for name, value in labels)
+        self.families = {}
+        self.collectors = []
+        self._lock = Lock()
+
+    def _family(self, family_class, name, *args, **kwargs):
+        with self._lock:
+            family = self.families.get(name)
+            if family is None:
+                family = self.families[name] = family_class(name, *args,
+                                                            **kwargs)
+        return family
+
+    def counter(self, name, help_text, label_names=()):
+        return self._family(Counter, name, help_text, label_names)
+
+    def gauge(self, name, help_text, label_names=()):
+        return self._family(Gauge, name, help_text, label_names)
+
+    def summary(self, name, help_text, label_names=()):
+        return self._family(Summary, name, help_text, label_names)
+
+    def histogram(self, name, help_text, label_names=(),
+                  buckets=LATENCY_BUCKETS):
+        return self._family(Histogram, name, help_text, label_names,
+                            buckets=buckets)
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def collect(self):
+        for collector in list(self.collectors):
+            collector()
+
+
+"""
+- @brief render() returns the text exposition of several Metrics, with the
+  HELP/TYPE header of every family written once
+"""
+
+
+def render(registries):
+    names = []
+    for metrics in registries:
+        metrics.collect()
+        for name in sorted(metrics.families):
+            if name not in names:
+                names.append(name)
+    lines = []
+    for name in names:
+        header = False
+        for metrics in registries:
+            family = metrics.families.get(name)
+            if family is None:
+                continue
+            if not header:
+                lines.append('# HELP %s %s' % (name, family.help_text))
+                lines.append('# TYPE %s %s' % (name, family.type_name))
+                header = True
+            lines.extend(family.lines(metrics.label_names,
+                                      metrics.label_values))
+    return '\n'.join(lines) + '\n'
+
+
+"""
+- @brief serve_metrics() serves metrics on http://address:port/metrics from
+  the Twisted reactor, and adds it to the endpoint if the port is already
+  served by another PLC device of this process
+"""
+
+_endpoints = {}
+
+
+def serve_metrics(metrics, port, address='127.0.0.1'):
+    if port in _endpoints:
+        _endpoints[port].append(metrics)
+        return
+    from twisted.internet import reactor
+    from twisted.web.resource import Resource
+    from twisted.web.server import Site
+
+    registries = _endpoints[port] = [metrics]
+
+    class MetricsResource(Resource):
+        isLeaf = True
+
+        def render_GET(self, request):
+            request.setHeader(b'Content-Type',
+                              b'text/plain; version=0.0.4; charset=utf-8')
+            return render(registries).encode('utf-8')
+
+    reactor.listenTCP(int(port), Site(MetricsResource()), interface=address)
+
+
+"""
+- @brief meter_tables() counts the reads and writes of every table of a slave
+  context, call it after lock_tables()
+"""
+
+
+def meter_tables(context, metrics):
+    from datablock import MeteredDataBlock
+    reads = metrics.counter('scadasim_datastore_reads_total',
+                            "Reads of a datastore table", ('table',))
+    writes = metrics.counter('scadasim_datastore_writes_total',
+                             "Writes to a datastore table", ('table',))
+    # key of the datablock in the slave context -> table name
+    tables = {'d': 'di', 'c': 'co', 'h': 'hr', 'i': 'ir'}
+    for key, block in context.store.items():
+        if not isinstance(block, MeteredDataBlock):
+            context.store[key] = MeteredDataBlock(block, (tables[key],),
+                                                  reads, writes)
+
+
+"""
+MeteredServerContext is passed to the Modbus server instead of the server
+context, so only client requests are counted per function code, and the
+time they spend in the datastore is metered
+"""
+
+
+class MeteredServerContext(object):
+
+    def __init__(self, context, metrics):
+        self.context = context
+        self.requests = metrics.counter('scadasim_requests_total',
+                                        "Modbus requests served", ('fc',))
+        # only the datastore part of a request, see metered_framer() for the
+        # latency of the whole request
+        self.latency = metrics.histogram(
+            'scadasim_request_datastore_seconds',
+            "Time Modbus requests spent reading/writing the datastore (part "
+            "of scadasim_request_seconds)", ('fc',))
+        self.slaves_metered = {}
+
+    def __getitem__(self, slave):
+        metered = self.slaves_metered.get(slave)
+        if metered is None:
+            metered = self.slaves_metered[slave] = MeteredSlaveContext(
+                self.context[slave], self.requests, self.latency)
+        return metered
+
+    def __contains__(self, slave):
+        return slave in self.context
+
+    def __getattr__(self, name):
+        return getattr(self.context, name)
+
+
+class MeteredSlaveContext(object):
+
+    def __init__(self, slave, requests, latency):
+        self.slave = slave
+        self.requests = requests
+        self.latency = latency
+
+    def validate(self, fx, address, count=1):
+        # every request validates its addresses first, once
+        self.requests.inc((fx,))
+        return self.slave.validate(fx, address, count)
+
+    def getValues(self, fx, address, count=1):
+        start = perf_counter()
+        values = self.slave.getValues(fx, address, count)
+        self.latency.observe((fx,), perf_counter() - start)
+        return values
+
+    def setValues(self, fx, address, values):
+        start = perf_counter()
+        self.slave.setValues(fx, address, values)
+        self.latency.observe((fx,), perf_counter() - start)
+
+    def __getattr__(self, name):
+        return getattr(self.slave, name)
+
+
+"""
+- @brief meter_ticks() exposes the stats the scheduler keeps for every
+  scheduled tick (see ScheduledTick in scheduler.py)
+"""
+
+
+def meter_ticks(metrics, entries):
+    ticks = metrics.counter('scadasim_behavior_ticks_total',
+                            "Ticks run by a behavior", ('behavior',))
+    lateness = metrics.summary('scadasim_behavior_lateness_seconds',
+                               "Time between the deadline of a tick and "
+                               "the time it ran", ('behavior',))
+    lateness_max = metrics.gauge('scadasim_behavior_lateness_max_seconds',
+                                 "Largest lateness of a tick",
+                                 ('behavior',))
+    skipped = metrics.counter('scadasim_behavior_skipped_ticks_total',
+                              "Ticks dropped to get a behavior back on its "
+                              "schedule", ('behavior',))
+
+    def collect():
+        for entry in entries:
+            key = (entry.name,)
+            ticks.set(key, entry.ticks)
+            lateness.set(key, (entry.lateness_total, entry.ticks))
+            lateness_max.set(key, entry.lateness_max)
+            skipped.set(key, entry.skipped)
+    metrics.add_collector(collect)
+
+
+"""
+- @brief meter_backup() exposes the stats of a backup writer (backup.py)
+"""
+
+
+def meter_backup(metrics, writer):
+    duration = metrics.summary('scadasim_backup_write_seconds',
+                               "Time spent writing backups")
+    written = metrics.counter('scadasim_backup_write_bytes_total',
+                              "Bytes written to backups")
+
+    def collect():
+        duration.set((), (writer.write_seconds, writer.writes))
+        written.set((), writer.bytes_written)
+    metrics.add_collector(collect)
+
+
+"""
+- @brief meter_history() exposes the stats of a historian (historian.py)
+"""
+
+
+def meter_history(metrics, historian):
+    samples = metrics.counter('scadasim_history_samples_total',
+                              "Samples of the datastore taken by the "
+                              "historian")
+    duration = metrics.summary('scadasim_history_write_seconds',
+                               "Time spent writing to the history database")
+
+    def collect():
+        samples.set((), historian.samples)
+        duration.set((), (historian.write_seconds, historian.writes))
+    metrics.add_collector(collect)
+
+
+"""
+- @brief meter_writes() exposes the counters of the write buffer of the
+  behaviors (write_buffer.py)
+"""
+
+
+def meter_writes(metrics, write_buffer):
+    writes = metrics.counter('scadasim_behavior_writes_total',
+                             "setValues calls by the behaviors, buffered")
+    calls = metrics.counter('scadasim_behavior_write_calls_total',
+                            "setValues calls made to write the buffered "
+                            "writes")
+    saved = metrics.counter('scadasim_behavior_write_calls_saved_total',
+                            "setValues calls saved by coalescing the writes "
+                            "of the behaviors")
+
+    def collect():
+        writes.set((), write_buffer.writes)
+        calls.set((), write_buffer.flushed_calls)
+        saved.set((), write_buffer.calls_saved())
+    metrics.add_collector(collect)
+
+
+"""
+- @brief metered_framer() returns a subclass of a pymodbus framer class that
+  meters the latency of every request it decodes, per function code: from
+  the data being received to the response being written to the transport
+  (the server executes the request and encodes the response from the
+  framer's callback)
+- Requests arriving in the same packet are timed one after the other
+"""
+
+
+def metered_framer(framer, metrics):
+    latency = metrics.histogram(
+        'scadasim_request_seconds',
+        "Time from receiving a Modbus request to writing its response "
+        "(decode, validate, datastore and encode)", ('fc',))
+
+    class MeteredFramer(framer):
+
+        def processIncomingPacket(self, data, callback, *args, **kwargs):
+            start = [perf_counter()]
+
+            def execute(request):
+                callback(request)
+                end = perf_counter()
+                latency.observe((request.function_code,), end - start[0])
+                start[0] = end
+            return framer.processIncomingPacket(self, data, execute, *args,
+                                                **kwargs)
+
+    MeteredFramer.__name__ = 'Metered' + framer.__name__
+    return MeteredFramer
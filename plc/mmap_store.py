@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+"""
+Fixed-layout binary backup file for the datastore of a PLC device, used
+through mmap when the BACKUP section has 'format: mmap'.
+
+- Layout (native byte order):
+    - header: magic 'SCDB', version (u16), number of tables (u16)
+    - one descriptor per table: name (2 bytes), 2 pad bytes,
+      start_addr (u32), count (u32), byte offset of the values (u32)
+    - the values of every table, one u16 per register/coil
+- The datablocks in datablock.py read and write the mapped values directly,
+  so every write is persisted without any serialization, and a restart maps
+  the file instead of parsing YAML
+- Other tools can read live values without going over Modbus:
+    python mmap_store.py ../backups/backup_0.bin
+- Only depends on the standard library, so it can be used on its own
+"""
+import os
+import mmap
+import struct
+import sys
+
+MAGIC = b'SCDB'
+VERSION = 1
+HEADER = struct.Struct('=4sHH')
+DESCRIPTOR = struct.Struct('=2sxxIII')
+TABLES = ('di', 'co', 'hr', 'ir')
+REGISTER_SIZE = 2
+
+
+def mmap_filename(backup_filename):
+    # backup_N.bin, next to backup_N.yaml
+    return os.path.splitext(backup_filename)[0] + '.bin'
+
+
+"""
+- @brief create_mmap_file() writes a new file laid out for datastore_config,
+  the DATASTORE section of a backup/master config, with its initial values
+"""
+
+
+def create_mmap_file(filename, datastore_config):
+    offset = HEADER.size + DESCRIPTOR.size * len(TABLES)
+    header = HEADER.pack(MAGIC, VERSION, len(TABLES))
+    descriptors = b''
+    data = b''
+    for table in TABLES:
+        values = [min(max(int(v), 0), 0xFFFF)
+                  for v in datastore_config[table]['values']]
+        descriptors += DESCRIPTOR.pack(table.encode('ascii'),
+                                       datastore_config[table]['start_addr'],
+                                       len(values), offset + len(data))
+        data += struct.pack('=%dH' % len(values), *values)
+    with open(filename, 'wb') as mmap_file:
+        mmap_file.write(header + descriptors + data)
+
+
+"""
+- @brief layout() returns {table: (start_addr, count)} of the DATASTORE
+  section of a backup/master config, to compare with MmapFile.layout()
+"""
+
+
+def layout(datastore_config):
+    return dict((table, (datastore_config[table]['start_addr'],
+                         len(datastore_config[table]['values'])))
+                for table in TABLES)
+
+
+class MmapFile(object):
+
+    def __init__(self, filename, writable=True):
+        self.filename = filename
+        with open(filename, 'r+b' if writable else 'rb') as mmap_file:
+            access = mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ
+            self.mmap = mmap.mmap(mmap_file.fileno(), 0, access=access)
+        magic, version, num_tables = HEADER.unpack_from(self.mmap, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(filename + " is not a datastore mmap file")
+        # table name -> (start_addr, count, offset)
+        self.tables = {}
+        for i in range(num_tables):
+            name, start_addr, count, offset = DESCRIPTOR.unpack_from(
+                self.mmap, HEADER.size + DESCRIPTOR.size * i)
+            self.tables[name.decode('ascii')] = (start_addr, count, offset)
+
+    """
+    - @brief region() returns the values of a table as a memoryview of u16,
+      backed directly by the mapped file
+    """
+
+    def region(self, table):
+        start_addr, count, offset = self.tables[table]
+        view = memoryview(self.mmap)[offset:offset + count * REGISTER_SIZE]
+        return view.cast('H')
+
+    def layout(self):
+        return dict((table, (start_addr, count)) for table, (
+            start_addr, count, offset) in self.tables.items())
+
+    def flush(self):
+        self.mmap.flush()
+
+    def close(self):
+        self.mmap.close()
+
+
+"""
+- @brief read_mmap_file() returns a DATASTORE style dict with the current
+  values of every table
+"""
+
+
+def read_mmap_file(filename):
+    mmap_file = MmapFile(filename, writable=False)
+    datastore_config = {}
+    for table in TABLES:
+        start_addr = mmap_file.tables[table][0]
+        datastore_config[table] = {'start_addr': start_addr,
+                                   'values': mmap_file.region(table).tolist()}
+    return datastore_config
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("Usage: python mmap_store.py <backup_N.bin>")
+        sys.exit(1)
+    for table, config in sorted(read_mmap_file(sys.argv[1]).items()):
+        print(table + ' ' + str(config['start_addr']) + ': ' +
+              ' '.join(str(v) for v in config['values']))
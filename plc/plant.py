@@ -0,0 +1,366 @@
+#!/usr/bin/env python
+
+"""
+Process model of a plant (tanks, pumps and valves), stepped as one system
+of difference equations per tick instead of a behavior per register, set up
+from the PLANT section of a PLC config:
+
+    PLANT:
+      time: 1             # seconds between ticks
+      steps: 10           # difference steps per tick
+      tanks:
+        settling: {area: 20, max_level: 1.5, level_register: hr/0,
+                   scale: 100, low_switch: di/0, low_level: 0.2,
+                   high_switch: di/1, high_level: 1.4}
+      pumps:
+        intake: {to: settling, flow: 0.05, run: co/0,
+                 flow_register: ir/0, flow_scale: 1000, status: di/2}
+      valves:
+        outlet: {from: settling, cv: 0.03, open: hr/1,
+                 flow_register: ir/1, flow_scale: 1000}
+
+- Levels are in m, areas in m2 and flows in m3/s
+- A pump moves 'flow' from its 'from' tank to its 'to' tank; without 'from'
+  it draws from an unlimited supply, without 'to' the water leaves the plant
+- A valve lets cv * opening * sqrt(head) through, driven by the difference
+  of the levels of its tanks (a tank upstream is needed)
+- 'run'/'open' are a coil ('co/N', on or off), a register ('hr/N', a
+  percentage), a register of another PLC device ('PLC 2/co/5', see
+  references.py) or a fixed opening from 0 to 1
+- Outputs (written every tick, rounded and multiplied by their scale): the
+  level of a tank to 'level_register', low/high level switches, the mean
+  flow of a pump/valve over the tick to 'flow_register' and whether a pump
+  is moving water to 'status'
+- A tank never gives more water than it holds, and spills above max_level
+- The level of a tank is read back from its level_register on start, so it
+  carries over restarts with the backup; 'level' is the start level of
+  tanks without one
+- Registers driven by the plant should not have behaviors of their own
+- Needs NumPy; master.py rejects a PLANT section without it
+"""
+import re
+from datastore import *
+from references import RemoteRegister, parse_reference
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+ADDRESS = re.compile(r'^(co|di|hr|ir)/(\d+)$')
+FUNCTION_CODES = {'co': 1, 'di': 2, 'hr': 3, 'ir': 4}
+# (component section, key of the address, kind) of every output
+OUTPUTS = (('tanks', 'level_register', 'level'),
+           ('tanks', 'low_switch', 'low'),
+           ('tanks', 'high_switch', 'high'),
+           ('pumps', 'flow_register', 'flow'),
+           ('pumps', 'status', 'status'),
+           ('valves', 'flow_register', 'flow'))
+
+
+def parse_address(value):
+    match = ADDRESS.match(str(value).strip())
+    if match is None:
+        raise ValueError("'%s' is not a table/address ('hr/0')" % (value,))
+    return match.group(1), int(match.group(2))
+
+
+"""
+- @brief parse_input() returns ('constant', opening), ('local', (table,
+  address)) or ('remote', reference) for a 'run'/'open' value
+"""
+
+
+def parse_input(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return 'constant', float(value)
+    if parse_reference_or_none(value) is not None:
+        return 'remote', value
+    return 'local', parse_address(value)
+
+
+def parse_reference_or_none(value):
+    try:
+        return parse_reference(value)
+    except ValueError:
+        return None
+
+
+"""
+- @brief check_plant() raises ValueError for the first problem of a PLANT
+  section; returns the references to other PLC devices it reads
+"""
+
+
+def check_plant(plant_config, config_list):
+    if np is None:
+        raise ValueError("PLANT needs NumPy, which is not installed")
+    tanks = plant_config.get('tanks') or {}
+    references = []
+
+    def check_address(name, key, value):
+        table, address = parse_address(value)
+        table_config = config_list['DATASTORE'][table]
+        index = address + 1 - table_config.get('start_addr', 1)
+        if not 0 <= index < len(table_config['values']):
+            raise ValueError("PLANT %s '%s' is %s address %d, the table has "
+                             "%d" % (name, key, table, address,
+                                     len(table_config['values'])))
+
+    for name, tank in tanks.items():
+        for key in ('area', 'max_level'):
+            if float(tank.get(key, 0)) <= 0:
+                raise ValueError("PLANT tank %s '%s' must be above 0" % (
+                    name, key))
+    for section, amount, command in (('pumps', 'flow', 'run'),
+                                     ('valves', 'cv', 'open')):
+        for name, component in (plant_config.get(section) or {}).items():
+            for key in (amount, command):
+                if key not in component:
+                    raise ValueError("PLANT %s %s has no '%s'" % (
+                        section[:-1], name, key))
+            for key in ('from', 'to'):
+                if component.get(key) is not None and \
+                        component[key] not in tanks:
+                    raise ValueError("PLANT %s %s '%s' is not a tank: %s" % (
+                        section[:-1], name, key, component[key]))
+            if section == 'valves' and component.get('from') is None:
+                raise ValueError("PLANT valve %s has no 'from' tank" % name)
+            kind, value = parse_input(component[command])
+            if kind == 'local':
+                check_address(section[:-1] + ' ' + name, command,
+                              component[command])
+            elif kind == 'remote':
+                references.append(('PLANT %s %s' % (section[:-1], name),
+                                   command, parse_reference(value)))
+    for section, key, kind in OUTPUTS:
+        for name, component in (plant_config.get(section) or {}).items():
+            if component.get(key) is not None:
+                check_address(section[:-1] + ' ' + name, key, component[key])
+    return references
+
+
+"""
+Outputs maps the tank levels, flows and switches of a plant onto the
+registers/coils they are written to
+"""
+
+
+class Outputs(object):
+
+    def __init__(self):
+        self.tables = []
+        self.addresses = []
+        self.kinds = []
+        self.indexes = []
+        self.params = []
+
+    def add(self, table, address, kind, index, param):
+        self.tables.append(table)
+        self.addresses.append(address)
+        self.kinds.append(kind)
+        self.indexes.append(index)
+        self.params.append(param)
+
+    def compile(self):
+        kinds = np.array(self.kinds, dtype=object)
+        self.groups = []
+        for kind in ('level', 'low', 'high', 'flow', 'status'):
+            lanes = np.flatnonzero(kinds == kind)
+            if len(lanes):
+                self.groups.append((kind, lanes,
+                                    np.array(self.indexes)[lanes],
+                                    np.array(self.params,
+                                             dtype=np.float64)[lanes]))
+        # per table: (first address, positions in the value vector) of every
+        # contiguous run of addresses - one setValues per run
+        self.runs = {}
+        tables = np.array(self.tables, dtype=object)
+        addresses = np.array(self.addresses, dtype=np.int64)
+        for table in set(self.tables):
+            lanes = np.flatnonzero(tables == table)
+            lanes = lanes[np.argsort(addresses[lanes], kind='stable')]
+            breaks = np.flatnonzero(np.diff(addresses[lanes]) != 1) + 1
+            self.runs[table] = [(int(addresses[run[0]]), run)
+                                for run in np.split(lanes, breaks)]
+
+    def values(self, level, flow):
+        values = np.zeros(len(self.tables), dtype=np.int64)
+        for kind, lanes, indexes, params in self.groups:
+            if kind == 'level':
+                values[lanes] = np.rint(level[indexes] * params)
+            elif kind == 'flow':
+                values[lanes] = np.rint(flow[indexes] * params)
+            elif kind == 'low':
+                values[lanes] = level[indexes] <= params
+            elif kind == 'high':
+                values[lanes] = level[indexes] >= params
+            else:
+                values[lanes] = flow[indexes] > 0
+        return np.clip(values, 0, 0xFFFF)
+
+    def write(self, context, values):
+        for table, runs in self.runs.items():
+            fx = FUNCTION_CODES[table]
+            for address, run in runs:
+                run_values = values[run].tolist()
+                if fx in (1, 2):
+                    run_values = [bool(value) for value in run_values]
+                context.setValues(fx, address, run_values)
+
+
+class Plant(object):
+
+    def __init__(self, context, config, log):
+        self.context = context
+        self.log = log.getChild('plant')
+        self.period = config.get('time', 1)
+        self.policy = config.get('policy', 'skip')
+        self.steps = max(int(config.get('steps', 10)), 1)
+        tanks = config.get('tanks') or {}
+        index = dict((name, i) for i, name in enumerate(tanks))
+        # pumps, then valves
+        components = [(section, name, component)
+                      for section in ('pumps', 'valves')
+                      for name, component in (config.get(section) or
+                                              {}).items()]
+        outside = len(tanks)
+        self.area = np.array([float(tank['area']) for tank in
+                              tanks.values()])
+        self.max_level = np.array([float(tank['max_level']) for tank in
+                                   tanks.values()])
+        self.level = np.array([float(tank.get('level', 0)) for tank in
+                               tanks.values()])
+        # outside the plant is one more 'tank', at level 0
+        self.src = np.array([index.get(c.get('from'), outside)
+                             for s, n, c in components], dtype=np.int64)
+        self.dst = np.array([index.get(c.get('to'), outside)
+                             for s, n, c in components], dtype=np.int64)
+        self.is_valve = np.array([s == 'valves' for s, n, c in components],
+                                 dtype=bool)
+        self.rate = np.array([float(c['flow'] if s == 'pumps' else c['cv'])
+                              for s, n, c in components])
+        self.flow = np.zeros(len(components))
+        self.compile_inputs([c['run'] if s == 'pumps' else c['open']
+                             for s, n, c in components])
+
+        self.outputs = Outputs()
+        for i, tank in enumerate(tanks.values()):
+            self.add_output(tank, 'level_register', 'level', i,
+                            tank.get('scale', 1))
+            self.add_output(tank, 'low_switch', 'low', i,
+                            tank.get('low_level', 0))
+            self.add_output(tank, 'high_switch', 'high', i,
+                            tank.get('high_level', tank['max_level']))
+        for i, (section, name, component) in enumerate(components):
+            self.add_output(component, 'flow_register', 'flow', i,
+                            component.get('flow_scale', 1))
+            if section == 'pumps':
+                self.add_output(component, 'status', 'status', i, 0)
+        self.outputs.compile()
+
+        # levels carry over restarts through the level registers
+        for i, tank in enumerate(tanks.values()):
+            if tank.get('level_register') is not None:
+                table, address = parse_address(tank['level_register'])
+                value = self.context[0].getValues(FUNCTION_CODES[table],
+                                                  address, 1)[0]
+                self.level[i] = float(value) / tank.get('scale', 1)
+        self.fxs = tuple(set(FUNCTION_CODES[table] for table in
+                             list(self.outputs.runs) + list(self.reads)))
+
+    def add_output(self, component, key, kind, index, param):
+        if component.get(key) is not None:
+            table, address = parse_address(component[key])
+            self.outputs.add(table, address, kind, index, param)
+
+    """
+    - @brief compile_inputs() splits the 'run'/'open' inputs into constants,
+      one read per table of this PLC device, and references to registers of
+      other PLC devices
+    """
+
+    def compile_inputs(self, inputs):
+        self.constant = np.zeros(len(inputs))
+        self.remote = []
+        local = {}
+        for i, value in enumerate(inputs):
+            kind, value = parse_input(value)
+            if kind == 'constant':
+                self.constant[i] = value
+            elif kind == 'remote':
+                self.remote.append((i, RemoteRegister(value, self.log),
+                                    parse_reference(value)[1]))
+            else:
+                local.setdefault(value[0], []).append((i, value[1]))
+        # table -> (first address, count, component lanes, offsets)
+        self.reads = {}
+        for table, lanes in local.items():
+            addresses = np.array([address for i, address in lanes])
+            lo = int(addresses.min())
+            self.reads[table] = (lo, int(addresses.max()) + 1 - lo,
+                                 np.array([i for i, address in lanes]),
+                                 addresses - lo)
+
+    def read_inputs(self):
+        opening = self.constant.copy()
+        slave = self.context[0]
+        for table, (lo, count, lanes, offsets) in self.reads.items():
+            values = np.array(slave.getValues(FUNCTION_CODES[table], lo,
+                                              count), dtype=np.float64)
+            opening[lanes] = input_opening(table, values[offsets])
+        for i, remote, table in self.remote:
+            value = remote.read()
+            opening[i] = 0 if value is None else \
+                input_opening(table, float(value))
+        return opening
+
+    """
+    - @brief step() advances the plant by dt seconds with the opening of
+      every pump/valve, and returns the flows of the step
+    """
+
+    def step(self, dt, opening):
+        level = np.append(self.level, 0.0)
+        head = np.maximum(level[self.src] - level[self.dst], 0)
+        flow = self.rate * opening
+        flow = np.where(self.is_valve, flow * np.sqrt(head), flow)
+        # a tank can not give more than it holds
+        outside = len(self.level)
+        out = np.bincount(self.src, weights=flow,
+                          minlength=outside + 1)[:outside] * dt
+        volume = self.level * self.area
+        limit = np.ones(outside + 1)
+        short = out > volume
+        limit[:outside][short] = volume[short] / out[short]
+        flow = flow * limit[self.src]
+        net = np.bincount(self.dst, weights=flow, minlength=outside + 1) - \
+            np.bincount(self.src, weights=flow, minlength=outside + 1)
+        # spill above max_level
+        self.level = np.clip(self.level + dt * net[:outside] / self.area, 0,
+                             self.max_level)
+        return flow
+
+    def tick(self):
+        slave = self.context[0]
+        dt = float(self.period) / self.steps
+        with transaction(slave, *self.fxs):
+            opening = np.clip(self.read_inputs(), 0, 1)
+            flow = np.zeros(len(self.rate))
+            for _ in range(self.steps):
+                flow += self.step(dt, opening)
+            self.flow = flow / self.steps
+            values = self.outputs.values(self.level, self.flow)
+            self.outputs.write(slave, values)
+        self.log.debug(values)
+
+    def schedule(self, scheduler):
+        return scheduler.add(self.tick, self.period, name='plant',
+                             policy=self.policy)
+
+
+def input_opening(table, values):
+    # coils/discrete inputs are on or off, registers a percentage
+    if table in ('co', 'di'):
+        return (values != 0) * 1.0
+    return values / 100.0
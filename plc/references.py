@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+"""
+References to the registers of other PLC devices, so a behavior can follow
+another PLC device (a pump PLC device reacting to the valve coil of a tank
+PLC device) without a Modbus client in between:
+
+    behavior_1: {type: linear_coil_dependent, coil_address: 'PLC 2/co/5',
+                 variance: 1, max: 100, default_coil_value: 1, ...}
+
+- 'PLC N/table/address': table is co, di, hr or ir, and address is counted
+  like a local coil_address
+- PLC devices hosted by the same process (async_plc.py --range/--all) read
+  each other's slave contexts directly
+- Otherwise the backup_N.bin of the other PLC device (BACKUP 'format: mmap')
+  is mapped read-only; its MmapDataBlocks write to the same pages, so a read
+  is an index into shared memory instead of a Modbus request
+- check_reference() in config_cache.py only lets a reference through to a
+  PLC device with an mmap backup, unless MASTER has 'host_mode: true' (every
+  PLC device in one process)
+- A backup_N.bin is only mapped if the other PLC device's config has
+  'format: mmap' and the tables of the file match its config, so a file
+  left over from an earlier run is not read as live values
+- A reference that can not be resolved yet (the other PLC device has not
+  started, or its backup_N.bin is missing or stale) reads None and is
+  resolved again on the next read
+"""
+import os
+import re
+
+REFERENCE = re.compile(r'^PLC (\d+)/(co|di|hr|ir)/(\d+)$')
+FUNCTION_CODES = {'co': 1, 'di': 2, 'hr': 3, 'ir': 4}
+
+# PLC number -> slave context, of the PLC devices of this process
+_contexts = {}
+# PLC number (str) -> backup filename / PLC config, see
+# set_backup_filenames()
+_backup_filename_for = None
+_plc_config_for = None
+
+
+"""
+- @brief parse_reference() returns (PLC number, table, address) for a
+  reference, or None for a plain (local) address
+- Raises ValueError for a string that is not a reference
+"""
+
+
+def parse_reference(value):
+    if not isinstance(value, str):
+        return None
+    match = REFERENCE.match(value.strip())
+    if match is None:
+        raise ValueError("'%s' is not a register reference "
+                         "('PLC N/table/address')" % value)
+    return int(match.group(1)), match.group(2), int(match.group(3))
+
+
+def register_plc(num_of_PLC, context):
+    _contexts[int(num_of_PLC)] = context[0]
+
+
+def set_backup_filenames(backup_filename_for, plc_config_for=None):
+    global _backup_filename_for, _plc_config_for
+    _backup_filename_for = backup_filename_for
+    _plc_config_for = plc_config_for
+
+
+"""
+RemoteRegister reads one register/coil of another PLC device
+- read() returns the current value, or None while it can not be resolved
+"""
+
+
+class RemoteRegister(object):
+
+    __slots__ = ('reference', 'num_of_PLC', 'table', 'address', 'read',
+                 'log', 'warned', 'stale')
+
+    def __init__(self, reference, log):
+        self.reference = reference
+        self.num_of_PLC, self.table, self.address = parse_reference(reference)
+        self.log = log
+        self.warned = False
+        # modification time of a stale backup_N.bin, not mapped again until
+        # it changes
+        self.stale = None
+        # replaced by a direct reader once resolved
+        self.read = self.resolve
+
+    def resolve(self):
+        slave = _contexts.get(self.num_of_PLC)
+        if slave is not None:
+            # the datablock itself, as ModbusSlaveContext.getValues would
+            block = slave.store[slave.decode(FUNCTION_CODES[self.table])]
+            address = self.address if slave.zero_mode else self.address + 1
+            self.read = lambda: block.getValues(address, 1)[0]
+            return self.read()
+        mapped = self.map_region()
+        if mapped is None:
+            if not self.warned:
+                self.warned = True
+                self.log.warning("%s is not hosted by this process and has "
+                                 "no mmap backup (yet)", self.reference)
+            return None
+        region, index = mapped
+        self.read = lambda: region[index]
+        return self.read()
+
+    def map_region(self):
+        if _backup_filename_for is None:
+            return None
+        from mmap_store import MmapFile, mmap_filename, layout
+        config = None
+        if _plc_config_for is not None:
+            config = _plc_config_for(str(self.num_of_PLC))
+            if config.get('BACKUP', {}).get('format', 'yaml') != 'mmap':
+                return None
+        filename = mmap_filename(_backup_filename_for(str(self.num_of_PLC)))
+        if not os.path.exists(filename):
+            return None
+        mtime = os.stat(filename).st_mtime
+        if mtime == self.stale:
+            return None
+        mmap_file = MmapFile(filename, writable=False)
+        if config is not None and \
+                mmap_file.layout() != layout(config['DATASTORE']):
+            # left from an earlier run, rebuilt once the PLC device starts
+            mmap_file.close()
+            if self.stale is None:
+                self.log.warning("%s: %s does not match the config of PLC %d,"
+                                 " waiting for it to be rebuilt",
+                                 self.reference, filename, self.num_of_PLC)
+            self.stale = mtime
+            return None
+        start_addr, count, offset = mmap_file.tables[self.table]
+        # addresses are 0 based, like the slave contexts (not zero_mode)
+        index = self.address + 1 - start_addr
+        if not 0 <= index < count:
+            raise ValueError("%s is out of range of %s" % (self.reference,
+                                                           filename))
+        return mmap_file.region(self.table), index
@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+
+"""
+Scheduler used to run the register behaviors of a PLC device.
+
+- Every behavior is reduced to a "tick" callable that does one unit of work
+  and returns the number of seconds until it wants to run again, or None to
+  run again after its configured period
+- All ticks are kept in one deadline heap and run from a single worker, so
+  the number of threads stays the same no matter how many behaviors the
+  master config defines
+- Deadlines are in simulated time, kept by a clock from clock.py, so the
+  behaviors can run faster than real time
+- Deadlines are absolute: the next deadline of a tick is its last deadline
+  plus its delay, not the time the tick finished plus its delay, so the time
+  spent running ticks does not make the periods drift
+- A tick that fell behind by a full delay or more follows its policy:
+    - 'skip' (default): the missed ticks are dropped, and it runs once, on
+      the last missed deadline, to get back on its schedule
+    - 'catch_up': every missed tick is run, back to back
+- Flush callbacks (add_flush, used by write_buffer.py) run once the ticks of
+  a deadline have run, so a scheduler that is behind still flushes
+"""
+import heapq
+import itertools
+from threading import Event, Lock, Thread
+from clock import SimClock
+
+
+POLICIES = ('skip', 'catch_up')
+
+
+"""
+ScheduledTick is a tick added to a scheduler, with the stats kept for it
+- Lateness is how many (simulated) seconds after its deadline a tick ran
+- Skipped is the number of ticks dropped by the 'skip' policy
+"""
+
+
+class ScheduledTick(object):
+
+    __slots__ = ('tick', 'period', 'name', 'policy', 'ticks',
+                 'lateness_total', 'lateness_max', 'skipped')
+
+    def __init__(self, tick, period, name, policy='skip'):
+        if policy not in POLICIES:
+            raise ValueError("Unknown policy '%s' for %s" % (policy, name))
+        self.tick = tick
+        self.period = period
+        self.name = name
+        self.policy = policy
+        self.ticks = 0
+        self.lateness_total = 0.0
+        self.lateness_max = 0.0
+        self.skipped = 0
+
+    """
+    - @brief run() runs the tick due at 'deadline' and returns the deadline
+      of the next one
+    """
+
+    def run(self, deadline, clock):
+        lateness = clock.now() - deadline
+        self.ticks += 1
+        self.lateness_total += lateness
+        if lateness > self.lateness_max:
+            self.lateness_max = lateness
+        delay = self.tick()
+        if delay is None:
+            delay = self.period
+        next_deadline = deadline + delay
+        if self.policy == 'skip' and delay > 0:
+            behind = clock.now() - next_deadline
+            if behind >= delay:
+                missed = int(behind // delay)
+                next_deadline += missed * delay
+                self.skipped += missed
+        return next_deadline
+
+
+class BehaviorScheduler(object):
+
+    def __init__(self, log, clock=None):
+        self.log = log
+        self.clock = SimClock() if clock is None else clock
+        self._heap = []
+        self._counter = itertools.count()
+        self._lock = Lock()
+        self._wakeup = Event()
+        self._stopped = Event()
+        self._flushes = []
+        self._ran = False
+        # deadline of the ticks run since the last flush
+        self._batch = None
+
+    """
+    - @brief add() schedules a tick to run every 'period' seconds
+    - The first run happens after 'delay' seconds (defaults to 'period'),
+      matching the old sleep-then-work loops of the behavior threads
+    - 'policy' is what to do with the ticks it falls behind on
+    - Returns the ScheduledTick, which keeps the stats of the tick
+    """
+
+    def add(self, tick, period, name='behavior', delay=None, policy='skip'):
+        if delay is None:
+            delay = period
+        entry = ScheduledTick(tick, period, name, policy)
+        with self._lock:
+            heapq.heappush(self._heap, (self.clock.now() + delay,
+                                        next(self._counter), entry))
+        self._wakeup.set()
+        return entry
+
+    def add_flush(self, flush):
+        self._flushes.append(flush)
+
+    def _flush(self):
+        if not self._ran:
+            return
+        self._ran = False
+        for flush in self._flushes:
+            try:
+                flush()
+            except Exception:
+                self.log.exception("Flush of the behaviors' writes failed")
+
+    """
+    - @brief run() pops due ticks off the heap until stop() is called, or
+      until the simulated time 'until' if it is given
+    - A tick that raises is logged and dropped, the same as a behavior
+      thread exiting on error used to be
+    """
+
+    def run(self, until=None):
+        clock = self.clock
+        while not self._stopped.is_set():
+            self._wakeup.clear()
+            with self._lock:
+                deadline = self._heap[0][0] if self._heap else None
+            if deadline is None or deadline > clock.now() or \
+                    deadline != self._batch:
+                # every tick due so far has run, or every tick of the last
+                # deadline (a scheduler that is behind still flushes)
+                self._flush()
+            if until is not None and (deadline is None or deadline > until):
+                # nothing else is due before the end of the run
+                timeout = clock.wall_seconds(until - clock.now())
+                if timeout > 0:
+                    self._wakeup.wait(timeout)
+                    continue
+                clock.advance(until)
+                return
+            if deadline is None:
+                self._wakeup.wait()
+                continue
+            timeout = clock.wall_seconds(deadline - clock.now())
+            if timeout > 0:
+                self._wakeup.wait(timeout)
+                continue
+
+            clock.advance(deadline)
+            with self._lock:
+                deadline, seq, entry = heapq.heappop(self._heap)
+            self._ran = True
+            self._batch = deadline
+            try:
+                deadline = entry.run(deadline, clock)
+            except Exception:
+                self.log.exception("Behavior " + entry.name + " stopped")
+                continue
+            with self._lock:
+                heapq.heappush(self._heap, (deadline, seq, entry))
+        self._flush()
+
+    def start(self):
+        thread = Thread(target=self.run, name='behavior-scheduler')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._heap)
+
+
+"""
+ReactorScheduler has the same add() interface as BehaviorScheduler, but runs
+every tick on the Twisted reactor that serves the Modbus requests
+- Ticks and request handling share one loop, so there are no behavior threads
+  and every read served sees a fully applied tick
+- add() must be called from the reactor thread, or before the reactor runs
+- The clock can speed the ticks up, but not run them in the discrete mode:
+  the reactor has to keep serving requests in real time
+"""
+
+
+class ReactorScheduler(object):
+
+    def __init__(self, log, reactor=None, clock=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        if clock is not None and clock.discrete:
+            raise ValueError("the reactor can not run a discrete clock")
+        self.log = log
+        self.reactor = reactor
+        self.clock = SimClock() if clock is None else clock
+        self._counter = itertools.count()
+        self._calls = {}
+        self._flushes = []
+        self._flush_call = None
+
+    def add(self, tick, period, name='behavior', delay=None, policy='skip'):
+        if delay is None:
+            delay = period
+        entry = ScheduledTick(tick, period, name, policy)
+        self._call_at(self.clock.now() + delay, next(self._counter), entry)
+        return entry
+
+    def _call_at(self, deadline, seq, entry):
+        delay = max(self.clock.wall_seconds(deadline - self.clock.now()), 0)
+        self._calls[seq] = self.reactor.callLater(delay, self._run, seq,
+                                                  entry, deadline)
+
+    def add_flush(self, flush):
+        self._flushes.append(flush)
+
+    def _flush(self):
+        self._flush_call = None
+        for flush in self._flushes:
+            try:
+                flush()
+            except Exception:
+                self.log.exception("Flush of the behaviors' writes failed")
+
+    def _run(self, seq, entry, deadline):
+        del self._calls[seq]
+        if self._flushes and self._flush_call is None:
+            # after the other ticks due now, in the next reactor iteration
+            self._flush_call = self.reactor.callLater(0, self._flush)
+        try:
+            deadline = entry.run(deadline, self.clock)
+        except Exception:
+            self.log.exception("Behavior " + entry.name + " stopped")
+            return
+        self._call_at(deadline, seq, entry)
+
+    def start(self):
+        # nothing to start - the ticks run once the reactor runs
+        return None
+
+    def stop(self):
+        for call in list(self._calls.values()):
+            if call.active():
+                call.cancel()
+        self._calls.clear()
+        if self._flush_call is not None and self._flush_call.active():
+            self._flush_call.cancel()
+            self._flush()
+
+    def __len__(self):
+        return len(self._calls)
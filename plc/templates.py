@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+"""
+Templates in the master config, for plants with many PLC devices of a kind.
+
+    TEMPLATES:
+      pump_station:              # a PLC config, like a 'PLC N' section
+        DATASTORE: ...
+        LOGGING: {file: '/var/log/scadasim/logging_{n}.log', ...}
+        SERVER: {type: tcp, framer: TCP, address: 0.0.0.0, port: 5020}
+    PLC_GROUPS:
+    - template: pump_station
+      plcs: 0-1999               # PLC numbers of the group, inclusive
+      vary:                      # i is the index of the PLC in the group
+        SERVER.port: {start: 5020, step: 1}           # 5020 + i
+        SERVER.address: {start: 10.0.0.1, step: 1}    # IPv4 addresses too
+        DATASTORE.hr.values.0: {start: 100, step: 5}  # list items by index
+        DATASTORE.hr.behavior_1.type: [linear, random] # cycled through
+      overrides:                 # merged into single PLC devices
+        17: {SERVER: {port: 6000}}
+
+- In the strings of a template, {n} is replaced by the PLC number and {i}
+  by its index in the group
+- 'PLC N' sections written out in full still work, and win over groups
+- get_plc_config() expands one PLC device at a time, so a master config of
+  thousands of PLC devices is never expanded all at once
+"""
+import pickle
+import ipaddress
+
+
+def parse_plcs(plcs):
+    if isinstance(plcs, int):
+        return plcs, plcs
+    first, last = [int(n) for n in str(plcs).split('-')]
+    return first, last
+
+
+"""
+- @brief find_group() returns the PLC_GROUPS entry with PLC number num and
+  the index of the PLC in it, or (None, None)
+"""
+
+
+def find_group(master_config, num):
+    for group in master_config.get('PLC_GROUPS') or []:
+        first, last = parse_plcs(group['plcs'])
+        if first <= num <= last:
+            return group, num - first
+    return None, None
+
+
+def varied_value(spec, i):
+    if isinstance(spec, list):
+        return spec[i % len(spec)]
+    if isinstance(spec, dict):
+        start, step = spec['start'], spec.get('step', 1)
+        if isinstance(start, str):
+            return str(ipaddress.ip_address(start) + i * step)
+        return start + i * step
+    return spec
+
+
+def set_path(config, dotted_path, value):
+    keys = dotted_path.split('.')
+    for key in keys[:-1]:
+        config = config[int(key) if isinstance(config, list) else key]
+    last = keys[-1]
+    config[int(last) if isinstance(config, list) else last] = value
+
+
+def merge(config, override):
+    for key, value in override.items():
+        if isinstance(value, dict) and isinstance(config.get(key), dict):
+            merge(config[key], value)
+        else:
+            config[key] = value
+
+
+def substitute(config, n, i):
+    if isinstance(config, dict):
+        for key, value in config.items():
+            config[key] = substitute(value, n, i)
+    elif isinstance(config, list):
+        for index, value in enumerate(config):
+            config[index] = substitute(value, n, i)
+    elif isinstance(config, str) and '{' in config:
+        return config.replace('{n}', str(n)).replace('{i}', str(i))
+    return config
+
+
+"""
+- @brief expand_plc() builds the config of PLC device num from its group
+"""
+
+
+def expand_plc(master_config, group, num, i):
+    template = master_config['TEMPLATES'][group['template']]
+    # a pickle round trip is a much faster deep copy than copy.deepcopy
+    config_list = pickle.loads(pickle.dumps(template,
+                                            pickle.HIGHEST_PROTOCOL))
+    substitute(config_list, num, i)
+    for dotted_path, spec in (group.get('vary') or {}).items():
+        set_path(config_list, dotted_path, varied_value(spec, i))
+    overrides = group.get('overrides') or {}
+    override = overrides.get(num, overrides.get(str(num)))
+    if override is not None:
+        merge(config_list, override)
+    return config_list
+
+
+"""
+- @brief get_plc_config() returns the config of PLC device num, written out
+  in full as 'PLC N' or expanded from PLC_GROUPS
+- Raises KeyError if the master config has neither
+"""
+
+
+def get_plc_config(master_config, num):
+    name = 'PLC ' + str(num)
+    if name in master_config:
+        return master_config[name]
+    group, i = find_group(master_config, int(num))
+    if group is None:
+        raise KeyError(name + " is not in the master config")
+    return expand_plc(master_config, group, int(num), i)
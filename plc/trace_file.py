@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+
+"""
+Columnar trace files of register values over time, for the 'replay'
+behavior.
+
+- Layout (native byte order):
+    - header: magic 'SCTR', version (u16), number of columns (u16), rows per
+      chunk (u32), number of chunks (u32), byte offset of the index (u64)
+    - one descriptor per column: table (2 bytes), 2 pad bytes, address (u32)
+    - the chunks: for every chunk the times (f64 seconds since the start of
+      the trace) and then every column (u16 per row, as the difference to
+      the row before), each zlib compressed on its own
+    - the index: per chunk the number of rows, the first and last time, and
+      the byte offset and compressed size of the times and of every column
+- Values change little from row to row, so the differences compress well
+- TraceReader maps the file with mmap and only decompresses the columns it
+  is asked for, one chunk at a time, so a trace is never loaded whole
+- Trace files are written by TraceWriter, from a running plant with
+  'python trace_file.py record ...' or from a CSV file with
+  'python trace_file.py import ...':
+
+    python trace_file.py record --host 10.0.0.5 --port 502 --hr 0-9 \
+        --co 0-3 --interval 1 --duration 3600 plant.trace
+    python trace_file.py import plant.csv plant.trace  # time,hr:0,co:5,...
+    python trace_file.py info plant.trace
+    python trace_file.py dump plant.trace --columns hr:0,hr:1 | head
+- Only depends on the standard library (recording over Modbus needs
+  pymodbus), so it can be used on its own
+"""
+import os
+import sys
+import csv
+import mmap
+import time
+import zlib
+import struct
+import argparse
+from array import array
+from itertools import accumulate
+
+MAGIC = b'SCTR'
+VERSION = 1
+HEADER = struct.Struct('=4sHHIIQ')
+COLUMN = struct.Struct('=2sxxI')
+# rows, first time, last time
+CHUNK = struct.Struct('=Idd')
+# byte offset, compressed size
+BLOCK = struct.Struct('=QI')
+TABLES = ('di', 'co', 'hr', 'ir')
+
+
+def parse_column(name):
+    table, address = name.split(':')
+    if table not in TABLES:
+        raise ValueError("unknown table '%s' in column '%s'" % (table, name))
+    return table, int(address)
+
+
+def encode_values(values):
+    # differences to the previous value, modulo 2^16
+    previous = 0
+    deltas = array('H')
+    for value in values:
+        deltas.append((value - previous) & 0xFFFF)
+        previous = value
+    return deltas
+
+
+def decode_values(deltas):
+    return array('H', (value & 0xFFFF for value in accumulate(deltas)))
+
+
+"""
+TraceWriter writes a trace file, a chunk of rows at a time
+- columns is a list of (table, address), append() takes one value per column
+- Values are clamped to 0-65535, like the registers they come from
+"""
+
+
+class TraceWriter(object):
+
+    def __init__(self, filename, columns, chunk_rows=4096, level=6):
+        self.filename = filename
+        self.columns = [(table, int(address)) for table, address in columns]
+        self.chunk_rows = chunk_rows
+        self.level = level
+        self.index = []
+        self.start = None
+        self._times = array('d')
+        self._values = [[] for column in self.columns]
+        self.file = open(filename, 'wb')
+        self.file.write(HEADER.pack(MAGIC, VERSION, len(self.columns),
+                                    chunk_rows, 0, 0))
+        for table, address in self.columns:
+            self.file.write(COLUMN.pack(table.encode('ascii'), address))
+
+    """
+    - @brief append() adds a row of values taken at time t (seconds, e.g.
+      from time.time()); times have to be increasing
+    """
+
+    def append(self, t, values):
+        if self.start is None:
+            self.start = t
+        self._times.append(t - self.start)
+        for column, value in zip(self._values, values):
+            column.append(min(max(int(value), 0), 0xFFFF))
+        if len(self._times) >= self.chunk_rows:
+            self.flush_chunk()
+
+    def _write_block(self, data):
+        offset = self.file.tell()
+        block = zlib.compress(data, self.level)
+        self.file.write(block)
+        return offset, len(block)
+
+    def flush_chunk(self):
+        if not self._times:
+            return
+        blocks = [self._write_block(self._times.tobytes())]
+        for column in self._values:
+            blocks.append(self._write_block(encode_values(column).tobytes()))
+        self.index.append((len(self._times), self._times[0], self._times[-1],
+                           blocks))
+        self._times = array('d')
+        self._values = [[] for column in self.columns]
+
+    def close(self):
+        self.flush_chunk()
+        index_offset = self.file.tell()
+        for rows, first, last, blocks in self.index:
+            self.file.write(CHUNK.pack(rows, first, last))
+            for offset, size in blocks:
+                self.file.write(BLOCK.pack(offset, size))
+        self.file.seek(0)
+        self.file.write(HEADER.pack(MAGIC, VERSION, len(self.columns),
+                                    self.chunk_rows, len(self.index),
+                                    index_offset))
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class TraceReader(object):
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as trace:
+            self.mmap = mmap.mmap(trace.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        magic, version, num_columns, self.chunk_rows, num_chunks, \
+            index_offset = HEADER.unpack_from(self.mmap, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(filename + " is not a trace file")
+        if index_offset == 0:
+            raise ValueError(filename + " was not closed by its writer")
+        self.columns = []
+        for i in range(num_columns):
+            table, address = COLUMN.unpack_from(
+                self.mmap, HEADER.size + COLUMN.size * i)
+            self.columns.append((table.decode('ascii'), address))
+        # per chunk: (rows, first time, last time, [(offset, size), ...])
+        self.chunks = []
+        offset = index_offset
+        for i in range(num_chunks):
+            rows, first, last = CHUNK.unpack_from(self.mmap, offset)
+            offset += CHUNK.size
+            blocks = []
+            for j in range(num_columns + 1):
+                blocks.append(BLOCK.unpack_from(self.mmap, offset))
+                offset += BLOCK.size
+            self.chunks.append((rows, first, last, blocks))
+
+    @property
+    def rows(self):
+        return sum(chunk[0] for chunk in self.chunks)
+
+    @property
+    def duration(self):
+        return self.chunks[-1][2] if self.chunks else 0.0
+
+    def column_index(self, table, address):
+        try:
+            return self.columns.index((table, address))
+        except ValueError:
+            raise ValueError("%s has no column %s:%d" % (self.filename,
+                                                         table, address))
+
+    def _block(self, chunk, j):
+        offset, size = self.chunks[chunk][3][j]
+        return zlib.decompress(self.mmap[offset:offset + size])
+
+    """
+    - @brief read_chunk() returns the times of a chunk and the values of the
+      columns asked for (indexes into self.columns)
+    """
+
+    def read_chunk(self, chunk, column_indexes):
+        times = array('d')
+        times.frombytes(self._block(chunk, 0))
+        values = []
+        for i in column_indexes:
+            deltas = array('H')
+            deltas.frombytes(self._block(chunk, i + 1))
+            values.append(decode_values(deltas))
+        return times, values
+
+    """
+    - @brief iter_rows() yields (time, values) for every row, with the values
+      of the columns asked for, decompressing one chunk at a time
+    """
+
+    def iter_rows(self, column_indexes):
+        for chunk in range(len(self.chunks)):
+            times, values = self.read_chunk(chunk, column_indexes)
+            for row in range(len(times)):
+                yield times[row], [column[row] for column in values]
+
+    def close(self):
+        self.mmap.close()
+
+
+def parse_range(spec):
+    first, _, last = spec.partition('-')
+    return range(int(first), int(last or first) + 1)
+
+
+"""
+- @brief record() polls a running PLC device over Modbus every 'interval'
+  seconds and writes the values to a trace file
+"""
+
+
+def record(args):
+    from pymodbus.client.sync import ModbusTcpClient
+    reads = {'co': 'read_coils', 'di': 'read_discrete_inputs',
+             'hr': 'read_holding_registers', 'ir': 'read_input_registers'}
+    ranges = [(table, parse_range(getattr(args, table)))
+              for table in TABLES if getattr(args, table)]
+    columns = [(table, address) for table, addresses in ranges
+               for address in addresses]
+    client = ModbusTcpClient(args.host, args.port)
+    end = time.time() + args.duration
+    next_poll = time.time()
+    with TraceWriter(args.trace, columns) as writer:
+        while next_poll < end:
+            time.sleep(max(next_poll - time.time(), 0))
+            now = time.time()
+            row = []
+            for table, addresses in ranges:
+                response = getattr(client, reads[table])(
+                    addresses[0], len(addresses), unit=args.unit)
+                if response.isError():
+                    raise IOError("reading %s: %s" % (table, response))
+                if table in ('co', 'di'):
+                    row.extend(int(bit) for bit in
+                               response.bits[:len(addresses)])
+                else:
+                    row.extend(response.registers)
+            writer.append(now, row)
+            next_poll += args.interval
+    client.close()
+
+
+def import_csv(args):
+    with open(args.csv) as csv_file:
+        reader = csv.reader(csv_file)
+        header = next(reader)
+        columns = [parse_column(name) for name in header[1:]]
+        with TraceWriter(args.trace, columns) as writer:
+            for row in reader:
+                writer.append(float(row[0]),
+                              [int(float(value)) for value in row[1:]])
+
+
+def info(args):
+    reader = TraceReader(args.trace)
+    print("%s: %d columns, %d rows in %d chunks, %.3f seconds, %d bytes" % (
+        args.trace, len(reader.columns), reader.rows, len(reader.chunks),
+        reader.duration, os.path.getsize(args.trace)))
+    print(' '.join('%s:%d' % column for column in reader.columns))
+
+
+def dump(args):
+    reader = TraceReader(args.trace)
+    if args.columns:
+        indexes = [reader.column_index(*parse_column(name))
+                   for name in args.columns.split(',')]
+    else:
+        indexes = list(range(len(reader.columns)))
+    writer = csv.writer(sys.stdout)
+    writer.writerow(['time'] + ['%s:%d' % reader.columns[i]
+                                for i in indexes])
+    for t, values in reader.iter_rows(indexes):
+        writer.writerow([repr(t)] + values)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Record, import and read register traces")
+    commands = parser.add_subparsers(dest='command')
+    record_parser = commands.add_parser(
+        'record', help="Record a PLC device over Modbus/TCP")
+    record_parser.add_argument("trace")
+    record_parser.add_argument("--host", default='127.0.0.1')
+    record_parser.add_argument("--port", type=int, default=502)
+    record_parser.add_argument("--unit", type=int, default=1)
+    for table in TABLES:
+        record_parser.add_argument("--" + table,
+                                   help="Addresses to record, e.g. 0-9")
+    record_parser.add_argument("--interval", type=float, default=1,
+                               help="Seconds between polls")
+    record_parser.add_argument("--duration", type=float, default=60,
+                               help="Seconds to record for")
+    record_parser.set_defaults(run=record)
+    import_parser = commands.add_parser(
+        'import', help="Convert a CSV file (time,hr:0,co:5,...) to a trace")
+    import_parser.add_argument("csv")
+    import_parser.add_argument("trace")
+    import_parser.set_defaults(run=import_csv)
+    info_parser = commands.add_parser('info', help="Describe a trace")
+    info_parser.add_argument("trace")
+    info_parser.set_defaults(run=info)
+    dump_parser = commands.add_parser('dump', help="Print a trace as CSV")
+    dump_parser.add_argument("trace")
+    dump_parser.add_argument("--columns", help="e.g. hr:0,hr:1")
+    dump_parser.set_defaults(run=dump)
+    args = parser.parse_args()
+    if args.command is None:
+        parser.error("a command is required")
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()
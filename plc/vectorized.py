@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+
+"""
+Vectorized register behaviors, used when ENGINE has 'vectorized: true'.
+
+- Behaviors of the same table, type, period and policy are grouped and
+  compiled into NumPy arrays (addresses, variances, min/max, coil addresses)
+- Each group is run as ONE tick by the scheduler: the registers of the group
+  are read as one block, updated with array operations (clamping and coil
+  masks included) and written back with one setValues per contiguous run
+- Every register controlled by a behavior is a "lane"; the lanes of one
+  behavior are contiguous so per-behavior checks use np.minimum.reduceat
+- If two behaviors of a group control the same register, the last one wins
+- Behaviors that can not be vectorized (fuel_tank_behavior, plugins, coils
+  of other PLC devices) keep their own tick from behaviors.py
+- NumPy is optional - if it is not installed, is_available() returns False
+  and updating_writer falls back to one tick per behavior
+"""
+from datastore import *
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def is_available():
+    return np is not None
+
+
+"""
+- @brief read/write functions for the tables a group can control
+- Holding registers are read through a view, so packed datablocks are
+  copied into the array in one go instead of through a list
+"""
+
+READERS = {'hr': view_hr_register, 'co': read_co_register}
+WRITERS = {'hr': write_hr_register, 'co': write_co_register}
+
+
+"""
+- @brief Kernels take the group and the current lane values and return the
+  new lane values; one kernel per behavior type
+"""
+
+
+def linear_kernel(group, values):
+    return values + group.variance
+
+
+def random_kernel(group, values):
+    drawn = group.rng.integers(group.minimum, group.maximum, endpoint=True)
+    return drawn[group.owner]
+
+
+def constant_kernel(group, values):
+    return group.num[group.owner]
+
+
+def linear_coil_dependent_kernel(group, values):
+    default = group.read_coils() == group.default_coil_value
+    lane_default = default[group.owner]
+    new = values.copy()
+
+    # default coil value - add variance to the first register of the behavior
+    # until it reaches max
+    first = group.first & lane_default
+    new[first] = np.where(values[first] >= group.top[first], group.top[first],
+                          values[first] + group.variance[first])
+
+    # otherwise negate the variance, only if every register is above 0
+    all_gt_0 = np.minimum.reduceat(values, group.starts) > 0
+    down = ~lane_default & all_gt_0[group.owner]
+    new[down] = values[down] - group.variance[down]
+    return new
+
+
+def random_coil_dependent_kernel(group, values):
+    default = group.read_coils() == group.default_coil_value
+    lane_default = default[group.owner]
+    new = values.copy()
+
+    # checking to see if max value was reached to begin random data variance
+    first_values = values[group.starts]
+    group.at_max |= first_values >= group.behavior_top
+
+    # default coil value - random value if at max, otherwise add variance
+    up = default & ~group.at_max
+    drawn = group.rng.integers(group.rand_min, group.rand_max, endpoint=True)
+    first_new = np.where(group.at_max, drawn, first_values)
+    first_new[up] = np.where(
+        first_values[up] >= group.behavior_top[up], group.behavior_top[up],
+        first_values[up] + group.behavior_variance[up])
+    new[group.starts[default]] = first_new[default]
+
+    # otherwise negate the variance, only if every register is above 0,
+    # and stop the random data variance
+    all_gt_0 = np.minimum.reduceat(values, group.starts) > 0
+    down_behavior = ~default & all_gt_0
+    group.at_max[down_behavior] = False
+    down = down_behavior[group.owner]
+    new[down] = values[down] - group.variance[down]
+    clamp = down & group.first & (new < 0)
+    new[clamp] = 0
+    return new
+
+
+KERNELS = {('hr', 'linear'): linear_kernel,
+           ('hr', 'random'): random_kernel,
+           ('hr', 'linear_coil_dependent'): linear_coil_dependent_kernel,
+           ('hr', 'random_coil_dependent'): random_coil_dependent_kernel,
+           ('co', 'constant'): constant_kernel}
+
+
+class VectorGroup(object):
+
+    def __init__(self, table, kind, period, policy, context, log):
+        self.table = table
+        self.kind = kind
+        self.period = period
+        self.policy = policy
+        self.context = context
+        self.log = log.getChild('%s %s every %ss' % (table, kind, period))
+        self.kernel = KERNELS[(table, kind)]
+        self.behaviors = []
+        self.rng = np.random.default_rng()
+
+    def add(self, behavior):
+        self.behaviors.append(behavior)
+
+    """
+    - @brief compile() turns the behavior objects into lane arrays
+    """
+
+    def compile(self):
+        behaviors = self.behaviors
+        counts = np.array([b.count for b in behaviors], dtype=np.int64)
+        addresses = np.array([b.address for b in behaviors], dtype=np.int64)
+        self.owner = np.repeat(np.arange(len(behaviors)), counts)
+        self.starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        self.first = np.zeros(len(self.owner), dtype=bool)
+        self.first[self.starts] = True
+        lane_addr = addresses[self.owner] + \
+            (np.arange(len(self.owner)) - self.starts[self.owner])
+
+        # read the whole span of the group at once, then gather the lanes
+        self.lo = int(lane_addr.min())
+        self.span = int(lane_addr.max()) + 1 - self.lo
+        self.lane_offset = lane_addr - self.lo
+
+        # contiguous runs of controlled registers - one setValues per run
+        offsets = np.unique(self.lane_offset)
+        breaks = np.flatnonzero(np.diff(offsets) != 1) + 1
+        self.runs = [(int(run[0]), len(run))
+                     for run in np.split(offsets, breaks)]
+
+        def column(key):
+            return np.array([getattr(b, key) for b in behaviors],
+                            dtype=np.int64)
+
+        def lanes(key):
+            return column(key)[self.owner]
+
+        if self.kind in ('linear', 'linear_coil_dependent',
+                         'random_coil_dependent'):
+            self.behavior_variance = column('variance')
+            self.variance = self.behavior_variance[self.owner]
+        if self.kind == 'random':
+            self.minimum = column('min')
+            self.maximum = column('max')
+        if self.kind == 'constant':
+            self.num = column('num')
+        # tables to lock for the update - 1 is co, 3 is hr
+        self.fxs = (1,) if self.table == 'co' else (3,)
+        if self.kind in ('linear_coil_dependent', 'random_coil_dependent'):
+            self.fxs = (1, 3)
+            self.behavior_top = column('max')
+            self.top = lanes('max')
+            self.coil_address = column('coil_address')
+            self.default_coil_value = column('default_coil_value')
+            self.coil_lo = int(self.coil_address.min())
+            self.coil_span = int(self.coil_address.max()) + 1 - self.coil_lo
+        if self.kind == 'random_coil_dependent':
+            self.rand_min = column('rand_min')
+            self.rand_max = column('rand_max')
+            self.at_max = np.zeros(len(behaviors), dtype=bool)
+
+    def read_coils(self):
+        coils = read_co_register(self.context[0], 0x00, self.coil_lo,
+                                 self.coil_span)
+        coils = np.array(coils, dtype=np.int64) != 0
+        return coils[self.coil_address - self.coil_lo]
+
+    def tick(self):
+        read = READERS[self.table]
+        write = WRITERS[self.table]
+        # the read, coil check and writes of the group are one update
+        with transaction(self.context[0], *self.fxs):
+            block = np.array(read(self.context[0], 0x00, self.lo, self.span),
+                             dtype=np.int64)
+            new = self.kernel(self, block[self.lane_offset])
+            block[self.lane_offset] = new
+            for offset, length in self.runs:
+                write(self.context[0], 0x00, self.lo + offset,
+                      block[offset:offset + length].tolist())
+        self.log.debug(new)
+
+    def __str__(self):
+        return "%s %s x%d every %ss" % (self.table, self.kind,
+                                        len(self.behaviors), self.period)
+
+
+class VectorEngine(object):
+
+    def __init__(self, context, log):
+        self.context = context
+        self.log = log
+        self.groups = {}
+
+    """
+    - @brief accept() takes a compiled behavior if it can be vectorized
+    - Returns False for behavior types that need their own tick
+    """
+
+    def accept(self, behavior):
+        key = (behavior.table, behavior.type_name)
+        if key not in KERNELS or getattr(behavior, 'remote', None) is not None:
+            # coils of other PLC devices are read one by one
+            return False
+        group_key = key + (behavior.period, behavior.policy)
+        if group_key not in self.groups:
+            self.groups[group_key] = VectorGroup(
+                behavior.table, behavior.type_name, behavior.period,
+                behavior.policy, self.context, self.log)
+        self.groups[group_key].add(behavior)
+        return True
+
+    def schedule(self, scheduler):
+        entries = []
+        for group in self.groups.values():
+            group.compile()
+            entries.append(scheduler.add(group.tick, group.period,
+                                         name=str(group),
+                                         policy=group.policy))
+        return entries
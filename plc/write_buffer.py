@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+"""
+Write coalescing for the register behaviors, used when ENGINE has
+'coalesce_writes: true'.
+
+- Behaviors write to a WriteBuffer in front of the slave context instead of
+  the slave context itself; every setValues is kept in memory, per table and
+  address, and reads through the buffer see the values written so far
+- Once every tick due at a deadline has run, the scheduler flushes the
+  buffer (even while it is behind, so writes are held back for one deadline
+  at most): the addresses written are merged into contiguous ranges and
+  written with one setValues per range, holding the locks of the tables
+  written
+- Behaviors on adjacent addresses (or rewriting the same one) then cost one
+  setValues per range and batch instead of one per behavior and tick; the
+  counters of the buffer (and metrics.py) show the calls saved
+- Modbus clients see the writes of a batch once it is flushed; a client
+  write to a register landing between a behavior's write and the flush is
+  overwritten, as if it came just before the behavior's write
+- Vectorized groups (vectorized.py) and the PLANT model (plant.py) already
+  write one setValues per range and write to the slave context directly
+- A WriteBuffer is only used from the thread of its scheduler
+"""
+from datastore import transaction
+
+
+class WriteBuffer(object):
+
+    def __init__(self, slave):
+        self.slave = slave
+        # looked up for every update (table_lock in datastore.py)
+        self.store = slave.store
+        self.decode = slave.decode
+        # fx -> {address: value}
+        self.pending = {}
+        # setValues calls by behaviors, setValues calls made by flush()
+        self.writes = 0
+        self.flushed_calls = 0
+        self.flushed_values = 0
+        self.flushes = 0
+
+    def setValues(self, fx, address, values):
+        pending = self.pending.get(fx)
+        if pending is None:
+            pending = self.pending[fx] = {}
+        for offset, value in enumerate(values):
+            pending[address + offset] = value
+        self.writes += 1
+
+    def getValues(self, fx, address, count=1):
+        values = self.slave.getValues(fx, address, count)
+        pending = self.pending.get(fx)
+        if pending:
+            values = list(values)
+            if count < len(pending):
+                for offset in range(count):
+                    value = pending.get(address + offset, values)
+                    if value is not values:
+                        values[offset] = value
+            else:
+                end = address + count
+                for pending_address, value in pending.items():
+                    if address <= pending_address < end:
+                        values[pending_address - address] = value
+        return values
+
+    """
+    - @brief flush() writes the buffered values with one setValues per
+      contiguous range of addresses and table
+    """
+
+    def flush(self):
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, {}
+        with transaction(self.slave, *pending):
+            for fx, values in pending.items():
+                for address, run in ranges(values):
+                    self.slave.setValues(fx, address, run)
+                    self.flushed_calls += 1
+                    self.flushed_values += len(run)
+        self.flushes += 1
+
+    def calls_saved(self):
+        return self.writes - self.flushed_calls
+
+    def __getattr__(self, name):
+        # store, decode, zero_mode, validate... of the slave context, so the
+        # table locks of datastore.py are the same
+        return getattr(self.slave, name)
+
+
+class BufferedServerContext(object):
+
+    # context[0] for the behaviors, like MeteredServerContext in metrics.py
+
+    def __init__(self, context, write_buffer):
+        self.context = context
+        self.write_buffer = write_buffer
+
+    def __getitem__(self, slave):
+        return self.write_buffer
+
+    def __getattr__(self, name):
+        return getattr(self.context, name)
+
+
+"""
+- @brief ranges() returns (first address, values) for every run of
+  consecutive addresses of an {address: value} dict, in address order
+"""
+
+
+def ranges(values):
+    runs = []
+    previous = None
+    for address in sorted(values):
+        if previous is None or address != previous + 1:
+            run = []
+            runs.append((address, run))
+        run.append(values[address])
+        previous = address
+    return runs
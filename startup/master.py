@@ -3,9 +3,21 @@
 # SCADA Simulator
 
 import sys
+import pickle
+import hashlib
 import yaml
 from os import path
 
+try:
+    from yaml import CDumper as Dumper
+except ImportError:
+    from yaml import Dumper
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..',
+                             'plc'))
+from config_cache import compile_config
+from templates import get_plc_config
+
 # (Default) open txt file to get config.yaml file name IF path of config
 # file was not supplied as argument to master.py
 # strip any trailing /n from string
@@ -17,39 +29,43 @@ if len(sys.argv) == 1:
 else:
     file_name = sys.argv[1]
 
-# open yaml config file, build object
-with open(file_name, 'r') as config_file:
-    config_yaml = yaml.safe_load(config_file)
+# parse and validate the yaml config file, and write the per PLC device
+# cache async_plc.py loads its configuration from (config_cache.py)
+try:
+    config_yaml = compile_config(file_name)
+except ValueError as error:
+    sys.stderr.write("Invalid config file " + file_name + ": " +
+                     str(error) + "\n")
+    sys.exit(1)
 
 # get number of plc devices from MASTER section of the config file
 num_of_plc = config_yaml['MASTER']['num_of_PLC']
 # create backup files if they do not already exist - 1 for each PLC device
+# PLC devices of a PLC_GROUPS template mostly share the same datastore, so
+# the YAML of every distinct datastore is only dumped once
+dumped = {}
 i = 0
 while i < num_of_plc:
     num = str(i)
-    plc_device_name = 'PLC ' + num
     # keep in the src repo, in format of "backup_N.yaml",
     # where N is the ID of the PLC device
     backup_file = '/usr/local/bin/scadasim_pymodbus_plc/backups/backup_' \
                   + num + '.yaml'
-    
-    # collect num of register/coils for each plc device
-    hr_values = config_yaml[plc_device_name]['DATASTORE']['hr']['values']
-    co_values = config_yaml[plc_device_name]['DATASTORE']['co']['values']
-    di_values = config_yaml[plc_device_name]['DATASTORE']['di']['values']
-    ir_values = config_yaml[plc_device_name]['DATASTORE']['ir']['values']
 
     # check if file exists
     if not path.exists(backup_file) or path.getsize(backup_file) == 0:
-        # create file - only storing the register starting address and values 
-        backup_dict = {}
+        # collect num of register/coils for each plc device, expanded from
+        # its template if it has one
+        datastore = get_plc_config(config_yaml, i)['DATASTORE']
+        # create file - only storing the register starting address and values
+        backup_dict = {'DATASTORE': dict(
+            (table, {'start_addr': 1, 'values': datastore[table]['values']})
+            for table in ('hr', 'ir', 'co', 'di'))}
+        key = hashlib.sha256(pickle.dumps(backup_dict)).digest()
+        if key not in dumped:
+            dumped[key] = yaml.dump(backup_dict, Dumper=Dumper)
         with open(backup_file, 'w+') as backup:
-            backup_dict['DATASTORE'] = {
-                'hr': {'start_addr': 1, 'values': hr_values},
-                'ir': {'start_addr': 1, 'values': ir_values},
-                'co': {'start_addr': 1, 'values': co_values},
-                'di': {'start_addr': 1, 'values': di_values}}
-            yaml.dump(backup_dict, backup)
+            backup.write(dumped[key])
     i = i + 1
 
 # return number of backup files created and the config
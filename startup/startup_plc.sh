@@ -41,25 +41,28 @@ else
     result=$(python /usr/local/bin/scadasim_pymodbus_plc/startup/master.py $TEMPLATE_VAR)
 fi
 
+# master.py exits with an error (and prints nothing) if the config is invalid
+if [ "$result" = "" ]; then
+    echo "master.py could not load the config file"
+    exit 1
+fi
+
 # master.py will return the number of plc devices for this schema, and the path of the config file
 results=( $result )
 
 echo "$results"
 
 # parse results
-START=0
 END=${results[0]}
 name_of_config=${results[1]}
 
-# loop and start plc devices with their ID and the path of the config file supplied as arguments
-# run in background as async_plc will start off multiple threads
-for (( c=$START; c<$END; c++ ))
-do
-        echo "Running async_plc.py with arg $c"
-	python /usr/local/bin/scadasim_pymodbus_plc/plc/async_plc.py --n $c --c $name_of_config &	
-done
-
-# keep script alive so that async_plc programs continue to run
-while true; do
-    echo
-done
+# supervisor.py shards the plc devices across one async_plc.py worker process
+# per CPU, restarts workers that exit or stop answering, and blocks (without
+# using any CPU) until it is stopped, so this script keeps running for systemd.
+# With PLC_HOST_MODE=1, every plc device is served from one worker process
+if [ "$PLC_HOST_MODE" = "1" ]; then
+        echo "Running supervisor.py with 1 worker"
+        exec python /usr/local/bin/scadasim_pymodbus_plc/startup/supervisor.py $END $name_of_config --workers 1
+fi
+echo "Running supervisor.py for $END plc devices"
+exec python /usr/local/bin/scadasim_pymodbus_plc/startup/supervisor.py $END $name_of_config
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+
+# SCADA Simulator
+
+"""
+Runs the PLC devices of a master config in a fixed number of worker
+processes, and keeps them running.
+
+    python supervisor.py <num_of_PLC> <config file>     # master.py's output
+
+- The PLC devices are split into contiguous shards, one per worker; every
+  worker is an 'async_plc.py --range START-END' process hosting its shard
+  from one reactor (see run_plc_host in async_plc.py)
+- There are as many workers as CPUs (--workers), or one with MASTER
+  'host_mode: true', and every worker is pinned to a CPU of its own where
+  the OS supports it (--no_pin to leave it to the scheduler)
+- A worker that exits is restarted, after a delay that doubles with every
+  restart in a row (up to --max_backoff seconds) so a crashing config does
+  not spin; a worker that kept running for a while starts over at 1 second
+- Health checks: every --check_interval seconds one PLC device of each
+  worker (in turn) with a TCP server must accept a connection; a worker
+  failing --max_failures checks in a row is killed and restarted
+- Between checks the supervisor blocks in select() on a self-pipe; an
+  exiting worker or SIGTERM/SIGINT wakes it up (signal.set_wakeup_fd writes
+  to the pipe, so the signal handlers take no locks). On SIGTERM/SIGINT the
+  workers are stopped too
+"""
+import os
+import sys
+import time
+import signal
+import select
+import socket
+import logging
+import argparse
+import subprocess
+from os import path
+
+PLC_DIR = path.join(path.dirname(path.abspath(__file__)), '..', 'plc')
+sys.path.insert(0, PLC_DIR)
+
+
+def shard(num_of_plc, workers):
+    # contiguous, as even as possible: [(first, last), ...]
+    if num_of_plc < 1:
+        raise ValueError("there are no PLC devices to run (num_of_PLC is %d)"
+                         % num_of_plc)
+    workers = max(min(workers, num_of_plc), 1)
+    size, extra = divmod(num_of_plc, workers)
+    shards = []
+    first = 0
+    for i in range(workers):
+        last = first + size + (1 if i < extra else 0) - 1
+        shards.append((first, last))
+        first = last + 1
+    return shards
+
+
+def probe_address(server_config):
+    # only TCP servers can be probed without speaking Modbus
+    if server_config.get('type') != 'tcp':
+        return None
+    host = server_config.get('address') or '127.0.0.1'
+    if host in ('0.0.0.0', ''):
+        host = '127.0.0.1'
+    return host, int(server_config['port'])
+
+
+class Worker(object):
+
+    def __init__(self, shard_range, cpu, probes, args):
+        self.first, self.last = shard_range
+        self.cpu = cpu
+        # (host, port) of the PLC devices that can be probed
+        self.probes = probes
+        self.args = args
+        self.process = None
+        self.started = 0
+        self.backoff = 1
+        self.restart_at = 0
+        self.failures = 0
+        self.next_probe = 0
+        self.restarts = 0
+
+    def __str__(self):
+        return "worker PLC %d-%d" % (self.first, self.last)
+
+    def start(self, log):
+        command = [self.args.python, path.join(PLC_DIR, 'async_plc.py'),
+                   '--range', '%d-%d' % (self.first, self.last),
+                   '--c', self.args.config]
+        self.process = subprocess.Popen(command)
+        self.started = time.time()
+        self.failures = 0
+        if self.cpu is not None:
+            try:
+                os.sched_setaffinity(self.process.pid, {self.cpu})
+            except OSError as error:
+                log.warning("%s: could not pin to CPU %d: %s", self, self.cpu,
+                            error)
+        log.info("%s started, pid %d%s", self, self.process.pid,
+                 '' if self.cpu is None else ', CPU %d' % self.cpu)
+
+    """
+    - @brief exited() schedules a restart of a worker that exited
+    """
+
+    def exited(self, now, log):
+        code = self.process.returncode
+        self.process = None
+        if now - self.started > self.args.max_backoff:
+            # it ran for a while, this is not a crash loop
+            self.backoff = 1
+        self.restart_at = now + self.backoff
+        log.warning("%s exited with %s, restarting in %ds", self, code,
+                    self.backoff)
+        self.backoff = min(self.backoff * 2, self.args.max_backoff)
+        self.restarts += 1
+
+    def probe(self, log):
+        if not self.probes or time.time() - self.started < self.args.grace:
+            return True
+        address = self.probes[self.next_probe % len(self.probes)]
+        self.next_probe += 1
+        try:
+            socket.create_connection(address, timeout=self.args.timeout) \
+                .close()
+            self.failures = 0
+            return True
+        except (OSError, socket.timeout) as error:
+            self.failures += 1
+            log.warning("%s: PLC device at %s:%d failed a health check "
+                        "(%d in a row): %s", self, address[0], address[1],
+                        self.failures, error)
+            return self.failures < self.args.max_failures
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+
+
+class Supervisor(object):
+
+    def __init__(self, args, log):
+        self.args = args
+        self.log = log
+        # signal.set_wakeup_fd writes to it, select() waits on it
+        self.wakeup_read, self.wakeup_write = os.pipe()
+        for fd in (self.wakeup_read, self.wakeup_write):
+            os.set_blocking(fd, False)
+        self.stopping = False
+        self.workers = []
+
+    def build_workers(self):
+        from config_cache import load_plc_configs, load_sections
+        cpus = [None]
+        if not self.args.no_pin and hasattr(os, 'sched_getaffinity'):
+            cpus = sorted(os.sched_getaffinity(0))
+        available = len(cpus) if cpus != [None] else os.cpu_count() or 1
+        if load_sections(self.args.config, ['MASTER'])['MASTER'].get(
+                'host_mode', False):
+            # register references are only checked for one process
+            workers = 1
+        else:
+            workers = self.args.workers or available
+        for i, (first, last) in enumerate(shard(self.args.num_of_PLC,
+                                                workers)):
+            configs = load_plc_configs(self.args.config,
+                                       range(first, last + 1))
+            probes = [address for address in (
+                probe_address(configs['PLC ' + str(num)]['SERVER'])
+                for num in range(first, last + 1)) if address is not None]
+            self.workers.append(Worker((first, last), cpus[i % len(cpus)],
+                                       probes, self.args))
+
+    def handle_signal(self, signum, frame):
+        # only sets a flag; the wakeup fd wakes up the loop
+        if signum != signal.SIGCHLD:
+            self.stopping = True
+
+    def wait(self, timeout):
+        try:
+            select.select([self.wakeup_read], [], [], max(timeout, 0))
+        except InterruptedError:
+            pass
+        try:
+            while os.read(self.wakeup_read, 512):
+                pass
+        except BlockingIOError:
+            pass
+
+    def run(self):
+        self.build_workers()
+        signal.set_wakeup_fd(self.wakeup_write)
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGCHLD):
+            signal.signal(signum, self.handle_signal)
+        for worker in self.workers:
+            worker.start(self.log)
+        next_check = time.time() + self.args.check_interval
+        while not self.stopping:
+            now = time.time()
+            timeout = next_check - now
+            for worker in self.workers:
+                if worker.process is None:
+                    timeout = min(timeout, worker.restart_at - now)
+            # blocks until a worker exits, a signal or the next deadline
+            self.wait(timeout)
+            if self.stopping:
+                break
+            now = time.time()
+            check = now >= next_check
+            if check:
+                next_check = now + self.args.check_interval
+            for worker in self.workers:
+                if worker.process is not None and \
+                        worker.process.poll() is not None:
+                    worker.exited(now, self.log)
+                if worker.process is None:
+                    if now >= worker.restart_at:
+                        worker.start(self.log)
+                elif check and not worker.probe(self.log):
+                    self.log.warning("%s is not healthy, killing it", worker)
+                    worker.process.kill()
+                    worker.process.wait()
+                    worker.exited(now, self.log)
+        self.stop()
+
+    def stop(self):
+        self.log.info("stopping %d workers", len(self.workers))
+        for worker in self.workers:
+            worker.stop()
+        deadline = time.time() + 10
+        for worker in self.workers:
+            if worker.process is None:
+                continue
+            try:
+                worker.process.wait(max(deadline - time.time(), 0))
+            except subprocess.TimeoutExpired:
+                worker.process.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run the PLC devices of a master config in worker "
+                    "processes and keep them running")
+    parser.add_argument("num_of_PLC", type=int,
+                        help="Number of PLC devices, from master.py")
+    parser.add_argument("config", help="Master config file, from master.py")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="Number of worker processes (default: one "
+                             "per CPU)")
+    parser.add_argument("--no_pin", action='store_true',
+                        help="Do not pin workers to CPUs")
+    parser.add_argument("--check_interval", type=float, default=10,
+                        help="Seconds between health checks")
+    parser.add_argument("--grace", type=float, default=30,
+                        help="Seconds after a start before health checks")
+    parser.add_argument("--timeout", type=float, default=2,
+                        help="Seconds a health check waits to connect")
+    parser.add_argument("--max_failures", type=int, default=3,
+                        help="Failed health checks in a row before a "
+                             "worker is restarted")
+    parser.add_argument("--max_backoff", type=float, default=60,
+                        help="Longest delay before a restart, in seconds")
+    parser.add_argument("--python", default=sys.executable,
+                        help="Python interpreter to run async_plc.py with")
+    args = parser.parse_args()
+    if args.num_of_PLC < 1:
+        parser.error("num_of_PLC has to be at least 1")
+
+    logging.basicConfig(format='%(asctime)-15s supervisor %(levelname)-8s '
+                               '%(message)s', level=logging.INFO)
+    Supervisor(args, logging.getLogger('supervisor')).run()
+
+
+if __name__ == "__main__":
+    main()